@@ -0,0 +1,244 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+# one fixed width record for each window of heralding attempts, written by the node that controls the EPS. node and
+# protocol are indices in the table of names, attempt is the first attempt latched by this node (the first one that
+# entangled a pair with multiplexing) and other_attempt the first one reported by the peer in END, -1 if none
+ATTEMPT_DTYPE = np.dtype([
+    ("trial", "i8"),
+    ("run_start", "f8"),
+    ("window_start", "f8"),
+    ("window_end", "f8"),
+    ("node", "u2"),
+    ("protocol", "u2"),
+    ("window", "u4"),
+    ("k_attempts", "u4"),
+    ("attempt", "i4"),
+    ("other_attempt", "i4"),
+    ("latched", "u2"),
+    ("matched", "u2"),
+])
+
+META_FILE = "meta.json"
+
+def _chunk_name(index):
+    return f"chunk_{index:06d}.bin"
+
+class AttemptStore:
+    """
+    This class appends the windows of the MS protocols to chunked binary files, it keeps only one chunk in memory
+    """
+
+    def __init__(self, buffer_records = 1 << 16, chunk_records = 1 << 22):
+        # the protocols check this flag before recording, like the level of the tracer
+        self.enabled = False
+        # index of the trial the next records belong to, set by whoever runs the trials
+        self.trial = -1
+        self.buffer_records = buffer_records
+        self.chunk_records = chunk_records
+
+        self.directory = None
+        self._buffer = np.zeros(buffer_records, dtype = ATTEMPT_DTYPE)
+        self._count = 0
+        self._chunk = 0
+        self._chunk_count = 0
+        self._names = []
+        self._name_index = {}
+        self._names_saved = 0
+
+    def open(self, directory):
+        # records are appended after the ones already in the directory, a store is never rewritten
+        self.close()
+        os.makedirs(directory, exist_ok = True)
+        self.directory = directory
+
+        meta_path = os.path.join(directory, META_FILE)
+        self._names = []
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if np.dtype([tuple(field) for field in meta["dtype"]]) != ATTEMPT_DTYPE:
+                raise ValueError(f"The records in {directory} have a different layout")
+            self.chunk_records = meta["chunk_records"]
+            self._names = meta["names"]
+        self._name_index = {name: index for index, name in enumerate(self._names)}
+        self._names_saved = len(self._names) if os.path.exists(meta_path) else -1
+
+        # the last chunk may be only partially full
+        self._chunk = 0
+        while os.path.exists(os.path.join(directory, _chunk_name(self._chunk + 1))):
+            self._chunk += 1
+        last = os.path.join(directory, _chunk_name(self._chunk))
+        self._chunk_count = os.path.getsize(last) // ATTEMPT_DTYPE.itemsize if os.path.exists(last) else 0
+
+        self._count = 0
+        self.enabled = True
+
+    def _intern(self, name):
+        index = self._name_index.get(name)
+        if index is None:
+            index = len(self._names)
+            self._names.append(name)
+            self._name_index[name] = index
+        return index
+
+    def record(self, run_start, window_start, window_end, node, protocol, window, k_attempts, attempt, other_attempt,
+               latched, matched):
+        self._buffer[self._count] = (self.trial, run_start, window_start, window_end, self._intern(node),
+                                     self._intern(protocol), window, k_attempts, attempt, other_attempt, latched, matched)
+        self._count += 1
+        if self._count == len(self._buffer):
+            self.flush()
+
+    def _save_meta(self):
+        meta = {"dtype": ATTEMPT_DTYPE.descr, "chunk_records": self.chunk_records, "names": self._names}
+        # the meta of the store is replaced at once, a reader never sees half of it
+        tmp_path = os.path.join(self.directory, META_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(self.directory, META_FILE))
+        self._names_saved = len(self._names)
+
+    def flush(self):
+        if self.directory is None:
+            return
+        if self._names_saved != len(self._names):
+            self._save_meta()
+
+        written = 0
+        while written < self._count:
+            if self._chunk_count == self.chunk_records:
+                self._chunk += 1
+                self._chunk_count = 0
+            size = min(self._count - written, self.chunk_records - self._chunk_count)
+            with open(os.path.join(self.directory, _chunk_name(self._chunk)), "ab") as f:
+                self._buffer[written:written + size].tofile(f)
+            written += size
+            self._chunk_count += size
+        self._count = 0
+
+    def close(self):
+        self.flush()
+        self.directory = None
+        self.enabled = False
+
+class AttemptReader:
+    """
+    This class maps the chunks of one or more stores as numpy arrays, without reading them
+    """
+
+    def __init__(self, path):
+        # a store, or a directory with a store for each process
+        self.directories = sorted(root for root, _, files in os.walk(path) if META_FILE in files)
+        if not self.directories:
+            raise FileNotFoundError(f"There is no attempt store in {path}")
+
+        self.names = {}
+        for directory in self.directories:
+            with open(os.path.join(directory, META_FILE)) as f:
+                meta = json.load(f)
+            if np.dtype([tuple(field) for field in meta["dtype"]]) != ATTEMPT_DTYPE:
+                raise ValueError(f"The records in {directory} have a different layout")
+            self.names[directory] = meta["names"]
+
+    def chunks(self):
+        for directory in self.directories:
+            index = 0
+            while True:
+                path = os.path.join(directory, _chunk_name(index))
+                if not os.path.exists(path):
+                    break
+                # a writer may be appending, only the complete records are mapped
+                count = os.path.getsize(path) // ATTEMPT_DTYPE.itemsize
+                if count > 0:
+                    yield np.memmap(path, dtype = ATTEMPT_DTYPE, mode = "r", shape = (count,))
+                index += 1
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self.chunks())
+
+    def attempt_distribution(self):
+        # number of windows in which the pair was entangled at each attempt index
+        counts = np.zeros(0, dtype = np.int64)
+        for chunk in self.chunks():
+            attempts = chunk["attempt"][(chunk["matched"] > 0) & (chunk["attempt"] >= 0)]
+            chunk_counts = np.bincount(attempts)
+            if len(chunk_counts) > len(counts):
+                counts = np.pad(counts, (0, len(chunk_counts) - len(counts)))
+            counts[:len(chunk_counts)] += chunk_counts
+        return counts
+
+    def window_success_rates(self):
+        # fraction of the n-th windows of a run that entangled at least a pair
+        windows = np.zeros(0, dtype = np.int64)
+        successes = np.zeros(0, dtype = np.int64)
+        for chunk in self.chunks():
+            chunk_windows = np.bincount(chunk["window"])
+            chunk_successes = np.bincount(chunk["window"], weights = chunk["matched"] > 0,
+                                          minlength = len(chunk_windows)).astype(np.int64)
+            if len(chunk_windows) > len(windows):
+                windows = np.pad(windows, (0, len(chunk_windows) - len(windows)))
+                successes = np.pad(successes, (0, len(chunk_windows) - len(successes)))
+            windows[:len(chunk_windows)] += chunk_windows
+            successes[:len(chunk_successes)] += chunk_successes
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            rates = np.where(windows > 0, successes / np.maximum(windows, 1), np.nan)
+        return {"windows": windows, "successes": successes, "rates": rates}
+
+    def latency_cdf(self, num_bins = 1000):
+        # nsecs from the start of the MS protocol to the end of the window that entangled the pair.
+        # The first pass finds the range of the latencies, the second one fills the histogram
+        low, high = np.inf, -np.inf
+        for chunk in self.chunks():
+            latencies = self._latencies(chunk)
+            if len(latencies) > 0:
+                low = min(low, latencies.min())
+                high = max(high, latencies.max())
+        if low > high:
+            return {"edges": np.zeros(0), "cdf": np.zeros(0)}
+
+        edges = np.linspace(low, high if high > low else low + 1, num_bins + 1)
+        counts = np.zeros(num_bins, dtype = np.int64)
+        for chunk in self.chunks():
+            counts += np.histogram(self._latencies(chunk), bins = edges)[0]
+        return {"edges": edges, "cdf": np.cumsum(counts) / counts.sum()}
+
+    @staticmethod
+    def _latencies(chunk):
+        matched = chunk["matched"] > 0
+        return chunk["window_end"][matched] - chunk["run_start"][matched]
+
+    def summary(self, quantiles = (0.5, 0.9, 0.99)):
+        distribution = self.attempt_distribution()
+        windows = self.window_success_rates()
+        cdf = self.latency_cdf()
+        latencies = {}
+        if len(cdf["cdf"]) > 0:
+            for q in quantiles:
+                # upper edge of the first bin where the cdf reaches q
+                latencies[f"p{round(q * 100)}"] = float(cdf["edges"][1:][np.searchsorted(cdf["cdf"], q)])
+
+        return {
+            "windows": int(windows["windows"].sum()),
+            "successful_windows": int(windows["successes"].sum()),
+            "mean_attempt": float(np.average(np.arange(len(distribution)), weights = distribution))
+                            if distribution.sum() > 0 else None,
+            "window_success_rates": [None if np.isnan(rate) else float(rate) for rate in windows["rates"][1:]],
+            "latency_quantiles": latencies,
+        }
+
+# store shared by all the protocols, it is disabled until a directory is opened
+ATTEMPTS = AttemptStore()
+
+def main():
+    parser = argparse.ArgumentParser(description = "Summarize the heralding attempts recorded by trials.py --attempts")
+    parser.add_argument("path", help = "directory of the attempt stores")
+    args = parser.parse_args()
+
+    print(json.dumps(AttemptReader(args.path).summary(), indent = 2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+import argparse
+import json
+import math
+
+import numpy as np
+
+from links import FIBRE_SPEED, eps_period, herald_probabilities
+
+# The states produced by the protocols stay Bell-diagonal, so a pair is represented by the 4 coefficients on the bell
+# states. The index of a bell state is 2 * z + x, where x is a bit flip and z a phase flip with respect to b00:
+# it is the same index returned by the BSM of netsquid (0 -> b00, 1 -> b01, 2 -> b10, 3 -> b11).
+B00, B01, B10, B11 = range(4)
+
+# the state latched when the two nodes store photons of two different pulses in the same attempt
+MIXED_STATE = np.full(4, 0.25)
+
+def link_state(depolar_rate = 0.1):
+    # both photons of the b00 pair are depolarized (time independent model, so the rate is a probability)
+    # while travelling to the nodes
+    werner = (1 - depolar_rate) ** 2
+    state = np.full(4, (1 - werner) / 4)
+    state[B00] += werner
+    return state
+
+def compose(state_a, state_b):
+    # pauli frame of two pairs joined by a swap: the errors add up as xor of the bell indices
+    composed = np.zeros(np.broadcast_shapes(state_a.shape, state_b.shape))
+    for i in range(4):
+        for j in range(4):
+            composed[..., i ^ j] += state_a[..., i] * state_b[..., j]
+    return composed
+
+def _combine_phases(control, target):
+    # control and target are indexed by [z, x], the phase flips of the two pairs add up on the control pair
+    combined = np.empty(np.broadcast_shapes(control.shape, target.shape))
+    combined[..., 0, :] = control[..., 0, :] * target[..., 0, :] + control[..., 1, :] * target[..., 1, :]
+    combined[..., 1, :] = control[..., 0, :] * target[..., 1, :] + control[..., 1, :] * target[..., 0, :]
+    return combined
+
+def purify(control, target, rng):
+    # both the nodes apply a CNOT from the control to the target pair and measure the target qubit:
+    # the outcomes match when the bit flips of the two pairs are equal, then the control keeps its bit flip
+    # and gets the phase flips of both pairs
+    control = control.reshape(control.shape[:-1] + (2, 2))
+    target = target.reshape(target.shape[:-1] + (2, 2))
+
+    match = _combine_phases(control, target)
+    mismatch = _combine_phases(control, target[..., ::-1])
+
+    p_match = match.sum(axis = (-2, -1))
+    matched = rng.random(p_match.shape) < p_match
+
+    # when the outcomes don't match the protocol goes on anyway with the resulting pair
+    state = np.where(matched[..., None, None],
+                     match / np.where(p_match > 0, p_match, 1)[..., None, None],
+                     mismatch / np.where(p_match < 1, 1 - p_match, 1)[..., None, None])
+
+    return state.reshape(state.shape[:-2] + (4,)), matched
+
+def swap(state_left, state_right, rng):
+    # for bell diagonal pairs the outcome of the BSM is uniform, the end node then expects the state b_outcome
+    outcome = rng.integers(0, 4, size = np.broadcast_shapes(state_left.shape, state_right.shape)[:-1])
+    # with respect to b_outcome the e2e pair has the composed errors of the two links
+    return compose(state_left, state_right), outcome
+
+def _window_probabilities(p_m, p_lr, K_attempts, pulses_per_attempt):
+    # probability that a pulse brings at least one photon, and that it brings both of them
+    p_any, p_both = herald_probabilities(p_m, p_lr)
+    # probability that a pulse brings a photon to a given node
+    p_side = p_m * p_lr
+
+    # every node latches the first photon that arrives in the window, the generation succeeds if both the
+    # nodes latched a photon in the same attempt
+    pulses = np.arange(K_attempts * pulses_per_attempt)
+    first_photon = (1 - p_any) ** pulses * p_any
+
+    p_same_pulse = p_both * first_photon.sum()
+
+    # only one photon arrived: the other node must latch a photon of a following pulse of the same attempt,
+    # in this case the two stored qubits are not entangled
+    remaining_pulses = pulses_per_attempt - 1 - pulses % pulses_per_attempt
+    p_other_pulse = ((1 - p_both) * first_photon * (1 - (1 - p_side) ** remaining_pulses)).sum()
+
+    return p_same_pulse, p_other_pulse
+
+class BellDiagonalEngine:
+    """
+    This class samples the MS -> purification -> swapping pipeline of get_network with Bell-diagonal states
+    """
+
+    def __init__(self, link_length, p_lr, p_m, t_clock, K_attempts = None, depolar_rate = 0.1):
+        if K_attempts is None:
+            # same number of attempts computed by get_network
+            K_attempts = math.ceil((1/p_m*p_lr))
+
+        self.link_length = link_length
+        self.p_lr = p_lr
+        self.p_m = p_m
+        self.t_clock = t_clock
+        self.K_attempts = K_attempts
+
+        # the EPS emits several pulses in each clock cycle
+        self.period = eps_period(t_clock)
+        self.pulses_per_attempt = max(1, round(t_clock / self.period))
+
+        # time in nsecs to go through a link
+        self.t_link = link_length / FIBRE_SPEED * 10 ** 9
+
+        self.link_state = link_state(depolar_rate)
+
+        p_same_pulse, p_other_pulse = _window_probabilities(p_m, p_lr, K_attempts, self.pulses_per_attempt)
+        self.p_window = p_same_pulse + p_other_pulse
+        if self.p_window <= 0:
+            raise ValueError("The entanglement generation can never succeed with these parameters")
+        self.p_same_pulse = p_same_pulse / self.p_window
+
+    def _sample_generation(self, start, rng):
+        # the node that controls the EPS waits for the first photon, then it sends START to the other node
+        first_photon = start + rng.geometric(self.p_m * self.p_lr, size = start.shape) * self.period + self.t_link / 2
+        start_time = np.ceil(first_photon + self.t_link)
+        start_time = start_time + (self.t_clock - start_time % self.t_clock) + self.t_clock - 1
+
+        # each window is followed by the exchange of the END messages
+        windows = rng.geometric(self.p_window, size = start.shape)
+        end_time = start_time + windows * (self.K_attempts * self.t_clock + 5 + self.t_link)
+
+        same_pulse = rng.random(start.shape) < self.p_same_pulse
+        state = np.where(same_pulse[:, None], self.link_state, MIXED_STATE)
+
+        return state, end_time, windows
+
+    def _sample_link(self, num_trials, rng):
+        start = np.zeros(num_trials)
+
+        # the two pairs are generated one after the other
+        state_0, end_0, windows_0 = self._sample_generation(start, rng)
+        state_1, end_1, windows_1 = self._sample_generation(end_0, rng)
+
+        state, matched = purify(state_0, state_1, rng)
+
+        # CNOT and measurement of 1 nsec each, then the outcomes are exchanged
+        end_time = end_1 + 2 + self.t_link
+
+        return state, matched, end_time, windows_0 + windows_1
+
+    def run(self, num_trials, seed = None, chunk_size = 1000000):
+        rng = np.random.default_rng(seed)
+        chunks = []
+
+        for first in range(0, num_trials, chunk_size):
+            n = min(chunk_size, num_trials - first)
+
+            state_left, matched_left, end_left, windows_left = self._sample_link(n, rng)
+            state_right, matched_right, end_right, windows_right = self._sample_link(n, rng)
+
+            state, outcome = swap(state_left, state_right, rng)
+
+            chunks.append({
+                "purification_success": matched_left & matched_right,
+                "purification_left": matched_left,
+                "purification_right": matched_right,
+                "final_bell_index": outcome,
+                # fidelity with respect to the bell state expected by the end node
+                "fidelity": state[:, B00],
+                # BSM of 1 nsec on the repeater, then the outcome goes to the right node
+                "e2e_time": np.maximum(end_left, end_right) + 1 + self.t_link,
+                "windows": windows_left + windows_right,
+            })
+
+        return {key: np.concatenate([chunk[key] for chunk in chunks]) for key in chunks[0]}
+
+def summarize(results):
+    return {
+        "trials": int(len(results["fidelity"])),
+        "purification_success": float(np.mean(results["purification_success"])),
+        "fidelity": float(np.mean(results["fidelity"])),
+        "e2e_time": float(np.mean(results["e2e_time"])),
+        "final_bell_index": {index: int(np.sum(results["final_bell_index"] == index)) for index in range(4)},
+    }
+
+def cross_check(link_length, p_lr, p_m, t_clock, K_attempts = None, depolar_rate = 0.1, num_trials = 100000,
+                num_netsquid_trials = 200, seed = 0, workers = None, confidence = 0.95):
+    # the netsquid path is imported only here, the engine itself does not need it
+    from trials import aggregate, run_trials
+
+    engine = BellDiagonalEngine(link_length = link_length, p_lr = p_lr, p_m = p_m, t_clock = t_clock,
+                                K_attempts = K_attempts, depolar_rate = depolar_rate)
+    fast = summarize(engine.run(num_trials, seed = seed))
+
+    netsquid_summary = aggregate(run_trials(num_trials = num_netsquid_trials, link_length = link_length, p_lr = p_lr,
+                                            p_m = p_m, t_clock = t_clock, K_attempts = K_attempts,
+                                            depolar_rate = depolar_rate, seed = seed, workers = workers),
+                                 confidence = confidence)
+
+    # the fast engine should fall inside the confidence intervals of the netsquid simulation
+    checks = {}
+    for key, value_key in [("purification_success", "rate"), ("fidelity", "mean"), ("e2e_time", "mean")]:
+        low, high = netsquid_summary[key]["ci"]
+        checks[key] = {
+            "fast": fast[key],
+            "netsquid": netsquid_summary[key][value_key],
+            "ci": (low, high),
+            "consistent": low is not None and low <= fast[key] <= high,
+        }
+
+    return {"fast": fast, "netsquid": netsquid_summary, "checks": checks}
+
+def main():
+    parser = argparse.ArgumentParser(description = "Sample the repeater network with Bell-diagonal states")
+    parser.add_argument("--trials", type = int, default = 1000000)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--link-length", type = float, default = 30)
+    parser.add_argument("--p-lr", type = float, default = 0.9)
+    parser.add_argument("--p-m", type = float, default = 0.02)
+    parser.add_argument("--t-clock", type = float, default = 10)
+    parser.add_argument("--K-attempts", type = int, default = None)
+    parser.add_argument("--depolar-rate", type = float, default = 0.1)
+    parser.add_argument("--cross-check", type = int, default = 0, metavar = "N",
+                        help = "compare with N trials of the netsquid simulation")
+    parser.add_argument("--workers", type = int, default = None)
+    args = parser.parse_args()
+
+    params = {"link_length": args.link_length, "p_lr": args.p_lr, "p_m": args.p_m, "t_clock": args.t_clock,
+              "K_attempts": args.K_attempts, "depolar_rate": args.depolar_rate}
+
+    if args.cross_check > 0:
+        report = cross_check(num_trials = args.trials, num_netsquid_trials = args.cross_check, seed = args.seed,
+                             workers = args.workers, **params)
+    else:
+        report = summarize(BellDiagonalEngine(**params).run(args.trials, seed = args.seed))
+
+    print(json.dumps(report, indent = 2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+
+# formalisms the protocols can run on: the purification and the BSM only use clifford gates and pauli noise,
+# so the stabilizer formalism is valid too
+FORMALISMS = ("DM", "KET", "STAB")
+
+# metrics compared with the baseline, True if a larger value is better
+COMPARED_METRICS = {"wall_per_pair": False, "events_per_second": True, "peak_rss_mb": False}
+
+# field of the statistics of the engine with the number of events processed since the last ns.sim_reset
+EVENTS_FIELD = "events_triggered"
+
+def _peak_rss_mb():
+    # linux reports the peak in KB, macos in bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+def _events_processed(ns):
+    # the statistics of the engine are reset by ns.sim_reset
+    data = ns.sim_stats().data
+    if EVENTS_FIELD not in data:
+        raise KeyError(f"The statistics of the simulator have no {EVENTS_FIELD} field, found {sorted(data)}")
+    return data[EVENTS_FIELD]
+
+def run_case(formalism, link_length, p_m, num_hops, pairs, seed = 0, p_lr = 0.9, t_clock = 10, depolar_rate = 0.1,
+             multiplexed = False, slots_per_link = 2):
+    # imported here so that the parent process of the benchmark does not count in the memory of the case
+    import netsquid as ns
+
+    from chain import setup_chain_network
+    from main import setup_network, start_protocols
+
+    build_time = 0.
+    sim_time = 0.
+    events = 0
+    completed = 0
+    simulated_nsecs = 0.
+    for pair_seed in np.random.SeedSequence(seed).generate_state(pairs):
+        ns.sim_reset()
+        ns.set_qstate_formalism(getattr(ns.QFormalism, formalism))
+        ns.set_random_state(seed = int(pair_seed))
+
+        # the network is built from scratch for every pair, like get_network does
+        start = time.perf_counter()
+        if num_hops is None:
+            _, protocols = setup_network(link_length = link_length, p_lr = p_lr, p_m = p_m, t_clock = t_clock,
+                                         depolar_rate = depolar_rate, multiplexed = multiplexed,
+                                         slots_per_link = slots_per_link, start = False)
+        else:
+            _, protocols = setup_chain_network(num_hops = num_hops, link_length = link_length, p_lr = p_lr, p_m = p_m,
+                                               t_clock = t_clock, depolar_rate = depolar_rate, multiplexed = multiplexed,
+                                               slots_per_link = slots_per_link, start = False)
+        start_protocols(protocols)
+        built = time.perf_counter()
+        ns.sim_run()
+        build_time += built - start
+        sim_time += time.perf_counter() - built
+
+        events += _events_processed(ns)
+        simulated_nsecs += ns.sim_time()
+        if protocols["end"].final_bell_index is not None:
+            completed += 1
+
+    return {
+        "completed": completed,
+        "build_time": build_time,
+        "sim_time": sim_time,
+        "simulated_nsecs": simulated_nsecs,
+        "wall_per_pair": (build_time + sim_time) / completed if completed > 0 else None,
+        "events": events,
+        "events_per_second": events / sim_time if sim_time > 0 else None,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+def _run_case_job(case):
+    try:
+        return run_case(**case)
+    except Exception as error:
+        # a formalism may not support a part of the network, the other cases go on
+        return {"error": f"{type(error).__name__}: {error}"}
+
+def run_benchmark(formalisms, link_lengths, p_ms, hops, pairs, seed = 0, **params):
+    cases = [{"formalism": formalism, "link_length": link_length, "p_m": p_m, "num_hops": num_hops}
+             for formalism, link_length, p_m, num_hops in itertools.product(formalisms, link_lengths, p_ms, hops)]
+
+    # every case runs in a new process, so its peak memory does not include the previous ones
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for case in cases:
+        with context.Pool(processes = 1, maxtasksperchild = 1) as pool:
+            result = pool.apply(_run_case_job, ({**case, "pairs": pairs, "seed": seed, **params},))
+        results.append({**case, **result})
+
+    return {
+        "machine": {"python": platform.python_version(), "platform": platform.platform(),
+                    "processor": platform.processor()},
+        "pairs": pairs,
+        "seed": seed,
+        "params": params,
+        "cases": results,
+    }
+
+def _case_key(case):
+    return (case["formalism"], case["link_length"], case["p_m"], case["num_hops"])
+
+def _regression(case, metric, reference_value, value, change = None):
+    return {"formalism": case["formalism"], "link_length": case["link_length"], "p_m": case["p_m"],
+            "num_hops": case["num_hops"], "metric": metric, "baseline": reference_value, "value": value,
+            "change": change}
+
+def compare(results, baseline, tolerance = 0.1):
+    # the cases slower (or bigger) than the baseline by more than tolerance, as a relative change. A case of the
+    # baseline that is missing, fails or delivers fewer pairs is a regression too
+    cases = {_case_key(case): case for case in results["cases"]}
+    regressions = []
+    for reference in baseline["cases"]:
+        case = cases.get(_case_key(reference))
+        if case is None:
+            regressions.append(_regression(reference, "missing", None, None))
+            continue
+        if "error" in case:
+            if "error" not in reference:
+                regressions.append(_regression(case, "error", None, case["error"]))
+            continue
+        if "error" in reference:
+            continue
+        if case["completed"] < reference["completed"]:
+            regressions.append(_regression(case, "completed", reference["completed"], case["completed"]))
+
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            value, reference_value = case.get(metric), reference.get(metric)
+            if reference_value is None:
+                continue
+            if value is None:
+                regressions.append(_regression(case, metric, reference_value, None))
+                continue
+            if not reference_value:
+                continue
+            change = (value - reference_value) / reference_value
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(_regression(case, metric, reference_value, value, change))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description = "Measure the speed of the simulation over a matrix of parameters")
+    parser.add_argument("--formalisms", nargs = "+", choices = FORMALISMS, default = ["DM", "KET"])
+    parser.add_argument("--link-lengths", type = float, nargs = "+", default = [10, 30])
+    parser.add_argument("--p-ms", type = float, nargs = "+", default = [0.02, 0.1])
+    parser.add_argument("--hops", type = int, nargs = "+", default = [2],
+                        help = "number of hops, 2 is the network of main.py and the others are chains")
+    parser.add_argument("--pairs", type = int, default = 20, help = "e2e pairs simulated in each case")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--p-lr", type = float, default = 0.9)
+    parser.add_argument("--t-clock", type = float, default = 10)
+    parser.add_argument("--depolar-rate", type = float, default = 0.1)
+    parser.add_argument("--multiplexed", action = "store_true")
+    parser.add_argument("--slots-per-link", type = int, default = 2)
+    parser.add_argument("--output", default = "benchmark.json", help = "json file with the results")
+    parser.add_argument("--baseline", default = None, help = "json file of a previous run to compare with")
+    parser.add_argument("--tolerance", type = float, default = 0.1, help = "relative change reported as a regression")
+    args = parser.parse_args()
+
+    # the 2 hops network is the one of main.py, built by setup_network
+    hops = [None if num_hops == 2 else num_hops for num_hops in args.hops]
+    results = run_benchmark(args.formalisms, args.link_lengths, args.p_ms, hops, pairs = args.pairs, seed = args.seed,
+                            p_lr = args.p_lr, t_clock = args.t_clock, depolar_rate = args.depolar_rate,
+                            multiplexed = args.multiplexed, slots_per_link = args.slots_per_link)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent = 2)
+
+    for case in results["cases"]:
+        if "error" in case:
+            print(f"{case['formalism']} length {case['link_length']} p_m {case['p_m']} hops {case['num_hops']}: "
+                  f"{case['error']}")
+        else:
+            print(f"{case['formalism']} length {case['link_length']} p_m {case['p_m']} hops {case['num_hops']}: "
+                  f"{case['wall_per_pair']} s per pair, {case['events_per_second']} events/s, "
+                  f"build {case['build_time']:.3f} s, sim {case['sim_time']:.3f} s, {case['peak_rss_mb']:.0f} MB")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, tolerance = args.tolerance)
+        print(json.dumps(regressions, indent = 2))
+        # a non zero exit code stops the rollout
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
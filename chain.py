@@ -0,0 +1,159 @@
+import math
+
+import netsquid as ns
+
+from ent_swapping import ChainEnd, ChainSwapping
+from main import start_protocols
+from ms_protocol import get_EPS_connection
+from node import NetNode
+from purification import PurificationProtocol
+
+SWAP_ORDERS = ("nested", "parallel")
+
+# the parameters that can be different on every hop of the chain
+LINK_PARAMS = ("link_length", "p_lr", "p_m", "t_clock")
+
+def _swap_tree(first, last, swaps_to_wait):
+    # the repeater in the middle of the segment connects the two halves, after their own swaps are done
+    if last - first < 2:
+        return None
+    middle = (first + last) // 2
+    children = [_swap_tree(first, middle, swaps_to_wait), _swap_tree(middle, last, swaps_to_wait)]
+    swaps_to_wait[middle] = [child for child in children if child is not None]
+    return middle
+
+def get_swap_dependencies(num_hops, swap_order = "nested"):
+    # for each repeater, the repeaters that must swap before it
+    if swap_order not in SWAP_ORDERS:
+        raise ValueError(f"Unknown swap order {swap_order}, it must be one of {SWAP_ORDERS}")
+
+    swaps_to_wait = {repeater: [] for repeater in range(1, num_hops)}
+    if swap_order == "nested":
+        _swap_tree(0, num_hops, swaps_to_wait)
+    return swaps_to_wait
+
+def _get_hop_params(num_hops, link_length, p_lr, p_m, t_clock, link_params):
+    # every hop has the parameters of the chain, unless link_params gives its own ones
+    defaults = {"link_length": link_length, "p_lr": p_lr, "p_m": p_m, "t_clock": t_clock}
+    if link_params is None:
+        return [defaults] * num_hops
+    if len(link_params) != num_hops:
+        raise ValueError(f"The chain has {num_hops} hops but link_params describes {len(link_params)} of them")
+    return [{**defaults, **params} for params in link_params]
+
+def _get_node_name(index, num_hops):
+    if index == 0:
+        return "L_node"
+    if index == num_hops:
+        return "R_node"
+    return f"Repeater_{index}"
+
+def setup_chain_network(num_hops, link_length, p_lr, p_m, t_clock, swap_order = "nested", sparse_source = False,
+                        K_attempts = None, depolar_rate = 0.1, multiplexed = False, slots_per_link = 2, link_params = None,
+                        node_names = None, memory_depolar_rate = 0., cutoff = None, start = True):
+    if num_hops < 1:
+        raise ValueError("The chain must have at least one hop")
+    # the purified pairs that wait for the nested swaps are never discarded, the trade-off would leave out the
+    # longest waits
+    if cutoff is not None:
+        raise ValueError("The cutoff is only supported by the network with one repeater, not by the chains")
+
+    net = ns.nodes.Network(f"Quantum Repeater Chain ({num_hops} hops)")
+
+    if node_names is None:
+        node_names = [_get_node_name(index, num_hops) for index in range(num_hops + 1)]
+    nodes = [NetNode(ID = index + 1, name = node_names[index], slots_per_link = slots_per_link,
+                     memory_depolar_rate = memory_depolar_rate)
+             for index in range(num_hops + 1)]
+    net.add_nodes(nodes)
+
+    hop_params = _get_hop_params(num_hops, link_length, p_lr, p_m, t_clock, link_params)
+
+    # the left link of a node is on nic 0, the right one on nic 1. The end nodes only have one link on nic 0
+    purif_left = []
+    purif_right = []
+
+    for hop in range(num_hops):
+        left_node = nodes[hop]
+        right_node = nodes[hop + 1]
+        left_nic = 0 if hop == 0 else 1
+
+        hop_length, hop_p_lr, hop_p_m, hop_t_clock = (hop_params[hop][key] for key in LINK_PARAMS)
+        hop_K_attempts = K_attempts if K_attempts is not None else math.ceil((1/hop_p_m*hop_p_lr))
+
+        # create the classical connection
+        channel_to_right = ns.components.ClassicalChannel(f"channel_{hop}_to_{hop + 1}", length = hop_length,
+                                                          models = {"delay_model": ns.components.models.FibreDelayModel()})
+        channel_to_left = ns.components.ClassicalChannel(f"channel_{hop + 1}_to_{hop}", length = hop_length,
+                                                         models = {"delay_model": ns.components.models.FibreDelayModel()})
+        classical_conn = ns.nodes.DirectConnection(f"classical_conn_{hop}", channel_to_right, channel_to_left)
+        net.add_connection(node1 = left_node, node2 = right_node, connection = classical_conn,
+                           port_name_node1 = f"c{left_nic}", port_name_node2 = "c0", label = f"classical_conn_{hop}")
+
+        # create the EPS connection, it is controlled by the left node of the hop
+        eps_conn = get_EPS_connection(t_clock = hop_t_clock, p_m = hop_p_m, p_lr = hop_p_lr, length = hop_length,
+                                      sparse = sparse_source, depolar_rate = depolar_rate)
+        net.add_connection(node1 = left_node, node2 = right_node, connection = eps_conn,
+                           port_name_node1 = f"q{left_nic}", port_name_node2 = "q0", label = f"eps_conn_{hop}")
+
+        purif_right.append(PurificationProtocol(node = left_node, name = f"PP_{hop}_right", K_attempts = hop_K_attempts,
+                                                t_clock = hop_t_clock, link_length = hop_length, connection = eps_conn,
+                                                nic_index = left_nic, multiplexed = multiplexed))
+        purif_left.append(PurificationProtocol(node = right_node, name = f"PP_{hop + 1}_left", K_attempts = hop_K_attempts,
+                                               t_clock = hop_t_clock, link_length = hop_length, connection = None,
+                                               nic_index = 0, multiplexed = multiplexed))
+
+    # every repeater sends its pauli correction directly to the right end node, on a channel as long as
+    # the rest of the chain so the delay is the same as forwarding it hop by hop
+    r_end_node = nodes[-1]
+    corrections_ports = []
+    swappings = {}
+
+    for index in range(1, num_hops):
+        repeater = nodes[index]
+        port_in = f"corr_in_{index}"
+        repeater.add_ports(["corr_out"])
+        r_end_node.add_ports([port_in])
+        corrections_ports.append(port_in)
+
+        remaining_length = sum(params["link_length"] for params in hop_params[index:])
+        channel = ns.components.ClassicalChannel(f"corrections_channel_{index}", length = remaining_length,
+                                                 models = {"delay_model": ns.components.models.FibreDelayModel()})
+        corrections_conn = ns.nodes.DirectConnection(f"corrections_conn_{index}", channel_AtoB = channel)
+        net.add_connection(node1 = repeater, node2 = r_end_node, connection = corrections_conn,
+                           port_name_node1 = "corr_out", port_name_node2 = port_in, label = f"corrections_conn_{index}")
+
+        swappings[index] = ChainSwapping(node = repeater, purif_to_wait = [purif_left[index - 1], purif_right[index]],
+                                         name = f"ent_swapping_{index}", corrections_port = "corr_out")
+
+    for index, to_wait in get_swap_dependencies(num_hops, swap_order).items():
+        swappings[index].set_swaps_to_wait([swappings[child] for child in to_wait])
+
+    chain_end = ChainEnd(node = r_end_node, purif_to_wait = [purif_left[-1]], corrections_ports = corrections_ports,
+                         name = "ent_swapping_r_node")
+    chain_end.set_end_purifications([purif_right[0], purif_left[-1]])
+
+    protocols = {
+        "standalone": [purif_right[0]],
+        "schedulers": [node.program_scheduler for node in nodes],
+        "purification": purif_right + purif_left,
+        "swapping": list(swappings.values()) + [chain_end],
+        "end": chain_end,
+        # the purifications that hold the qubits of the e2e pair
+        "end_purifications": [purif_right[0], purif_left[-1]],
+    }
+
+    if start:
+        start_protocols(protocols)
+
+    return net, protocols
+
+def get_chain_network(num_hops, link_length, p_lr, p_m, t_clock, swap_order = "nested", sparse_source = False,
+                      K_attempts = None, depolar_rate = 0.1, multiplexed = False, slots_per_link = 2,
+                      memory_depolar_rate = 0., cutoff = None):
+    net, _ = setup_chain_network(num_hops = num_hops, link_length = link_length, p_lr = p_lr, p_m = p_m,
+                                 t_clock = t_clock, swap_order = swap_order, sparse_source = sparse_source,
+                                 K_attempts = K_attempts, depolar_rate = depolar_rate, multiplexed = multiplexed,
+                                 slots_per_link = slots_per_link, memory_depolar_rate = memory_depolar_rate,
+                                 cutoff = cutoff)
+    return net
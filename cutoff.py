@@ -0,0 +1,60 @@
+import argparse
+import json
+
+from instrumentation import METRICS
+from trials import aggregate, run_trials
+
+def cutoff_tradeoff(cutoffs, num_trials, link_length, p_lr, p_m, t_clock, memory_depolar_rate, seed = 0,
+                    workers = None, confidence = 0.95, **params):
+    # every cutoff runs the same trials, None is the baseline that keeps every pair however old it is
+    rows = []
+    for cutoff in cutoffs:
+        # the workers send their metrics back, so the counters only hold the discards of this cutoff
+        METRICS.reset()
+        results = run_trials(num_trials = num_trials, link_length = link_length, p_lr = p_lr, p_m = p_m,
+                             t_clock = t_clock, seed = seed, workers = workers,
+                             memory_depolar_rate = memory_depolar_rate, cutoff = cutoff, **params)
+        summary = aggregate(results, confidence = confidence)
+
+        completed = [result for result in results if result.final_bell_index is not None]
+        total_time = sum(result.e2e_time for result in completed)
+        rows.append({
+            "cutoff": cutoff,
+            # pairs per second if the trials run one after the other, the times are in nsecs
+            "rate": len(completed) / total_time * 1e9 if total_time > 0 else None,
+            "fidelity": summary["fidelity"],
+            "e2e_time": summary["e2e_time"],
+            "purification_success": summary["purification_success"],
+            "discards": METRICS.counters.get("cutoff_discards", 0) if METRICS.enabled else None,
+        })
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description = "Compare the rate and the fidelity of the e2e pairs for several cutoffs")
+    parser.add_argument("--cutoffs", type = float, nargs = "+", required = True, help = "cutoffs in nsecs")
+    parser.add_argument("--no-baseline", action = "store_true", help = "do not run the trials without cutoff")
+    parser.add_argument("--memory-depolar-rate", type = float, default = 1e3, help = "depolarizing rate of the memories in Hz")
+    parser.add_argument("--trials", type = int, default = 100)
+    parser.add_argument("--workers", type = int, default = None)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--link-length", type = float, default = 30)
+    parser.add_argument("--p-lr", type = float, default = 0.9)
+    parser.add_argument("--p-m", type = float, default = 0.02)
+    parser.add_argument("--t-clock", type = float, default = 10)
+    parser.add_argument("--depolar-rate", type = float, default = 0.1)
+    parser.add_argument("--multiplexed", action = "store_true")
+    parser.add_argument("--slots-per-link", type = int, default = 2)
+    parser.add_argument("--confidence", type = float, default = 0.95)
+    args = parser.parse_args()
+
+    cutoffs = ([] if args.no_baseline else [None]) + args.cutoffs
+    rows = cutoff_tradeoff(cutoffs, num_trials = args.trials, link_length = args.link_length, p_lr = args.p_lr,
+                           p_m = args.p_m, t_clock = args.t_clock, memory_depolar_rate = args.memory_depolar_rate,
+                           seed = args.seed, workers = args.workers, confidence = args.confidence,
+                           depolar_rate = args.depolar_rate, multiplexed = args.multiplexed,
+                           slots_per_link = args.slots_per_link)
+
+    print(json.dumps(rows, indent = 2))
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,32 @@
 import netsquid as ns
 
+from instrumentation import METRICS, instrumented
+from links import check_cutoff
+from probes import E2E_PAIR, PROBES
 from purification import PurificationProtocol
+from scheduler import PRIORITY_BSM
+from tracing import INFO, SWAP_BSM_SENT, SWAP_FINAL_STATE, SWAP_START, SWAP_WAITING, TRACER
+
+# bell states indexed by the outcome of the BSM
+BELL_STATES = [ns.qubits.ketstates.b00, ns.qubits.ketstates.b01, ns.qubits.ketstates.b10, ns.qubits.ketstates.b11]
+
+def _e2e_qubits(end):
+    # cheating: we read the e2e pair without measuring it, only to evaluate the simulation
+    return [protocol.node.qmemory.peek(positions=[protocol.result_position])[0] for protocol in end.end_purifications]
+
+def _probe_e2e(end):
+    # fidelity of the e2e pair with respect to the bell state announced by the swaps, None if nobody sampled it
+    if not PROBES.active(E2E_PAIR) or not end.end_purifications:
+        return None
+    return PROBES.read(E2E_PAIR, _e2e_qubits(end), end.final_state, node=end.node.name, protocol=end.name)
+
+def e2e_fidelity(end):
+    # fidelity of the pair delivered to the end node, computed at most once: the probes may have already read it
+    if end.final_state is None:
+        return None
+    if end.final_fidelity is None:
+        end.final_fidelity = PROBES.fidelity(_e2e_qubits(end), end.final_state)
+    return end.final_fidelity
 
 class EntSwapping(ns.protocols.NodeProtocol):
     READY_TO_SWAPPING_SIGNAL = "swapping ready to start signal"
@@ -14,46 +40,162 @@ class EntSwapping(ns.protocols.NodeProtocol):
         
         return program
     
-    def __init__(self, node, purif_to_wait, name=None, is_left=True):
+    def __init__(self, node, purif_to_wait, name=None, is_left=True, continuous=False, outcome_port=None,
+                 release_port=None, cutoff=None):
         super().__init__(node=node, name=name)
         self.is_left = is_left
         self.purif_to_wait = purif_to_wait
+        # port used to send (left node) or receive (right node) the outcome of the BSM
+        if outcome_port is None:
+            outcome_port = 'c1' if is_left else 'c0'
+        self.outcome_port = outcome_port
+        # in continuous mode the swapping is repeated on every new pair of the purifications
+        self.continuous = continuous
+        # the right node tells the left end node on this port that the e2e pair has been consumed
+        if continuous and not is_left and release_port is None:
+            raise ValueError("In continuous mode the right node needs a port to release the pair of the left end node")
+        self.release_port = release_port
+        # the left node regenerates a purified pair that waited longer than the cutoff for the other link, the right
+        # node regenerates its pair when the left one asks
+        self.cutoff = cutoff
+        if is_left:
+            # a pair that waits for the other link is replaced by a new round of its link
+            check_cutoff(cutoff, max(to_wait.min_round_time for to_wait in purif_to_wait))
+        # purifications that hold the e2e pair, read by the consumer and the probes
+        self.end_purifications = []
+        # called by the right node with this protocol as argument every time a pair is delivered
+        self.consumer = None
 
         self.add_signal(self.READY_TO_SWAPPING_SIGNAL, self.READY_TO_SWAPPING_SIGNAL_EVT_TYPE)
         
         for to_wait in self.purif_to_wait: 
             self.add_subprotocol(to_wait)
 
+        self._bsm_program = self._get_bsm_program()
+
+        # number of rounds in which this node has been ready to swap
+        self.ready_count = 0
+        # results available on the right node once the swapping is terminated
+        self.final_bell_index = None
+        self.final_state = None
+        self.final_fidelity = None
+        self.end_time = None
+
     def set_swap_to_wait(self, swap_to_wait):
         self.swap_to_wait = swap_to_wait
 
+    def set_end_purifications(self, end_purifications):
+        self.end_purifications = end_purifications
+
+    @instrumented
     def run(self): 
-        # I wait for the entanglement eventually purified
+        self.ready_count = 0
+        self.final_bell_index = None
+        self.final_state = None
+        self.final_fidelity = None
+        self.end_time = None
+
+        while True:
+            yield from self._swap_round()
+            if not self.continuous:
+                return
+
+    def _regenerate(self, to_wait):
+        # the end node of the link discards its side of the pair too, then both generate a new one
+        to_wait.node_cport.tx_output(ns.components.Message(items=["REGENERATE"]))
+        to_wait.regenerate()
+        if METRICS.enabled:
+            METRICS.count("cutoff_discards")
+
+    def _wait_purifications(self):
         for to_wait in self.purif_to_wait:
-            print(f"[{ns.sim_time()}] Node {self.node.name}: waiting for purification protocol {to_wait.name} to terminate")
-            yield self.await_signal(sender=to_wait, signal_label = PurificationProtocol.PURIFICATION_SIGNAL)
-        
-        self.send_signal(self.READY_TO_SWAPPING_SIGNAL)
-        yield self.await_signal(sender=self.swap_to_wait, signal_label = self.READY_TO_SWAPPING_SIGNAL)
+            if TRACER.level <= INFO:
+                TRACER.record(ns.sim_time(), INFO, SWAP_WAITING, self.node.name, self.name, peer = to_wait.name)
+
+        while True:
+            # the signal is already gone if the protocol terminated before the ones we waited first
+            pending = [to_wait for to_wait in self.purif_to_wait if to_wait.success is None]
+            if not pending:
+                return
+            expression = None
+            for to_wait in pending:
+                signal = self.await_signal(sender=to_wait, signal_label = PurificationProtocol.PURIFICATION_SIGNAL)
+                expression = signal if expression is None else expression | signal
+
+            if self.cutoff is not None and self.is_left:
+                # the pair that is waiting for the other link decoheres, it is replaced when it gets too old
+                ready = [to_wait for to_wait in self.purif_to_wait if to_wait.success is not None]
+                if ready:
+                    oldest = min(ready, key=lambda to_wait: to_wait.done_time)
+                    expires = oldest.done_time + self.cutoff
+                    if expires <= ns.sim_time():
+                        self._regenerate(oldest)
+                        continue
+                    expression = expression | self.await_timer(duration = expires - ns.sim_time())
+            yield expression
+
+    def _wait_other_node(self):
+        # False if the left node discarded the pair of our link before it was ready
+        # the other node may have signaled before we started waiting, in that case the signal is already gone
+        while self.swap_to_wait.ready_count < self.ready_count:
+            expression = self.await_signal(sender=self.swap_to_wait, signal_label = self.READY_TO_SWAPPING_SIGNAL)
+            if self.cutoff is not None and not self.is_left:
+                for to_wait in self.purif_to_wait:
+                    # the message may have been already read by the purification, it is kept in the mailbox
+                    if self.node.take(to_wait.node_cport.name, ("REGENERATE",)) is not None:
+                        to_wait.regenerate()
+                        return False
+                    expression = expression | self.await_port_input(to_wait.node_cport)
+            yield expression
+        return True
 
-        print(f"[{ns.sim_time()}] Node {self.node.name}: starting the swapping")
+    def _swap_round(self):
+        run_start = ns.sim_time()
+
+        while True:
+            # I wait for the entanglement eventually purified
+            yield from self._wait_purifications()
+
+            self.ready_count += 1
+            ready_time = ns.sim_time()
+            self.send_signal(self.READY_TO_SWAPPING_SIGNAL)
+            if (yield from self._wait_other_node()):
+                break
+            self.ready_count -= 1
+        if METRICS.enabled:
+            METRICS.observe("swap_purification_wait", ready_time - run_start)
+            METRICS.observe("swap_ready_handshake", ns.sim_time() - ready_time)
+
+        if TRACER.level <= INFO:
+            TRACER.record(ns.sim_time(), INFO, SWAP_START, self.node.name, self.name)
 
         if self.is_left:
-            # i'm the left node, so I execute the BSM on qubit 0 (1 is measured during purification) and 2
-            prog = self._get_bsm_program()
-            self.node.qmemory.execute_program(prog, qubit_mapping=[0, 2], error_on_fail=True)
-            yield self.await_program(self.node.qmemory)
+            # i'm the left node, so I execute the BSM on the qubits left by the purifications of the two links
+            # (0 and 2 without multiplexing, 1 and 3 are measured during purification)
+            prog = self._bsm_program
+            qubit_mapping = [to_wait.result_position for to_wait in self.purif_to_wait]
+            ticket = self.node.program_scheduler.submit(prog, qubit_mapping=qubit_mapping, priority=PRIORITY_BSM, requester=self.name)
+            if not ticket.is_done:
+                yield ticket.await_done()
+            if METRICS.enabled:
+                METRICS.observe("swap_bsm", ticket.end_time - ticket.submit_time)
             
             # the ouptut of the measurement is sent to the right node
             outcome = prog.output["M"]
-            print(f"[{ns.sim_time()}] Node {self.node.name}: sending in output the BSM {outcome[0]}")
-            self.node.ports['c1'].tx_output(ns.components.Message(items=outcome))
+            if TRACER.level <= INFO:
+                TRACER.record(ns.sim_time(), INFO, SWAP_BSM_SENT, self.node.name, self.name, outcome = outcome[0])
+            self.node.ports[self.outcome_port].tx_output(ns.components.Message(items=["BSM", outcome[0]]))
+
+            # the measured qubits are not needed anymore, the links can generate the next pairs
+            if self.continuous:
+                for to_wait in self.purif_to_wait:
+                    to_wait.release()
 
         else:
             # wait to receive the ouput of the bsm from the left node
-            yield self.await_port_input(self.node.ports['c0'])
-            msg = self.node.ports['c0'].rx_input()
-            measurement = msg.items[0]
+            outcome_wait_start = ns.sim_time()
+            msg = yield from self.node.receive(self, self.outcome_port, ("BSM",))
+            measurement = msg.items[1]
 
             if (measurement == 0):
                 final_state = ns.qubits.ketstates.b00
@@ -64,14 +206,144 @@ class EntSwapping(ns.protocols.NodeProtocol):
             else:
                 final_state = ns.qubits.ketstates.b11
 
-            print(f"[{ns.sim_time()}] Node {self.node.name}: I'm entangled with the left end-node with state {final_state}")
+            self.final_bell_index = measurement
+            self.final_state = final_state
+            self.end_time = ns.sim_time()
+            self.final_fidelity = _probe_e2e(self)
 
+            if METRICS.enabled:
+                METRICS.observe("swap_outcome_wait", ns.sim_time() - outcome_wait_start)
+                METRICS.observe("e2e", self.end_time - run_start)
+                METRICS.count("e2e_pairs")
 
+            if TRACER.level <= INFO:
+                TRACER.record(ns.sim_time(), INFO, SWAP_FINAL_STATE, self.node.name, self.name, outcome = measurement)
 
+            if self.consumer is not None:
+                self.consumer(self)
 
-        
+            # the pair has been consumed, its memory slots can be used by the next round. The left end node
+            # frees its slots only when the message arrives
+            if self.continuous:
+                for to_wait in self.purif_to_wait:
+                    to_wait.release()
+                self.node.ports[self.release_port].tx_output(ns.components.Message(items=["RELEASE"]))
 
+class ChainSwapping(ns.protocols.NodeProtocol):
+    SWAP_DONE_SIGNAL = "swap done signal"
+    SWAP_DONE_SIGNAL_EVT_TYPE = ns.pydynaa.EventType("swap done signal", "The entanglement swapping on the repeater is done")
 
-        
+    def __init__(self, node, purif_to_wait, name=None, corrections_port="corr_out"):
+        super().__init__(node=node, name=name)
+        self.purif_to_wait = purif_to_wait
+        self.corrections_port = corrections_port
+        # swaps of the inner segments that must be done before this one, empty when all the swaps run in parallel
+        self.swaps_to_wait = []
+
+        self.add_signal(self.SWAP_DONE_SIGNAL, self.SWAP_DONE_SIGNAL_EVT_TYPE)
+
+        for to_wait in self.purif_to_wait:
+            self.add_subprotocol(to_wait)
+
+        self._bsm_program = EntSwapping._get_bsm_program()
+
+        self.is_done = False
+
+    def set_swaps_to_wait(self, swaps_to_wait):
+        self.swaps_to_wait = swaps_to_wait
+
+    @instrumented
+    def run(self):
+        self.is_done = False
+        run_start = ns.sim_time()
+
+        # I wait for the entanglement on both the links of the repeater
+        for to_wait in self.purif_to_wait:
+            if to_wait.success is None:
+                yield self.await_signal(sender=to_wait, signal_label = PurificationProtocol.PURIFICATION_SIGNAL)
+        purified_time = ns.sim_time()
+
+        # in the nested order the inner segments must be already connected
+        for to_wait in self.swaps_to_wait:
+            if not to_wait.is_done:
+                yield self.await_signal(sender=to_wait, signal_label = self.SWAP_DONE_SIGNAL)
+
+        if METRICS.enabled:
+            METRICS.observe("swap_purification_wait", purified_time - run_start)
+            METRICS.observe("swap_inner_wait", ns.sim_time() - purified_time)
+
+        if TRACER.level <= INFO:
+            TRACER.record(ns.sim_time(), INFO, SWAP_START, self.node.name, self.name)
+
+        # the purified qubits of the left and the right link
+        prog = self._bsm_program
+        qubit_mapping = [to_wait.result_position for to_wait in self.purif_to_wait]
+        ticket = self.node.program_scheduler.submit(prog, qubit_mapping=qubit_mapping, priority=PRIORITY_BSM, requester=self.name)
+        if not ticket.is_done:
+            yield ticket.await_done()
+        if METRICS.enabled:
+            METRICS.observe("swap_bsm", ticket.end_time - ticket.submit_time)
+
+        # the pauli correction is forwarded to the right end node
+        outcome = prog.output["M"][0]
+        if TRACER.level <= INFO:
+            TRACER.record(ns.sim_time(), INFO, SWAP_BSM_SENT, self.node.name, self.name, outcome = outcome)
+        self.node.ports[self.corrections_port].tx_output(ns.components.Message(items=[outcome]))
+
+        self.is_done = True
+        self.send_signal(self.SWAP_DONE_SIGNAL)
+
+class ChainEnd(ns.protocols.NodeProtocol):
+    def __init__(self, node, purif_to_wait, corrections_ports, name=None):
+        super().__init__(node=node, name=name)
+        self.purif_to_wait = purif_to_wait
+        self.corrections_ports = corrections_ports
+
+        # purifications that hold the e2e pair, read by the probes
+        self.end_purifications = []
+
+        for to_wait in self.purif_to_wait:
+            self.add_subprotocol(to_wait)
+
+        self.final_bell_index = None
+        self.final_state = None
+        self.final_fidelity = None
+        self.end_time = None
+
+    def set_end_purifications(self, end_purifications):
+        self.end_purifications = end_purifications
+
+    @instrumented
+    def run(self):
+        self.final_bell_index = None
+        self.final_state = None
+        self.final_fidelity = None
+        self.end_time = None
+        run_start = ns.sim_time()
+
+        for to_wait in self.purif_to_wait:
+            if to_wait.success is None:
+                yield self.await_signal(sender=to_wait, signal_label = PurificationProtocol.PURIFICATION_SIGNAL)
+
+        # the pauli corrections of all the swaps add up, the bell index is the xor of the outcomes
+        bell_index = 0
+        for port_name in self.corrections_ports:
+            port = self.node.ports[port_name]
+            # the correction may be already arrived while we were waiting for the purification
+            msg = port.rx_input()
+            if msg is None:
+                yield self.await_port_input(port)
+                msg = port.rx_input()
+            bell_index ^= msg.items[0]
+
+        self.final_bell_index = bell_index
+        self.final_state = BELL_STATES[bell_index]
+        self.end_time = ns.sim_time()
+        self.final_fidelity = _probe_e2e(self)
+
+        if METRICS.enabled:
+            METRICS.observe("e2e", self.end_time - run_start)
+            METRICS.count("e2e_pairs")
 
-    
\ No newline at end of file
+        if TRACER.level <= INFO:
+            TRACER.record(ns.sim_time(), INFO, SWAP_FINAL_STATE, self.node.name, self.name, outcome = bell_index)
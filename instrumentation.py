@@ -0,0 +1,200 @@
+import functools
+import json
+import math
+import time
+
+import numpy as np
+
+# the latencies are in nsecs of simulated time, the histograms have 10 logarithmic bins per decade from 1 nsec to
+# 10^12 nsecs, plus one bin for the smaller values and one for the bigger ones
+BINS_PER_DECADE = 10
+NUM_DECADES = 12
+NUM_BINS = BINS_PER_DECADE * NUM_DECADES + 2
+
+# upper edge of each bin, the last one is open
+BIN_EDGES = np.append(10 ** (np.arange(NUM_BINS - 1) / BINS_PER_DECADE), np.inf)
+
+def _bin_index(value):
+    if value < 1:
+        return 0
+    return min(NUM_BINS - 1, 1 + int(math.log10(value) * BINS_PER_DECADE))
+
+class Histogram:
+    """
+    This class accumulates the values of a latency in fixed logarithmic bins, so it can be merged across processes
+    """
+
+    def __init__(self):
+        self.counts = np.zeros(NUM_BINS, dtype = np.int64)
+        self.count = 0
+        self.total = 0.
+        self.min = math.inf
+        self.max = -math.inf
+
+    def observe(self, value):
+        self.counts[_bin_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        # upper edge of the bin that contains the quantile, clipped to the observed values
+        if self.count == 0:
+            return None
+        index = int(np.searchsorted(np.cumsum(self.counts), q * self.count))
+        return float(min(max(BIN_EDGES[index], self.min), self.max))
+
+    def summary(self):
+        if self.count == 0:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": self.total / self.count,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+    def to_dict(self):
+        return {"counts": self.counts.tolist(), "count": self.count, "total": self.total, "min": self.min,
+                "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        histogram.counts = np.array(data["counts"], dtype = np.int64)
+        histogram.count = data["count"]
+        histogram.total = data["total"]
+        histogram.min = data["min"]
+        histogram.max = data["max"]
+        return histogram
+
+class Metrics:
+    """
+    This class collects the latencies of the phases of the protocols, their counters and the wall time of their runs
+    """
+
+    def __init__(self, enabled = True):
+        # the protocols check this flag before measuring, like the level of the tracer
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.latencies = {}
+        self.counters = {}
+        # protocol class -> [wall time in secs, number of resumes of the run generator]
+        self.wall_times = {}
+
+    def observe(self, phase, value):
+        histogram = self.latencies.get(phase)
+        if histogram is None:
+            histogram = self.latencies[phase] = Histogram()
+        histogram.observe(value)
+
+    def count(self, name, value = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_wall_time(self, protocol, seconds):
+        entry = self.wall_times.get(protocol)
+        if entry is None:
+            entry = self.wall_times[protocol] = [0., 0]
+        entry[0] += seconds
+        entry[1] += 1
+
+    def snapshot(self):
+        # plain python values, so the snapshot can be sent back by the worker processes and saved as json
+        return {
+            "latencies": {phase: histogram.to_dict() for phase, histogram in self.latencies.items()},
+            "counters": dict(self.counters),
+            "wall_times": {protocol: list(entry) for protocol, entry in self.wall_times.items()},
+        }
+
+    def merge(self, snapshot):
+        for phase, data in snapshot["latencies"].items():
+            other = Histogram.from_dict(data)
+            if phase in self.latencies:
+                self.latencies[phase].merge(other)
+            else:
+                self.latencies[phase] = other
+        for name, value in snapshot["counters"].items():
+            self.count(name, value)
+        for protocol, (seconds, resumes) in snapshot["wall_times"].items():
+            entry = self.wall_times.setdefault(protocol, [0., 0])
+            entry[0] += seconds
+            entry[1] += resumes
+
+    def summary(self):
+        counters = dict(self.counters)
+        rounds = counters.get("purification_rounds", 0)
+        windows = counters.get("ms_windows", 0)
+        return {
+            "latencies": {phase: histogram.summary() for phase, histogram in sorted(self.latencies.items())},
+            "counters": counters,
+            "purification_match_rate": counters.get("purification_matches", 0) / rounds if rounds > 0 else None,
+            "ms_window_success_rate": counters.get("ms_successes", 0) / windows if windows > 0 else None,
+            "wall_times": {protocol: {"seconds": seconds, "resumes": resumes}
+                           for protocol, (seconds, resumes) in sorted(self.wall_times.items())},
+        }
+
+    def export(self, path):
+        # the summary for the humans, the snapshot to merge the results of several batches later
+        with open(path, "w") as f:
+            json.dump({"summary": self.summary(), "snapshot": self.snapshot()}, f, indent = 2)
+
+def load(path):
+    metrics = Metrics()
+    with open(path) as f:
+        metrics.merge(json.load(f)["snapshot"])
+    return metrics
+
+# metrics shared by all the protocols, they are cheap enough to be always enabled
+METRICS = Metrics()
+
+def instrumented(run):
+    """
+    Decorator of the run method of a protocol, it measures the wall time spent inside the generator
+    """
+
+    @functools.wraps(run)
+    def wrapper(self):
+        generator = run(self)
+        if not METRICS.enabled:
+            return (yield from generator)
+
+        protocol = type(self).__name__
+        value = None
+        error = None
+        while True:
+            # only the time between a resume and the next yield is spent in the protocol, the rest is the simulator
+            start = time.perf_counter()
+            try:
+                expression = generator.send(value) if error is None else generator.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                METRICS.add_wall_time(protocol, time.perf_counter() - start)
+
+            # the stop of the protocol closes this generator, the inner run must be closed too to run its cleanup
+            try:
+                value = yield expression
+                error = None
+            except GeneratorExit:
+                generator.close()
+                raise
+            except BaseException as thrown:
+                value = None
+                error = thrown
+
+    return wrapper
@@ -0,0 +1,32 @@
+# speed of light in the fibre, in km per second
+FIBRE_SPEED = 200000
+
+# the EPS emits this number of pulses in each clock cycle of the nodes
+PULSES_PER_CLOCK = 10
+
+def eps_frequency(t_clock):
+    # t_clock is in nsecs, the frequency of the EPS in Hz
+    return PULSES_PER_CLOCK * 1e9 / t_clock
+
+def eps_period(t_clock):
+    # nsecs between two pulses of the EPS
+    return 1e9 / eps_frequency(t_clock)
+
+def herald_probabilities(p_m, p_lr):
+    # the sparse source folds the losses of the dense one into the pulses it emits. A pulse holds a pair with
+    # probability p_m and every photon survives its half of the link with probability p_lr, so a pulse brings at
+    # least one photon with p_herald, and both of them, given that one arrives, with p_lr^2 / (1 - (1 - p_lr)^2)
+    p_herald = p_m * (1 - (1 - p_lr) ** 2)
+    p_both = p_lr / (2 - p_lr)
+    return p_herald, p_both
+
+def min_generation_time(length, K_attempts, t_clock):
+    # nsecs to generate a pair at the earliest: a window of attempts, then the START and the END messages cross
+    # the link. The length is in km
+    return 2 * length / FIBRE_SPEED * 1e9 + K_attempts * t_clock
+
+def check_cutoff(cutoff, min_time):
+    # a pair regenerated in less than min_time is already older than a shorter cutoff, so the pairs would be
+    # discarded one after the other forever
+    if cutoff is not None and cutoff <= min_time:
+        raise ValueError(f"The cutoff of {cutoff} nsecs is shorter than the {min_time} nsecs needed to replace a pair")
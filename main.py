@@ -4,15 +4,40 @@ from ms_protocol import get_EPS_connection
 import netsquid as ns
 from purification import PurificationProtocol
 from node import NetNode
+from tracing import DEBUG, TRACER
 
-def get_network(link_length, p_lr, p_m, t_clock):
+def start_protocols(protocols):
+    # the schedulers must be running before the protocols submit their programs
+    for scheduler in protocols["schedulers"]:
+        scheduler.start()
+    for protocol in protocols["standalone"]:
+        protocol.start()
+    for swapping in protocols["swapping"]:
+        swapping.start_subprotocols()
+    for swapping in protocols["swapping"]:
+        swapping.start()
+
+def stop_protocols(protocols):
+    for protocol in protocols["swapping"] + protocols["purification"]:
+        protocol.stop()
+        for subprotocol in protocol.subprotocols.values():
+            subprotocol.stop()
+    for scheduler in protocols["schedulers"]:
+        scheduler.stop()
+
+def setup_network(link_length, p_lr, p_m, t_clock, sparse_source = False, K_attempts = None, depolar_rate = 0.1,
+                  multiplexed = False, slots_per_link = 2, continuous = False, memory_depolar_rate = 0., cutoff = None,
+                  start = True):
     # create the network
     net = ns.nodes.Network("Quantum Repeater Network")
     
     # create the repeaters
-    l_end_node = NetNode(ID = 1, name = "L_node")
-    repeater = NetNode(ID = 2, name = "Repeater")
-    r_end_node = NetNode(ID = 3, name = "R_node")
+    l_end_node = NetNode(ID = 1, name = "L_node", slots_per_link = slots_per_link,
+                         memory_depolar_rate = memory_depolar_rate)
+    repeater = NetNode(ID = 2, name = "Repeater", slots_per_link = slots_per_link,
+                       memory_depolar_rate = memory_depolar_rate)
+    r_end_node = NetNode(ID = 3, name = "R_node", slots_per_link = slots_per_link,
+                         memory_depolar_rate = memory_depolar_rate)
 
     # add the repeaters and connections to the network
     net.add_node(l_end_node)
@@ -41,51 +66,94 @@ def get_network(link_length, p_lr, p_m, t_clock):
                        port_name_node1 = "c1", port_name_node2 = "c0", label = "classical_conn_r_repeater")
     
     # create the EPS connection
-    eps_conn_l_repeater = get_EPS_connection(t_clock = t_clock, p_m = p_m, p_lr = p_lr, length = link_length)
+    eps_conn_l_repeater = get_EPS_connection(t_clock = t_clock, p_m = p_m, p_lr = p_lr, length = link_length,
+                                             sparse = sparse_source, depolar_rate = depolar_rate)
     net.add_connection(node1 = l_end_node, node2 = repeater, connection = eps_conn_l_repeater,
                        port_name_node1 = "q0", port_name_node2 = "q0", label = "eps_conn_l_repeater")
     
-    eps_conn_r_repeater = get_EPS_connection(t_clock = t_clock, p_m = p_m, p_lr = p_lr, length = link_length)
+    eps_conn_r_repeater = get_EPS_connection(t_clock = t_clock, p_m = p_m, p_lr = p_lr, length = link_length,
+                                             sparse = sparse_source, depolar_rate = depolar_rate)
     net.add_connection(node1 = repeater, node2 = r_end_node, connection = eps_conn_r_repeater,
                        port_name_node1 = "q1", port_name_node2 = "q0", label = "eps_conn_r_repeater")
     
-    K_attempts = math.ceil((1/p_m*p_lr))
+    if K_attempts is None:
+        K_attempts = math.ceil((1/p_m*p_lr))
+
+    release_port = None
+    if continuous:
+        # the right end node tells the left one that the e2e pair has been consumed, the message crosses both links
+        channel_r_to_l = ns.components.ClassicalChannel("channel_r_to_l", length = 2 * link_length,
+                                                        models = {"delay_model": ns.components.models.FibreDelayModel()})
+        release_conn = ns.nodes.DirectConnection("release_conn_r_l", channel_AtoB = channel_r_to_l)
+        release_port = "release"
+        net.add_connection(node1 = r_end_node, node2 = l_end_node, connection = release_conn,
+                           port_name_node1 = release_port, port_name_node2 = release_port, label = "release_conn_r_l")
 
     purif_protocol_l = PurificationProtocol(node = l_end_node, name = "PP_l", K_attempts = K_attempts, t_clock = t_clock,
-                                           link_length = link_length, connection = eps_conn_l_repeater, nic_index = 0)
+                                           link_length = link_length, connection = eps_conn_l_repeater, nic_index = 0,
+                                           multiplexed = multiplexed, continuous = continuous, cutoff = cutoff,
+                                           release_port = release_port, listens_regenerate = True)
     
     purif_protocol_rep_1 = PurificationProtocol(node = repeater, name = "PP_rep_1", K_attempts = K_attempts, t_clock = t_clock,
-                                           link_length = link_length, connection = None, nic_index = 0)
+                                           link_length = link_length, connection = None, nic_index = 0,
+                                           multiplexed = multiplexed, continuous = continuous, cutoff = cutoff)
     
     purif_protocol_rep_2 = PurificationProtocol(node = repeater, name = "PP_rep_2", K_attempts = K_attempts, t_clock = t_clock,
-                                           link_length = link_length, connection = eps_conn_r_repeater, nic_index = 1)
+                                           link_length = link_length, connection = eps_conn_r_repeater, nic_index = 1,
+                                           multiplexed = multiplexed, continuous = continuous, cutoff = cutoff)
     
     purif_protocol_r = PurificationProtocol(node = r_end_node, name = "PP_r", K_attempts = K_attempts, t_clock = t_clock,
-                                           link_length = link_length, connection = None, nic_index = 0)
+                                           link_length = link_length, connection = None, nic_index = 0,
+                                           multiplexed = multiplexed, continuous = continuous, cutoff = cutoff)
 
     ent_swapping_repeater = EntSwapping(node=repeater, 
                                         purif_to_wait=[purif_protocol_rep_1, purif_protocol_rep_2],
                                         name="ent_swapping_repeater",
-                                        is_left=True)
+                                        is_left=True,
+                                        continuous=continuous,
+                                        cutoff=cutoff)
     
     ent_swapping_r_node = EntSwapping(node=r_end_node,
                                       purif_to_wait=[purif_protocol_r],
                                       name="ent_swapping_r_node",
-                                      is_left=False)
+                                      is_left=False,
+                                      continuous=continuous,
+                                      release_port=release_port,
+                                      cutoff=cutoff)
     
     ent_swapping_repeater.set_swap_to_wait(ent_swapping_r_node)
     ent_swapping_r_node.set_swap_to_wait(ent_swapping_repeater)
+    ent_swapping_r_node.set_end_purifications([purif_protocol_l, purif_protocol_r])
     
-    purif_protocol_l.start()
-    ent_swapping_repeater.start_subprotocols()
-    ent_swapping_r_node.start_subprotocols()
-    ent_swapping_repeater.start()
-    ent_swapping_r_node.start()
+    # keep a reference to the protocols so that the results can be read after the simulation
+    protocols = {
+        # protocols that are not the subprotocol of a swapping
+        "standalone": [purif_protocol_l],
+        "schedulers": [l_end_node.program_scheduler, repeater.program_scheduler, r_end_node.program_scheduler],
+        "purification": [purif_protocol_l, purif_protocol_rep_1, purif_protocol_rep_2, purif_protocol_r],
+        "swapping": [ent_swapping_repeater, ent_swapping_r_node],
+        "end": ent_swapping_r_node,
+        # the purifications that hold the qubits of the e2e pair, the repeater measures the other ones in the BSM
+        "end_purifications": [purif_protocol_l, purif_protocol_r],
+    }
+
+    if start:
+        start_protocols(protocols)
+
+    return net, protocols
 
+def get_network(link_length, p_lr, p_m, t_clock, sparse_source = False, K_attempts = None, depolar_rate = 0.1,
+                multiplexed = False, slots_per_link = 2, memory_depolar_rate = 0., cutoff = None):
+    net, _ = setup_network(link_length = link_length, p_lr = p_lr, p_m = p_m, t_clock = t_clock,
+                           sparse_source = sparse_source, K_attempts = K_attempts, depolar_rate = depolar_rate,
+                           multiplexed = multiplexed, slots_per_link = slots_per_link,
+                           memory_depolar_rate = memory_depolar_rate, cutoff = cutoff)
     return net
 
 if __name__ == '__main__':
     # to represent mixed states
     ns.set_qstate_formalism(ns.QFormalism.DM)
+    # print what the protocols are doing
+    TRACER.set_level(DEBUG, echo = True)
     net = get_network(link_length = 30, p_lr = 0.9, p_m = 0.02, t_clock = 10)
     ns.sim_run()
\ No newline at end of file
@@ -1,28 +1,117 @@
 import netsquid as ns
 import math
 
-def get_EPS_connection(t_clock, p_m, length, p_lr) :
+from attempt_store import ATTEMPTS
+from instrumentation import METRICS, instrumented
+from links import FIBRE_SPEED, eps_frequency, herald_probabilities
+from tracing import INFO, MS_LATCHED, MS_START_SENT, MS_SUCCESS, TRACER
+
+class HeraldedSource(ns.components.Component):
+    """
+    This class implements an EPS that only emits the pulses in which at least one photon reaches a node
+    """
+
+    def __init__(self, name, p_m, p_lr, frequency, status = ns.components.SourceStatus.OFF):
+        super().__init__(name = name, port_names = ["qout0", "qout1"])
+
+        # time between two pulses in nsecs, the same clock of the QSource
+        self.period = 1e9 / frequency
+        # probability that a pulse contains a bell pair and at least one of the photons is not lost, and that both
+        # the photons arrive given that at least one of them arrives
+        self.p_herald, self.p_both = herald_probabilities(p_m, p_lr)
+
+        self._status = ns.components.SourceStatus.OFF
+        self._next_emission_time = None
+        self._evtype_emission = ns.pydynaa.EventType("HERALDED_EMISSION", "A pulse with at least one photon arriving")
+        self._emission_handler = ns.pydynaa.EventHandler(self._emit)
+
+        self.status = status
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        if status == ns.components.SourceStatus.EXTERNAL:
+            raise ValueError("The heralded source supports only the INTERNAL and OFF status")
+
+        was_internal = self._status == ns.components.SourceStatus.INTERNAL
+        self._status = status
+
+        if status == ns.components.SourceStatus.INTERNAL and not was_internal:
+            self._schedule_next_emission()
+        elif status == ns.components.SourceStatus.OFF:
+            # the already scheduled emission is ignored when it triggers
+            self._next_emission_time = None
+
+    def _schedule_next_emission(self):
+        if self.p_herald <= 0:
+            return
+
+        # instead of one event per clock cycle we directly sample the index of the next useful pulse
+        num_pulses = ns.util.simtools.get_random_state().geometric(self.p_herald)
+        self._next_emission_time = ns.sim_time() + num_pulses * self.period
+        # the handler waits on this event only: ns.sim_reset drops the pending waits, so a wait registered once
+        # in __init__ would not survive the reset of a reused network
+        event = self._schedule_at(self._next_emission_time, self._evtype_emission)
+        self._wait_once(self._emission_handler, event = event)
+
+    def _emit(self, event):
+        if self._status != ns.components.SourceStatus.INTERNAL or ns.sim_time() != self._next_emission_time:
+            return
+
+        # decide which photons arrive: both of them, or only one side with the same probability
+        rng = ns.util.simtools.get_random_state()
+        if rng.random_sample() < self.p_both:
+            arrivals = (True, True)
+        elif rng.random_sample() < 0.5:
+            arrivals = (True, False)
+        else:
+            arrivals = (False, True)
+
+        qubits = ns.qubits.create_qubits(2)
+        ns.qubits.assign_qstate(qubits, ns.qubits.ketstates.b00)
+
+        for port_name, qubit, arrives in zip(["qout0", "qout1"], qubits, arrivals):
+            if arrives:
+                self.ports[port_name].tx_output(ns.components.Message(items = [qubit]))
+            else:
+                ns.qubits.discard(qubit)
+
+        self._schedule_next_emission()
+
+def get_EPS_connection(t_clock, p_m, length, p_lr, sparse = False, depolar_rate = 0.1) :
 
     # create the EPS connection
     eps_conn = ns.nodes.Connection(name = "eps_conn")
 
-    # define the EPS
-    # with probability p_m a bell state is generated
-    state_sampler = ns.qubits.StateSampler([ns.qubits.ketstates.b00, None], [p_m, 1 - p_m])
-    
-    # t_clock is in nsecs so is equal to 10e9 * x but the frequency is in the inverse of seconds so I put 10e9 on the numerator to obtain 1 / x 
-    eps = ns.components.qsource.QSource(name = "EPS", 
-                                state_sampler = state_sampler,
-                                frequency = 10e9 / t_clock,
-                                num_ports=2,
-                                status = ns.components.SourceStatus.OFF)
-    
-    # define the left and right channel
-    loss_model = ns.components.models.FibreLossModel(p_loss_init = 1 - p_lr, p_loss_length = 0.)
-    delay_model = ns.components.models.FibreDelayModel()
-    noise_model = ns.components.models.DepolarNoiseModel(depolar_rate = 0.1, time_independent = True)
+    # the EPS emits several pulses in each clock cycle, the same rule is used by the routing of topology.py
+    frequency = eps_frequency(t_clock)
 
-    models = {"delay_model": delay_model, "quantum_loss_model": loss_model, "quantum_noise_model": noise_model}
+    delay_model = ns.components.models.FibreDelayModel()
+    noise_model = ns.components.models.DepolarNoiseModel(depolar_rate = depolar_rate, time_independent = True)
+
+    if sparse:
+        # the source only schedules the pulses where a photon arrives, the losses are sampled by the source itself
+        eps = HeraldedSource(name = "EPS", p_m = p_m, p_lr = p_lr, frequency = frequency)
+
+        models = {"delay_model": delay_model, "quantum_noise_model": noise_model}
+    else:
+        # define the EPS
+        # with probability p_m a bell state is generated
+        state_sampler = ns.qubits.StateSampler([ns.qubits.ketstates.b00, None], [p_m, 1 - p_m])
+        
+        eps = ns.components.qsource.QSource(name = "EPS", 
+                                    state_sampler = state_sampler,
+                                    frequency = frequency,
+                                    num_ports=2,
+                                    status = ns.components.SourceStatus.OFF)
+        
+        # define the left and right channel
+        loss_model = ns.components.models.FibreLossModel(p_loss_init = 1 - p_lr, p_loss_length = 0.)
+
+        models = {"delay_model": delay_model, "quantum_loss_model": loss_model, "quantum_noise_model": noise_model}
 
     left_channel = ns.components.QuantumChannel(name = "left_channel", length = length/2, models = models)
     right_channel = ns.components.QuantumChannel(name = "right_channel", length = length/2, models = models)
@@ -56,16 +145,19 @@ class MSProtocol(ns.protocols.NodeProtocol):
         self.connection = connection
         self.add_signal(self.ENTANGLED_SIGNAL, self.ENTANGLED_SIGNAL_EVT_TYPE)
         self.mem_position = mem_position
+        # time at which the pair was declared entangled, the same on both the nodes
+        self.success_time = None
 
-        if (nic_index == 0):        # execution on left side of repeater or end node
-            self.node_qport = self.node.ports['q0']
-            self.node_cport = self.node.ports['c0']
-        else:                       # execution on right side of repeater
-            self.node_qport = self.node.ports['q1']
-            self.node_cport = self.node.ports['c1']
+        # nic 0 is the left side of repeater or end node, nic 1 the right side of repeater,
+        # the repeater of a star has a nic for each end node
+        self.node_qport = self.node.ports[f'q{nic_index}']
+        self.node_cport = self.node.ports[f'c{nic_index}']
 
-    def run(self):
-        t_link = self.length/200000 #seconds
+    def _start_handshake(self):
+        t_link = self.length/FIBRE_SPEED #seconds
+
+        # discard the photons arrived after the end of the previous window, they are not entangled with anything
+        self.node_qport.rx_input()
 
         # set the status of the quantum source to INTERNAL:
         # it means that the quantum source starts to emits photons at the frequency specified as param.
@@ -81,21 +173,30 @@ class MSProtocol(ns.protocols.NodeProtocol):
             start_time = math.ceil(ns.sim_time() + t_link * (10 ** 9))
             # round up to a few nanoseconds before the next clock cycle
             start_time = start_time + (self.t_clock - start_time % self.t_clock) + self.t_clock - 1
-            print(f"[{ns.sim_time()}] Node {self.node.name}: Sending START message with value {start_time}")
+            if TRACER.level <= INFO:
+                TRACER.record(ns.sim_time(), INFO, MS_START_SENT, self.node.name, self.name, value = start_time)
             self.node_cport.tx_output(ns.components.Message(items=["START", start_time]))
         else:
-            yield self.await_port_input(self.node_cport)
-            msg = self.node_cport.rx_input()
+            # in continuous mode the START of the next round may arrive before this protocol is restarted
+            msg = yield from self.node.receive(self, self.node_cport.name, ("START",))
+            start_time = msg.items[1]
 
-            assert msg.items[0] == "START"
+        return start_time
 
-            start_time = msg.items[1]
+    @instrumented
+    def run(self):
+        self.success_time = None
+        run_start = ns.sim_time()
+        start_time = yield from self._start_handshake()
 
         yield self.await_timer(end_time = start_time)
+        if METRICS.enabled:
+            METRICS.observe("ms_handshake", ns.sim_time() - run_start)
 
         t_total_attempts = self.K_attempts * self.t_clock + ns.sim_time() + 5
 
         success_index = None
+        windows = 0
 
         while True:
             ev_expr = yield self.await_port_input(self.node_qport) | self.await_timer(end_time = t_total_attempts)
@@ -109,7 +210,8 @@ class MSProtocol(ns.protocols.NodeProtocol):
                 self.node.qmemory.put(qubit, positions=[self.mem_position])
 
                 success_index = current_attempt
-                print(f"[{ns.sim_time()}] Node {self.node.name}: Latched photon at attempt {success_index}")
+                if TRACER.level <= INFO:
+                    TRACER.record(ns.sim_time(), INFO, MS_LATCHED, self.node.name, self.name, attempt = success_index)
 
             if ev_expr.second_term.value:
                 if success_index is None:
@@ -118,17 +220,31 @@ class MSProtocol(ns.protocols.NodeProtocol):
                 msg = ns.components.Message(items = ["END", success_index])
                 self.node_cport.tx_output(msg)
 
-                yield self.await_port_input(self.node_cport)
-
-                recv_msg = self.node_cport.rx_input()
-                assert recv_msg.items[0] == "END"
+                recv_msg = yield from self.node.receive(self, self.node_cport.name, ("END",))
                 other_success_index = recv_msg.items[1]
 
+                windows += 1
+                if METRICS.enabled:
+                    METRICS.observe("ms_window", ns.sim_time() - start_time)
+                    METRICS.count("ms_windows")
+                    METRICS.count("ms_attempts", self.K_attempts)
+                # the window is recorded once, by the node that controls the EPS
+                if ATTEMPTS.enabled and self.connection is not None:
+                    matched = success_index != -1 and success_index == other_success_index
+                    ATTEMPTS.record(run_start, start_time, ns.sim_time(), self.node.name, self.name, windows,
+                                    self.K_attempts, success_index, other_success_index,
+                                    latched = int(success_index != -1), matched = int(matched))
+
                 if success_index != -1 and success_index == other_success_index:
-                    print(f"[{ns.sim_time()}] Node {self.node.name}: Entanglement generation successful"
-                            f" at attempt {success_index}")
+                    if METRICS.enabled:
+                        METRICS.count("ms_successes")
+                        METRICS.observe("ms_generation", ns.sim_time() - run_start)
+                        METRICS.observe("ms_windows_per_pair", windows)
+                    if TRACER.level <= INFO:
+                        TRACER.record(ns.sim_time(), INFO, MS_SUCCESS, self.node.name, self.name, attempt = success_index)
                     
                     # I'm telling an upper layer protocol that in the quantum memory is present the entangled qubit
+                    self.success_time = ns.sim_time()
                     self.send_signal(self.ENTANGLED_SIGNAL, result = None)
 
                     # If we don't disable it the EPS continues to generate events, so the simulation does not end
@@ -137,9 +253,130 @@ class MSProtocol(ns.protocols.NodeProtocol):
 
                     return 
                 else: 
+                    if METRICS.enabled:
+                        METRICS.count("ms_retries")
                     start_time = ns.sim_time()
                     t_total_attempts = self.K_attempts * self.t_clock + ns.sim_time() + 5
                     success_index = None
                     # we must free the quantum memory slot otherwise the new qubit cannot be inserted
                     if self.mem_position in self.node.qmemory.used_positions:
                         self.node.qmemory.pop(positions=[self.mem_position])
+
+class MultiplexedMSProtocol(MSProtocol):
+    """
+    This class implements the MS protocol on several memory slots at the same time, with the same EPS clock
+    """
+
+    def __init__(self, node, name, K_attempts, length, t_clock, connection = None, mem_positions = (0, 1), nic_index = 0,
+                 pairs_needed = 2, cutoff = None):
+        super().__init__(node = node, name = name, K_attempts = K_attempts, length = length, t_clock = t_clock,
+                         connection = connection, mem_position = mem_positions[0], nic_index = nic_index)
+        self.mem_positions = list(mem_positions)
+        self.pairs_needed = pairs_needed
+        # nsecs a matched pair can wait for the others, the node that controls the EPS discards the older ones
+        self.cutoff = cutoff
+        # positions of the entangled pairs, in the same order on both the nodes, and the time they were matched
+        self.matched_positions = []
+        self.matched_times = []
+
+    def _expired_pairs(self):
+        if self.cutoff is None or self.connection is None:
+            return []
+        return [index for index, matched_time in enumerate(self.matched_times)
+                if ns.sim_time() - matched_time > self.cutoff]
+
+    @instrumented
+    def run(self):
+        self.matched_positions = []
+        self.matched_times = []
+
+        run_start = ns.sim_time()
+        start_time = yield from self._start_handshake()
+
+        yield self.await_timer(end_time = start_time)
+        if METRICS.enabled:
+            METRICS.observe("ms_handshake", ns.sim_time() - run_start)
+
+        t_total_attempts = self.K_attempts * self.t_clock + ns.sim_time() + 5
+
+        # attempt index -> memory position of the photons latched in the current window
+        latched = {}
+        windows = 0
+
+        while True:
+            ev_expr = yield self.await_port_input(self.node_qport) | self.await_timer(end_time = t_total_attempts)
+
+            if ev_expr.first_term.value:
+                current_attempt = math.floor((ns.sim_time() - start_time) / self.t_clock)
+                qubit = self.node_qport.rx_input().items[0]
+
+                # every free slot can latch a photon, but only one for each attempt
+                free_positions = [position for position in self.mem_positions
+                                  if position not in self.matched_positions and position not in latched.values()]
+                if current_attempt not in latched and free_positions:
+                    self.node.qmemory.put(qubit, positions=[free_positions[0]])
+                    latched[current_attempt] = free_positions[0]
+                    if TRACER.level <= INFO:
+                        TRACER.record(ns.sim_time(), INFO, MS_LATCHED, self.node.name, self.name, attempt = current_attempt)
+
+            if ev_expr.second_term.value:
+                # the other node tells us all its latched attempts, a pair is entangled if both latched the same attempt.
+                # The node that controls the EPS also tells which of the matched pairs are too old
+                expired = self._expired_pairs()
+                self.node_cport.tx_output(ns.components.Message(items = ["END", sorted(latched), expired]))
+
+                recv_msg = yield from self.node.receive(self, self.node_cport.name, ("END",))
+                other_latched = set(recv_msg.items[1])
+                if self.connection is None:
+                    expired = recv_msg.items[2]
+
+                for index in sorted(expired, reverse = True):
+                    self.node.qmemory.pop(positions=[self.matched_positions.pop(index)])
+                    self.matched_times.pop(index)
+                    if METRICS.enabled:
+                        METRICS.count("cutoff_discards")
+
+                windows += 1
+                if METRICS.enabled:
+                    METRICS.observe("ms_window", ns.sim_time() - start_time)
+                    METRICS.count("ms_windows")
+                    METRICS.count("ms_attempts", self.K_attempts)
+                # the window is recorded once, by the node that controls the EPS
+                if ATTEMPTS.enabled and self.connection is not None:
+                    # the first attempt that entangled a pair, the first one latched by the other node, and how many
+                    # pairs they have in common
+                    matched_attempts = [attempt for attempt in latched if attempt in other_latched]
+                    ATTEMPTS.record(run_start, start_time, ns.sim_time(), self.node.name, self.name, windows,
+                                    self.K_attempts, min(matched_attempts, default = -1),
+                                    min(other_latched, default = -1), latched = len(latched),
+                                    matched = len(matched_attempts))
+
+                for attempt in sorted(latched):
+                    if attempt in other_latched:
+                        self.matched_positions.append(latched[attempt])
+                        self.matched_times.append(ns.sim_time())
+                        if METRICS.enabled:
+                            METRICS.count("ms_pairs")
+                        if TRACER.level <= INFO:
+                            TRACER.record(ns.sim_time(), INFO, MS_SUCCESS, self.node.name, self.name, attempt = attempt)
+                    else:
+                        # we must free the quantum memory slot otherwise the new qubit cannot be inserted
+                        self.node.qmemory.pop(positions=[latched[attempt]])
+
+                if len(self.matched_positions) >= self.pairs_needed:
+                    if METRICS.enabled:
+                        METRICS.count("ms_successes")
+                        METRICS.observe("ms_generation", ns.sim_time() - run_start)
+                        METRICS.observe("ms_windows_per_pair", windows)
+                    self.send_signal(self.ENTANGLED_SIGNAL, result = list(self.matched_positions))
+
+                    if self.connection is not None:
+                        self.connection.subcomponents["EPS"].status = ns.components.qsource.SourceStatus.OFF
+
+                    return
+
+                if METRICS.enabled:
+                    METRICS.count("ms_retries")
+                start_time = ns.sim_time()
+                t_total_attempts = self.K_attempts * self.t_clock + ns.sim_time() + 5
+                latched = {}
@@ -1,28 +1,90 @@
+import collections
+
 import netsquid as ns 
 
+from scheduler import ProgramScheduler
+
 class NetNode(ns.nodes.Node):
     """
     This class implements a quantum network node
     """
 
-    def __init__(self, ID, name, is_repeater = True):
-        if is_repeater:
-            port_names = ["q0", "c0", "q1", "c1"]
-        else:
-            port_names = ["q0", "c0"]
+    def __init__(self, ID, name, is_repeater = True, slots_per_link = 2, num_links = None, num_positions = None,
+                 memory_depolar_rate = 0.):
+        # a repeater of a line has a link on each side, the links of a star all end on the same repeater
+        if num_links is None:
+            num_links = 2 if is_repeater else 1
+
+        # the quantum and classical ports of link i are qi and ci
+        port_names = []
+        for link in range(num_links):
+            port_names += [f"q{link}", f"c{link}"]
         
         super().__init__(name = name, ID = ID, port_names = port_names)
 
+        # memory slots reserved to each link, the purification needs at least two of them
+        if slots_per_link < 2:
+            raise ValueError("Each link needs at least two memory slots")
+        self.slots_per_link = slots_per_link
+        self.num_links = num_links
+
+        # by default every link has its own slots, a shared memory can be smaller and allocated on demand
+        if num_positions is None:
+            num_positions = num_links * slots_per_link
+
+        # the stored qubits depolarize with the time they wait, the rate is in Hz
+        memory_noise_models = None
+        if memory_depolar_rate > 0:
+            memory_noise_models = [ns.components.models.DepolarNoiseModel(depolar_rate = memory_depolar_rate,
+                                                                           time_independent = False)] * num_positions
+
         if is_repeater: 
             physical_instructions = [
                 ns.components.PhysicalInstruction(ns.components.INSTR_CX, duration=1., parallel=True),
                 ns.components.PhysicalInstruction(ns.components.INSTR_MEASURE, duration=1., parallel=True),
                 ns.components.PhysicalInstruction(ns.components.INSTR_MEASURE_BELL, duration=1.)
             ]
-            self.qmemory = ns.components.QuantumProcessor("qproc", num_positions=4, phys_instructions=physical_instructions)
+            self.qmemory = ns.components.QuantumProcessor("qproc", num_positions=num_positions, phys_instructions=physical_instructions,
+                                                          memory_noise_models=memory_noise_models)
         else:
             physical_instructions = [
                 ns.components.PhysicalInstruction(ns.components.INSTR_CX, duration=1., parallel=True),
                 ns.components.PhysicalInstruction(ns.components.INSTR_MEASURE, duration=1., parallel=True),
             ]
-            self.qmemory = ns.components.QuantumProcessor("qproc", num_positions=2, phys_instructions=physical_instructions)
\ No newline at end of file
+            self.qmemory = ns.components.QuantumProcessor("qproc", num_positions=num_positions, phys_instructions=physical_instructions,
+                                                          memory_noise_models=memory_noise_models)
+
+        # all the programs on the processor go through the scheduler, so the protocols never find it busy
+        self.program_scheduler = ProgramScheduler(node = self)
+
+        # the protocols of a link share its classical port: the messages read from a port wait here, in arrival
+        # order, until the protocol that expects their tag takes them
+        self._mailboxes = collections.defaultdict(collections.deque)
+
+    def take(self, port_name, tags):
+        # the first message arrived on the port with one of the tags, None if there is none
+        port = self.ports[port_name]
+        mailbox = self._mailboxes[port_name]
+        msg = port.rx_input()
+        while msg is not None:
+            mailbox.append(msg)
+            msg = port.rx_input()
+
+        for index, msg in enumerate(mailbox):
+            if msg.items[0] in tags:
+                del mailbox[index]
+                return msg
+        return None
+
+    def receive(self, protocol, port_name, tags):
+        # used with yield from by the protocols, waits for the first message with one of the tags
+        msg = self.take(port_name, tags)
+        while msg is None:
+            yield protocol.await_port_input(self.ports[port_name])
+            msg = self.take(port_name, tags)
+        return msg
+
+    def clear_mailboxes(self):
+        for port in self.ports.values():
+            port.rx_input()
+        self._mailboxes.clear()
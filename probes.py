@@ -0,0 +1,103 @@
+import collections
+
+import netsquid as ns
+import numpy as np
+
+# points of the protocols where the state of a pair can be read
+PURIF_PAIR = "purification_pair"
+PURIF_RESULT = "purification_result"
+E2E_PAIR = "e2e_pair"
+PROBE_POINTS = (PURIF_PAIR, PURIF_RESULT, E2E_PAIR)
+
+# a reading of a probe, state is the density matrix of the qubits when the subscriber asked for it
+ProbeSample = collections.namedtuple("ProbeSample", ["point", "sim_time", "node", "protocol", "fidelity", "state"])
+
+class Subscription:
+    """
+    This class is a consumer of the readings of a probe point, it receives a fraction rate of them
+    """
+
+    def __init__(self, point, callback, rate = 1., full_state = False):
+        if point not in PROBE_POINTS:
+            raise ValueError(f"Unknown probe point {point}, the points are {PROBE_POINTS}")
+        if not 0 < rate <= 1:
+            raise ValueError(f"The sampling rate must be in (0, 1], found {rate}")
+        self.point = point
+        self.callback = callback
+        self.rate = rate
+        self.full_state = full_state
+
+class Probes:
+    """
+    This class computes the fidelity of the pairs only when someone subscribed to it, it is the oracle
+    of the simulation: it reads the states without measuring them
+    """
+
+    def __init__(self, seed = None):
+        self._subscriptions = {point: [] for point in PROBE_POINTS}
+        # the sampling has its own generator, it does not change the random state of the simulation
+        self._rng = np.random.default_rng(seed)
+        # (qstate, qubits, reference) -> fidelity, valid only at the time of _cache_time
+        self._cache = {}
+        self._cache_time = None
+
+    def seed(self, seed):
+        self._rng = np.random.default_rng(seed)
+
+    def subscribe(self, point, callback, rate = 1., full_state = False):
+        subscription = Subscription(point, callback, rate = rate, full_state = full_state)
+        self._subscriptions[point].append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self._subscriptions[subscription.point].remove(subscription)
+
+    def clear(self):
+        for subscriptions in self._subscriptions.values():
+            subscriptions.clear()
+        self._cache.clear()
+        self._cache_time = None
+
+    def active(self, point):
+        # the protocols check this before collecting the qubits, like they check the level of the tracer
+        return len(self._subscriptions[point]) > 0
+
+    def fidelity(self, qubits, reference):
+        # the state of a qubit only changes when time passes or a program runs on it, and the protocols read it
+        # at most once per program, so within the same instant the value of a qstate can be reused
+        now = ns.sim_time()
+        if now != self._cache_time:
+            self._cache.clear()
+            self._cache_time = now
+
+        key = (id(qubits[0].qstate), tuple(qubit.name for qubit in qubits), id(reference))
+        fidelity = self._cache.get(key)
+        if fidelity is None:
+            fidelity = float(ns.qubits.qubitapi.fidelity(qubits, reference, squared=True))
+            self._cache[key] = fidelity
+        return fidelity
+
+    def read(self, point, qubits, reference, node = "", protocol = "", force = False):
+        # fidelity of the qubits if at least a subscriber sampled this reading (or force), None otherwise
+        selected = [subscription for subscription in self._subscriptions[point]
+                    if subscription.rate >= 1 or self._rng.random() < subscription.rate]
+        if not selected and not force:
+            return None
+
+        fidelity = self.fidelity(qubits, reference)
+        state = None
+        if any(subscription.full_state for subscription in selected):
+            state = ns.qubits.qubitapi.reduced_dm(qubits)
+
+        for subscription in selected:
+            subscription.callback(ProbeSample(point = point, sim_time = ns.sim_time(), node = node,
+                                              protocol = protocol, fidelity = fidelity,
+                                              state = state if subscription.full_state else None))
+        return fidelity
+
+def pair_qubits(qmemory, position):
+    # cheating: we peek the qubit and take all the qubits of its state, i.e. the pair it belongs to
+    return qmemory.peek(positions=[position])[0].qstate.qubits
+
+# probes shared by all the protocols, nothing is computed until someone subscribes
+PROBES = Probes()
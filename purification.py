@@ -1,10 +1,22 @@
 import netsquid as ns
 
-from ms_protocol import MSProtocol
+from instrumentation import METRICS, instrumented
+from links import FIBRE_SPEED, check_cutoff, min_generation_time
+from ms_protocol import MSProtocol, MultiplexedMSProtocol
+from probes import PROBES, PURIF_PAIR, PURIF_RESULT, pair_qubits
+from scheduler import PRIORITY_PURIFICATION
+from tracing import (DEBUG, INFO, PURIF_FAILED, PURIF_FIDELITY, PURIF_PAIRS_READY, PURIF_SUCCESS, PURIF_TERMINATED,
+                     TRACER)
+
+# verdicts of the cutoff on the oldest pair of a round
+CUTOFF_KEEP = "KEEP"
+CUTOFF_DISCARD = "DISCARD"
 
 class PurificationProtocol(ns.protocols.NodeProtocol):
     PURIFICATION_SIGNAL = "purification_signal"
     PURIFICATION_SIGNAL_EVT_TYPE = ns.pydynaa.EventType("purification signal", "The purification is terminated")
+    RELEASED_SIGNAL = "released_signal"
+    RELEASED_SIGNAL_EVT_TYPE = ns.pydynaa.EventType("released signal", "The purified pair has been consumed")
 
     @staticmethod
     def _get_purification_program():
@@ -15,90 +27,256 @@ class PurificationProtocol(ns.protocols.NodeProtocol):
         program.apply(ns.components.INSTR_MEASURE, q2, output_key="M0")     # apply a mesaurement to the second qubit
         return program
     
-    def __init__(self, node, name=None, K_attempts=200, t_clock=10, link_length=25, connection=None, nic_index = 0):
+    def __init__(self, node, name=None, K_attempts=200, t_clock=10, link_length=25, connection=None, nic_index = 0,
+                 multiplexed = False, continuous = False, mem_positions = None, cutoff = None, release_port = None,
+                 listens_regenerate = False):
         super().__init__(node=node, name=name)
 
         self.add_signal(self.PURIFICATION_SIGNAL, self.PURIFICATION_SIGNAL_EVT_TYPE)
-        
-        if (nic_index == 0):        # execution on left side of repeater or end node 
-            # we must perform the MS protocol for each quantum memory slot
-            self.add_subprotocol(MSProtocol(self.node, name="MS0", K_attempts=K_attempts, length=link_length, t_clock=t_clock,
-                                            connection=connection, mem_position=0, nic_index=nic_index), name="MSProtocol_0")
-            self.add_subprotocol(MSProtocol(self.node, name="MS1", K_attempts=K_attempts, length=link_length, t_clock=t_clock,
-                                            connection=connection, mem_position=1, nic_index=nic_index), name="MSProtocol_1")
-            self.qmemory_pos0 = 0
-            self.qmemory_pos1 = 1
-            self.node_cport = self.node.ports['c0']
-            
-        else:                       # execution on right side of repeater
+        self.add_signal(self.RELEASED_SIGNAL, self.RELEASED_SIGNAL_EVT_TYPE)
+
+        # nic 0 is the left side of repeater or end node, nic 1 the right side of repeater.
+        # Each nic has its own memory slots: with 2 slots per link they are 0, 1 for nic 0 and 2, 3 for nic 1
+        # a memory shared by several links allocates the slots on demand and passes them explicitly
+        if mem_positions is None:
+            slots_per_link = self.node.slots_per_link
+            mem_positions = range(nic_index * slots_per_link, (nic_index + 1) * slots_per_link)
+        self.mem_positions = list(mem_positions)
+        self.qmemory_pos0 = self.mem_positions[0]
+        self.qmemory_pos1 = self.mem_positions[1]
+        self.node_cport = self.node.ports[f"c{nic_index}"]
+        self.multiplexed = multiplexed
+        # in continuous mode a new round starts every time the pair of the previous one is released
+        self.continuous = continuous
+        # port where the node that consumes the pair tells us to release it, None if it is released on this node
+        self.release_port = release_port
+        # nsecs a pair can wait in memory for the other pair of the round, then it is discarded and generated again.
+        # The node that controls the EPS decides, like it decides when the MS protocol starts
+        self.cutoff = cutoff
+        self.decides_cutoff = connection is not None
+        # nsecs of the fastest round: the pairs are generated one after the other without multiplexing, then the
+        # outcomes cross the link. A cutoff must leave the time to replace a pair
+        pair_time = min_generation_time(link_length, K_attempts, t_clock)
+        self.min_round_time = (1 if multiplexed else 2) * pair_time + link_length / FIBRE_SPEED * 1e9
+        check_cutoff(cutoff, pair_time)
+        # an end node whose purified pair waits on the repeater: with a cutoff the repeater may ask to regenerate it
+        self.listens_regenerate = listens_regenerate and cutoff is not None
+
+        if multiplexed:
+            # all the slots try to latch a photon from the same EPS clock
+            self.add_subprotocol(MultiplexedMSProtocol(self.node, name="MS_mux", K_attempts=K_attempts, length=link_length,
+                                                       t_clock=t_clock, connection=connection,
+                                                       mem_positions=self.mem_positions, nic_index=nic_index,
+                                                       cutoff=cutoff),
+                                 name="MSProtocol_mux")
+        else:
             # we must perform the MS protocol for each quantum memory slot
             self.add_subprotocol(MSProtocol(self.node, name="MS0", K_attempts=K_attempts, length=link_length, t_clock=t_clock,
-                                            connection=connection, mem_position=2, nic_index=nic_index), name="MSProtocol_0")
+                                            connection=connection, mem_position=self.qmemory_pos0, nic_index=nic_index), name="MSProtocol_0")
             self.add_subprotocol(MSProtocol(self.node, name="MS1", K_attempts=K_attempts, length=link_length, t_clock=t_clock,
-                                            connection=connection, mem_position=3, nic_index=nic_index), name="MSProtocol_1")
-            self.qmemory_pos0 = 2
-            self.qmemory_pos1 = 3
-            self.node_cport = self.node.ports['c1']
+                                            connection=connection, mem_position=self.qmemory_pos1, nic_index=nic_index), name="MSProtocol_1")
+
+        # position of the pair left by the purification
+        self.result_position = self.qmemory_pos0
+
+        # the program is always the same, it is built once and reused in every run
+        self._purification_program = self._get_purification_program()
+
+        # result of the last round: True if the outcomes matched, None while the protocol is running
+        self.success = None
+        # time at which the last round terminated
+        self.done_time = None
+        # result of the last round whose pair has been released
+        self.last_success = None
+        self.round_start = None
+        self._released = False
         
-    def _get_fidelity(self, position):
-        # we read without popping the qubit, cheating because we cannot access the state of a qubit without measure
-        qubits = self.node.qmemory.peek(positions=[position])[0].qstate.qubits
-        fidelity = ns.qubits.qubitapi.fidelity(qubits, ns.qubits.ketstates.b00, squared=True)
-        return fidelity
+    def _probe_fidelity(self, point, position):
+        # the tracer at DEBUG level reads every fidelity, the subscribers of the probe only the sampled ones
+        return PROBES.read(point, pair_qubits(self.node.qmemory, position), ns.qubits.ketstates.b00,
+                           node=self.node.name, protocol=self.name, force=TRACER.level <= DEBUG)
     
+    def _start_ms(self, protocol, restart = False):
+        # the MS protocol of a previous round is terminated but still running, so it must be restarted
+        if self.continuous or restart or protocol.is_running:
+            protocol.reset()
+        else:
+            protocol.start()
+
+    def _cutoff_verdict(self, generated_at):
+        # both the nodes must discard the same pair, so the verdict travels on the classical port of the link
+        if self.decides_cutoff:
+            oldest_age = ns.sim_time() - min(generated_at.values())
+            verdict = CUTOFF_DISCARD if oldest_age > self.cutoff else CUTOFF_KEEP
+            self.node_cport.tx_output(ns.components.Message(items=["CUTOFF", verdict]))
+        else:
+            msg = yield from self.node.receive(self, self.node_cport.name, ("CUTOFF",))
+            verdict = msg.items[1]
+        return verdict
+
+    def release(self):
+        # the pair of the round has been consumed: free the memory slots of the link and start the next round
+        for position in self.mem_positions:
+            if position in self.node.qmemory.used_positions:
+                self.node.qmemory.pop(positions=[position])
+        self.last_success = self.success
+        self.success = None
+        self._released = True
+        self.send_signal(self.RELEASED_SIGNAL)
+
+    def _discard_pair(self):
+        for position in self.mem_positions:
+            if position in self.node.qmemory.used_positions:
+                self.node.qmemory.pop(positions=[position])
+        self.success = None
+
+    def regenerate(self):
+        # the purified pair waited too long on the repeater: it is discarded and a new round starts
+        self._discard_pair()
+        self.reset()
+
+    def _wait_next_round(self):
+        # True when a new round must start: the pair has been released or, with a cutoff, the repeater discarded it
+        while True:
+            if self._released:
+                return True
+            if self.listens_regenerate and self.node.take(self.node_cport.name, ("REGENERATE",)) is not None:
+                self._discard_pair()
+                return True
+            # the pair has been consumed on another node, only the RELEASE messages travel on this port
+            if self.continuous and self.release_port is not None and self.node.ports[self.release_port].rx_input() is not None:
+                self.release()
+                return True
+
+            if self.continuous and self.release_port is None:
+                expression = self.await_signal(sender=self, signal_label = self.RELEASED_SIGNAL)
+            elif self.continuous:
+                expression = self.await_port_input(self.node.ports[self.release_port])
+            elif self.listens_regenerate:
+                expression = None
+            else:
+                return False
+
+            if self.listens_regenerate:
+                regenerate = self.await_port_input(self.node_cport)
+                expression = regenerate if expression is None else expression | regenerate
+            yield expression
+
+    @instrumented
     def run(self):
-        # create the entangled pair on the first memory slot
-        self.subprotocols["MSProtocol_0"].start()
+        while True:
+            yield from self._purification_round()
+            if not (yield from self._wait_next_round()):
+                return
 
-        # wait for the first MSProtocol to finish
-        yield self.await_signal(sender=self.subprotocols["MSProtocol_0"], signal_label = MSProtocol.ENTANGLED_SIGNAL)
+    def _purification_round(self):
+        self.success = None
+        self._released = False
+        self.round_start = run_start = ns.sim_time()
 
-        # start the second MSProtocol to entangle the second qubit
-        self.subprotocols["MSProtocol_1"].start()
-        yield self.await_signal(sender=self.subprotocols["MSProtocol_1"], signal_label = MSProtocol.ENTANGLED_SIGNAL)
+        if self.multiplexed:
+            # the purification starts as soon as any two slots hold entangled pairs
+            ms_protocol = self.subprotocols["MSProtocol_mux"]
+            self._start_ms(ms_protocol)
+            yield self.await_signal(sender=ms_protocol, signal_label = MSProtocol.ENTANGLED_SIGNAL)
+
+            # the pairs are in the same order on both the nodes, so the control and target pairs are the same
+            control_position, target_position = ms_protocol.matched_positions[:2]
+            # the other pairs are not needed
+            for position in ms_protocol.matched_positions[2:]:
+                self.node.qmemory.pop(positions=[position])
+        else:
+            # create the entangled pair on the first memory slot
+            self._start_ms(self.subprotocols["MSProtocol_0"])
 
-        # get the fidelity of the qubits
-        fidelity_0 = self._get_fidelity(self.qmemory_pos0)
-        fidelity_1 = self._get_fidelity(self.qmemory_pos1)
+            # wait for the first MSProtocol to finish
+            yield self.await_signal(sender=self.subprotocols["MSProtocol_0"], signal_label = MSProtocol.ENTANGLED_SIGNAL)
 
-        # print the fidelities
-        print(f"[{ns.sim_time()}] Node {self.node.name}: Both qubits are entangled with fidelity {fidelity_0} and {fidelity_1}")
+            # start the second MSProtocol to entangle the second qubit
+            self._start_ms(self.subprotocols["MSProtocol_1"])
+            yield self.await_signal(sender=self.subprotocols["MSProtocol_1"], signal_label = MSProtocol.ENTANGLED_SIGNAL)
+
+            if self.cutoff is not None:
+                # the first pair decohered while the second one was generated: it is replaced until both are fresh
+                ms_protocols = {self.qmemory_pos0: "MSProtocol_0", self.qmemory_pos1: "MSProtocol_1"}
+                generated_at = {self.qmemory_pos0: self.subprotocols["MSProtocol_0"].success_time,
+                                self.qmemory_pos1: self.subprotocols["MSProtocol_1"].success_time}
+                while (yield from self._cutoff_verdict(generated_at)) == CUTOFF_DISCARD:
+                    oldest = min(generated_at, key=generated_at.get)
+                    self.node.qmemory.pop(positions=[oldest])
+                    if METRICS.enabled:
+                        METRICS.count("cutoff_discards")
+
+                    ms_protocol = self.subprotocols[ms_protocols[oldest]]
+                    self._start_ms(ms_protocol, restart=True)
+                    yield self.await_signal(sender=ms_protocol, signal_label = MSProtocol.ENTANGLED_SIGNAL)
+                    generated_at[oldest] = ms_protocol.success_time
+
+            control_position, target_position = self.qmemory_pos0, self.qmemory_pos1
+
+        self.result_position = control_position
+        if METRICS.enabled:
+            METRICS.observe("purif_generation", ns.sim_time() - run_start)
+
+        # get the fidelity of the qubits, only if someone reads it because it is expensive
+        if TRACER.level <= DEBUG or PROBES.active(PURIF_PAIR):
+            fidelity_control = self._probe_fidelity(PURIF_PAIR, control_position)
+            fidelity_target = self._probe_fidelity(PURIF_PAIR, target_position)
+            if TRACER.level <= DEBUG:
+                TRACER.record(ns.sim_time(), DEBUG, PURIF_PAIRS_READY, self.node.name, self.name,
+                              value = fidelity_control, value2 = fidelity_target)
 
         # at this point we have two entangled qubits in the memory
-        prog = self._get_purification_program()
+        prog = self._purification_program
         
-        # the middle repeater must wait the program on the other indexes if in execution
-        while(True):
-            try:
-                self.node.qmemory.execute_program(prog, qubit_mapping=[self.qmemory_pos0, self.qmemory_pos1], error_on_fail=True)
-                break
-            except ns.components.qprocessor.ProcessorBusyError:
-                self.await_timer(end_time = ns.sim_time() + 100)
-
-        yield self.await_program(self.node.qmemory)
+        # the middle repeater may be executing the program on the other indexes, the scheduler runs ours when it's free
+        ticket = self.node.program_scheduler.submit(prog, qubit_mapping=[control_position, target_position],
+                                                    priority=PRIORITY_PURIFICATION, requester=self.name)
+        if not ticket.is_done:
+            yield ticket.await_done()
+        if METRICS.enabled:
+            METRICS.observe("purif_program", ticket.end_time - ticket.submit_time)
 
         # we collect the measurement result
         outcome = prog.output["M0"][0]
 
         # we send the measurement to the other node
-        self.node_cport.tx_output(ns.components.Message(items=outcome))
+        self.node_cport.tx_output(ns.components.Message(items=["OUTCOME", outcome]))
+        exchange_start = ns.sim_time()
+
+        # we wait from the measurement result from the other node, it may be already arrived if the scheduler
+        # of this node was busy
+        msg = yield from self.node.receive(self, self.node_cport.name, ("OUTCOME",))
+        outcome_other = msg.items[1]
 
-        # we wait from the measurement result from the other node
-        yield self.await_port_input(self.node_cport)
-        msg = self.node_cport.rx_input()
-        outcome_other = msg.items[0]
+        if METRICS.enabled:
+            METRICS.observe("purif_exchange", ns.sim_time() - exchange_start)
+            METRICS.observe("purif_total", ns.sim_time() - run_start)
+            METRICS.count("purification_rounds")
+            if outcome == outcome_other:
+                METRICS.count("purification_matches")
 
         # we check if the measurement are the same
         if outcome == outcome_other:
-            print(f"[{ns.sim_time()}] Node {self.node.name}: Purification successful")
-            # print the new qubit fidelity with respect to the bell state
-            print(f"[{ns.sim_time()}] Node {self.node.name}: Fidelity of the new qubit pair with respect to the Bell state: {self._get_fidelity(position=self.qmemory_pos0)}")
+            if TRACER.level <= INFO:
+                TRACER.record(ns.sim_time(), INFO, PURIF_SUCCESS, self.node.name, self.name)
+            # the new qubit fidelity with respect to the bell state
+            if TRACER.level <= DEBUG or PROBES.active(PURIF_RESULT):
+                fidelity = self._probe_fidelity(PURIF_RESULT, self.result_position)
+                if TRACER.level <= DEBUG:
+                    TRACER.record(ns.sim_time(), DEBUG, PURIF_FIDELITY, self.node.name, self.name, value = fidelity)
+            self.success = True
+            self.done_time = ns.sim_time()
             self.send_signal(self.PURIFICATION_SIGNAL, result = True)
         else:
-            print(f"[{ns.sim_time()}] Node {self.node.name}: Purification failed")
+            if TRACER.level <= INFO:
+                TRACER.record(ns.sim_time(), INFO, PURIF_FAILED, self.node.name, self.name)
+            self.success = False
+            self.done_time = ns.sim_time()
             self.send_signal(self.PURIFICATION_SIGNAL, result = False)
         
-        print(f"[{ns.sim_time()}] Purification protocol {self.name} terminated")
+        if TRACER.level <= INFO:
+            TRACER.record(ns.sim_time(), INFO, PURIF_TERMINATED, self.node.name, self.name)
 
 
         
\ No newline at end of file
@@ -0,0 +1,111 @@
+import heapq
+import itertools
+
+import netsquid as ns
+
+from instrumentation import METRICS, instrumented
+
+# priorities of the programs, the lower the sooner: the BSM frees the memory of the repeater
+PRIORITY_BSM = 0
+PRIORITY_PURIFICATION = 1
+
+class ProgramTicket(ns.pydynaa.Entity):
+    """
+    This class represents a program submitted to the scheduler of a node
+    """
+
+    DONE_EVT_TYPE = ns.pydynaa.EventType("PROGRAM_DONE", "The scheduled program has been executed")
+
+    def __init__(self, program, qubit_mapping, priority, requester):
+        super().__init__()
+        self.program = program
+        self.qubit_mapping = qubit_mapping
+        self.priority = priority
+        self.requester = requester
+
+        self.submit_time = ns.sim_time()
+        self.start_time = None
+        self.end_time = None
+        self.is_done = False
+
+    def await_done(self):
+        # the protocols yield this expression to wait until the program has been executed
+        return ns.pydynaa.EventExpression(source = self, event_type = self.DONE_EVT_TYPE)
+
+class ProgramScheduler(ns.protocols.NodeProtocol):
+    """
+    This class queues the programs of the protocols of a node and runs them when the processor is free
+    """
+
+    SUBMITTED_SIGNAL = "program submitted"
+    SUBMITTED_SIGNAL_EVT_TYPE = ns.pydynaa.EventType("program submitted", "A program has been submitted to the scheduler")
+
+    def __init__(self, node, name = None):
+        super().__init__(node = node, name = name if name is not None else f"scheduler_{node.name}")
+        self.add_signal(self.SUBMITTED_SIGNAL, self.SUBMITTED_SIGNAL_EVT_TYPE)
+
+        self._queue = []
+        self._counter = itertools.count()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._stats_start_time = ns.sim_time()
+        self.num_programs = 0
+        self.busy_time = 0.
+        self.total_wait = 0.
+        self.max_wait = 0.
+        self.max_queue_length = 0
+        # total wait and number of programs of each requester
+        self.wait_by_requester = {}
+
+    def submit(self, program, qubit_mapping, priority = PRIORITY_PURIFICATION, requester = None):
+        ticket = ProgramTicket(program, qubit_mapping, priority, requester)
+        heapq.heappush(self._queue, (priority, next(self._counter), ticket))
+        self.max_queue_length = max(self.max_queue_length, len(self._queue))
+
+        # wake up the scheduler if it is waiting for programs
+        self.send_signal(self.SUBMITTED_SIGNAL)
+        return ticket
+
+    @instrumented
+    def run(self):
+        self._queue = []
+        self._reset_stats()
+
+        while True:
+            if not self._queue:
+                yield self.await_signal(sender = self, signal_label = self.SUBMITTED_SIGNAL)
+                continue
+
+            _, _, ticket = heapq.heappop(self._queue)
+
+            ticket.start_time = ns.sim_time()
+            self.node.qmemory.execute_program(ticket.program, qubit_mapping = ticket.qubit_mapping, error_on_fail = True)
+            yield self.await_program(self.node.qmemory)
+            ticket.end_time = ns.sim_time()
+
+            wait = ticket.start_time - ticket.submit_time
+            self.num_programs += 1
+            self.busy_time += ticket.end_time - ticket.start_time
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            total, count = self.wait_by_requester.get(ticket.requester, (0., 0))
+            self.wait_by_requester[ticket.requester] = (total + wait, count + 1)
+            if METRICS.enabled:
+                METRICS.observe("scheduler_wait", wait)
+
+            ticket.is_done = True
+            ticket._schedule_now(ticket.DONE_EVT_TYPE)
+
+    def stats(self):
+        elapsed = ns.sim_time() - self._stats_start_time
+        return {
+            "programs": self.num_programs,
+            "busy_time": self.busy_time,
+            "utilization": self.busy_time / elapsed if elapsed > 0 else 0.,
+            "mean_wait": self.total_wait / self.num_programs if self.num_programs > 0 else 0.,
+            "max_wait": self.max_wait,
+            "max_queue_length": self.max_queue_length,
+            "mean_wait_by_requester": {requester: total / count
+                                       for requester, (total, count) in self.wait_by_requester.items()},
+        }
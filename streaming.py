@@ -0,0 +1,162 @@
+import argparse
+import collections
+import json
+
+import netsquid as ns
+import numpy as np
+
+from ent_swapping import e2e_fidelity
+from main import setup_network, start_protocols
+from probes import PROBES
+
+# an e2e pair delivered to the right end node, the times are in nsecs
+StreamedPair = collections.namedtuple("StreamedPair", ["index", "bell_index", "fidelity", "purification_success",
+                                                       "delivery_time", "latency"])
+
+class PairStream:
+    """
+    This class runs the network in continuous mode and delivers the e2e pairs as a generator
+    """
+
+    def __init__(self, link_length, p_lr, p_m, t_clock, seed = None, sparse_source = False, K_attempts = None,
+                 depolar_rate = 0.1, multiplexed = False, slots_per_link = 2, chunk_duration = 1e7,
+                 warmup_pairs = 0, reservoir_size = 10000, memory_depolar_rate = 0., cutoff = None):
+        ns.sim_reset()
+        ns.set_qstate_formalism(ns.QFormalism.DM)
+        if seed is not None:
+            ns.set_random_state(seed = seed)
+            PROBES.seed(seed)
+
+        self.net, self.protocols = setup_network(link_length = link_length, p_lr = p_lr, p_m = p_m, t_clock = t_clock,
+                                                 sparse_source = sparse_source, K_attempts = K_attempts,
+                                                 depolar_rate = depolar_rate, multiplexed = multiplexed,
+                                                 slots_per_link = slots_per_link, memory_depolar_rate = memory_depolar_rate,
+                                                 cutoff = cutoff, continuous = True, start = False)
+        self.protocols["end"].consumer = self._consume
+        start_protocols(self.protocols)
+
+        # simulated nsecs run between two checks of the delivered pairs
+        self.chunk_duration = chunk_duration
+        # the first pairs are not counted in the statistics, they are not in the steady state
+        self.warmup_pairs = warmup_pairs
+
+        # pairs delivered during the last chunk and not yet read by the generator
+        self._pending = collections.deque()
+        self._num_pairs = 0
+
+        # the statistics use constant memory however long the stream is
+        self._steady_start = None
+        self._steady_pairs = 0
+        self._latency_total = 0.
+        self._fidelity_total = 0.
+        self._reservoir = np.empty(reservoir_size)
+        self._reservoir_count = 0
+        # the sampling of the reservoir has its own generator, it does not change the random state of the simulation
+        self._rng = np.random.default_rng(seed)
+
+    def _consume(self, end_swapping):
+        # called by the right end node as soon as it knows the bell state of the pair, before the slots are freed
+        fidelity = e2e_fidelity(end_swapping)
+
+        # time since the end nodes freed the slots of the previous pair
+        latency = end_swapping.end_time - min(protocol.round_start for protocol in self.protocols["end_purifications"])
+        # the repeater has already released its pairs after the BSM
+        purification_success = all(protocol.success if protocol.success is not None else protocol.last_success
+                                   for protocol in self.protocols["purification"])
+
+        pair = StreamedPair(index = self._num_pairs, bell_index = end_swapping.final_bell_index, fidelity = fidelity,
+                            purification_success = purification_success, delivery_time = end_swapping.end_time,
+                            latency = latency)
+        self._num_pairs += 1
+        self._pending.append(pair)
+        self._record(pair)
+
+    def _record(self, pair):
+        if pair.index < self.warmup_pairs:
+            return
+        if self._steady_start is None:
+            # the rate is measured from the delivery of the first pair after the warm up
+            self._steady_start = pair.delivery_time
+            return
+
+        self._steady_pairs += 1
+        self._latency_total += pair.latency
+        self._fidelity_total += pair.fidelity
+
+        # reservoir sampling, every latency has the same probability to be in the sample
+        if self._reservoir_count < len(self._reservoir):
+            self._reservoir[self._reservoir_count] = pair.latency
+        else:
+            index = self._rng.integers(0, self._reservoir_count + 1)
+            if index < len(self._reservoir):
+                self._reservoir[index] = pair.latency
+        self._reservoir_count += 1
+
+    def pairs(self, max_pairs = None, max_sim_time = None):
+        # the simulation advances by chunks, only when the pairs of the previous chunk have been read
+        delivered = 0
+        while max_pairs is None or delivered < max_pairs:
+            if self._pending:
+                delivered += 1
+                yield self._pending.popleft()
+                continue
+
+            if max_sim_time is not None and ns.sim_time() >= max_sim_time:
+                return
+            duration = self.chunk_duration
+            if max_sim_time is not None:
+                duration = min(duration, max_sim_time - ns.sim_time())
+            ns.sim_run(duration = duration)
+
+    def __iter__(self):
+        return self.pairs()
+
+    def stats(self):
+        sample = self._reservoir[:min(self._reservoir_count, len(self._reservoir))]
+        elapsed = self.protocols["end"].end_time - self._steady_start if self._steady_start is not None else 0
+        return {
+            "pairs": self._num_pairs,
+            "steady_pairs": self._steady_pairs,
+            "sim_time": ns.sim_time(),
+            # the times of the simulation are in nsecs
+            "pairs_per_second": self._steady_pairs / elapsed * 1e9 if elapsed > 0 else None,
+            "mean_fidelity": self._fidelity_total / self._steady_pairs if self._steady_pairs > 0 else None,
+            "mean_latency": self._latency_total / self._steady_pairs if self._steady_pairs > 0 else None,
+            "latency_percentiles": {f"p{q}": float(np.percentile(sample, q)) for q in (50, 90, 99)}
+                                   if len(sample) > 0 else None,
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description = "Generate e2e pairs continuously and measure the steady state rate")
+    parser.add_argument("--pairs", type = int, default = 1000)
+    parser.add_argument("--warmup-pairs", type = int, default = 10)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--link-length", type = float, default = 30)
+    parser.add_argument("--p-lr", type = float, default = 0.9)
+    parser.add_argument("--p-m", type = float, default = 0.02)
+    parser.add_argument("--t-clock", type = float, default = 10)
+    parser.add_argument("--depolar-rate", type = float, default = 0.1)
+    parser.add_argument("--K-attempts", type = int, default = None)
+    parser.add_argument("--multiplexed", action = "store_true")
+    parser.add_argument("--slots-per-link", type = int, default = 2)
+    parser.add_argument("--sparse-source", action = "store_true")
+    parser.add_argument("--memory-depolar-rate", type = float, default = 0.)
+    parser.add_argument("--cutoff", type = float, default = None)
+    parser.add_argument("--chunk-duration", type = float, default = 1e7, help = "simulated nsecs between two reads")
+    args = parser.parse_args()
+
+    stream = PairStream(link_length = args.link_length, p_lr = args.p_lr, p_m = args.p_m, t_clock = args.t_clock,
+                        seed = args.seed, sparse_source = args.sparse_source, K_attempts = args.K_attempts,
+                        depolar_rate = args.depolar_rate, multiplexed = args.multiplexed,
+                        slots_per_link = args.slots_per_link, chunk_duration = args.chunk_duration,
+                        warmup_pairs = args.warmup_pairs, memory_depolar_rate = args.memory_depolar_rate,
+                        cutoff = args.cutoff)
+
+    # the pairs are only counted, the statistics are collected by the stream
+    for _ in stream.pairs(max_pairs = args.pairs + args.warmup_pairs):
+        pass
+
+    print(json.dumps(stream.stats(), indent = 2))
+
+if __name__ == '__main__':
+    main()
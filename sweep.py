@@ -0,0 +1,392 @@
+import argparse
+import glob
+import hashlib
+import itertools
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+import time
+
+import numpy as np
+
+# the parameters of a point of the sweep, with the values used when the spec does not set them
+DEFAULT_PARAMS = {
+    "link_length": 30,
+    "p_lr": 0.9,
+    "p_m": 0.02,
+    "t_clock": 10,
+    "depolar_rate": 0.1,
+    "K_attempts": None,
+    "sparse_source": False,
+    "num_hops": None,
+    "swap_order": "nested",
+    "multiplexed": False,
+    "slots_per_link": 2,
+    "memory_depolar_rate": 0.,
+    "cutoff": None,
+}
+
+def code_files():
+    # the results change when any module of the simulation changes, so all of them are part of the key of the cache.
+    # A module that does not affect the results only costs a recomputation, a missing one would serve stale results
+    directory = os.path.dirname(os.path.abspath(__file__))
+    return sorted(glob.glob(os.path.join(directory, "*.py")))
+
+def code_version():
+    digest = hashlib.sha256()
+    for path in code_files():
+        with open(path, "rb") as f:
+            digest.update(os.path.basename(path).encode())
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+def make_point(params):
+    unknown = set(params) - set(DEFAULT_PARAMS)
+    if unknown:
+        raise ValueError(f"Unknown parameters {sorted(unknown)}")
+    return {**DEFAULT_PARAMS, **params}
+
+def point_key(point, num_trials, seed, version):
+    content = json.dumps({"point": point, "trials": num_trials, "seed": seed, "version": version}, sort_keys = True)
+    return hashlib.sha256(content.encode()).hexdigest()[:32]
+
+def spec_key(spec, version):
+    content = json.dumps({"spec": spec, "version": version}, sort_keys = True)
+    return hashlib.sha256(content.encode()).hexdigest()[:32]
+
+def grid_points(grid, fixed = None):
+    # cartesian product of the values of every parameter in the grid
+    names = sorted(grid)
+    return [make_point({**(fixed or {}), **dict(zip(names, values))})
+            for values in itertools.product(*(grid[name] for name in names))]
+
+def _to_columns(results):
+    return {
+        "seed": np.array([result.seed for result in results], dtype = np.uint32),
+        "purification_success": np.array([result.purification_success for result in results], dtype = bool),
+        "final_bell_index": np.array([-1 if result.final_bell_index is None else result.final_bell_index
+                                      for result in results], dtype = np.int8),
+        "fidelity": np.array([np.nan if result.fidelity is None else result.fidelity for result in results]),
+        "e2e_time": np.array([np.nan if result.e2e_time is None else result.e2e_time for result in results]),
+    }
+
+class ResultCache:
+    """
+    This class stores the per-trial results of each point of a sweep in its own npz file
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok = True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.npz")
+
+    def has(self, key):
+        return os.path.exists(self.path(key))
+
+    def load(self, key):
+        with np.load(self.path(key)) as data:
+            point = json.loads(str(data["point"]))
+            columns = {name: data[name] for name in data.files if name != "point"}
+        return point, columns
+
+    def store(self, key, point, columns):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+
+        # the file appears only when it is complete, so a crashed job never leaves a partial result
+        fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path), suffix = ".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, point = np.array(json.dumps(point, sort_keys = True)), **columns)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def sweep_path(self, key):
+        return os.path.join(self.directory, "sweeps", f"{key}.json")
+
+    def store_sweep(self, key, points):
+        # the points chosen by an adaptive sweep depend on its results, collect reads them from here
+        path = self.sweep_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path), suffix = ".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(points, f, sort_keys = True)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def load_sweep(self, key):
+        path = self.sweep_path(key)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+def run_point(point, num_trials, seed, workers = None):
+    # imported here so that the queue and the cache can be used without netsquid
+    from trials import run_trials
+
+    return _to_columns(run_trials(num_trials = num_trials, seed = seed, workers = workers, **point))
+
+def run_sweep(points, cache, num_trials, seed = 0, workers = None, version = None):
+    if version is None:
+        version = code_version()
+
+    keys = []
+    for point in points:
+        key = point_key(point, num_trials, seed, version)
+        # the points already computed by a previous run are not computed again
+        if not cache.has(key):
+            cache.store(key, point, run_point(point, num_trials, seed, workers))
+        keys.append(key)
+    return keys
+
+def summarize_point(columns):
+    completed = columns["final_bell_index"] >= 0
+    return {
+        "trials": int(len(completed)),
+        "completed": float(np.mean(completed)) if len(completed) else np.nan,
+        "purification_success": float(np.mean(columns["purification_success"])) if len(completed) else np.nan,
+        "fidelity": float(np.nanmean(columns["fidelity"])) if completed.any() else np.nan,
+        "e2e_time": float(np.nanmean(columns["e2e_time"])) if completed.any() else np.nan,
+    }
+
+def collect(keys, cache):
+    # one row for each point, one column for each parameter and each summary value
+    rows = []
+    for key in keys:
+        point, columns = cache.load(key)
+        rows.append({**point, **summarize_point(columns)})
+
+    table = {}
+    for name in rows[0] if rows else []:
+        values = [row[name] for row in rows]
+        # the optional parameters can be None, they are stored as nan
+        table[name] = np.array([np.nan if value is None else value for value in values])
+    return table
+
+def adaptive_points(param, low, high, evaluate, fixed = None, initial = 5, tolerance = 0.02, max_rounds = 4,
+                    metric = "fidelity"):
+    # start from a coarse grid and add the middle point between two neighbours when the metric changes too much
+    values = list(np.linspace(low, high, initial))
+    for _ in range(max_rounds):
+        points = [make_point({**(fixed or {}), param: float(value)}) for value in values]
+        summaries = evaluate(points)
+
+        new_values = []
+        for (value_a, summary_a), (value_b, summary_b) in zip(zip(values, summaries), zip(values[1:], summaries[1:])):
+            if abs(summary_a[metric] - summary_b[metric]) > tolerance:
+                new_values.append((value_a + value_b) / 2)
+
+        if not new_values:
+            break
+        values = sorted(values + new_values)
+
+    return [make_point({**(fixed or {}), param: float(value)}) for value in values]
+
+class WorkQueue:
+    """
+    This class implements a queue of points on a sqlite file, shared by the workers of a sweep
+    """
+
+    def __init__(self, path, timeout = 60):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout = timeout, isolation_level = None)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS points (
+                key TEXT PRIMARY KEY,
+                point TEXT NOT NULL,
+                trials INTEGER NOT NULL,
+                seed INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                claimed_at REAL,
+                finished_at REAL
+            )""")
+
+    def close(self):
+        self.connection.close()
+
+    def add(self, points, num_trials, seed, version):
+        keys = []
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            for point in points:
+                key = point_key(point, num_trials, seed, version)
+                self.connection.execute("INSERT OR IGNORE INTO points (key, point, trials, seed) VALUES (?, ?, ?, ?)",
+                                        (key, json.dumps(point, sort_keys = True), num_trials, seed))
+                keys.append(key)
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return keys
+
+    def claim(self, worker, stale_after = None):
+        # the write lock is taken before reading, so two workers never claim the same point
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.connection.execute("SELECT key, point, trials, seed FROM points WHERE status = 'pending' LIMIT 1").fetchone()
+            if row is None and stale_after is not None:
+                # a point claimed long ago belongs to a worker that crashed
+                row = self.connection.execute("SELECT key, point, trials, seed FROM points "
+                                              "WHERE status = 'running' AND claimed_at < ? LIMIT 1",
+                                              (now - stale_after,)).fetchone()
+            if row is not None:
+                self.connection.execute("UPDATE points SET status = 'running', worker = ?, claimed_at = ? WHERE key = ?",
+                                        (worker, now, row[0]))
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+
+        if row is None:
+            return None
+        key, point, num_trials, seed = row
+        return key, json.loads(point), num_trials, seed
+
+    def finish(self, key, status = "done"):
+        self.connection.execute("UPDATE points SET status = ?, finished_at = ? WHERE key = ?", (status, time.time(), key))
+
+    def counts(self):
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM points GROUP BY status").fetchall())
+
+def run_worker(queue, cache, workers = None, name = None, stale_after = None):
+    if name is None:
+        name = f"{socket.gethostname()}:{os.getpid()}"
+
+    done = 0
+    while True:
+        claimed = queue.claim(name, stale_after = stale_after)
+        if claimed is None:
+            return done
+
+        key, point, num_trials, seed = claimed
+        # another worker may have already stored it before crashing
+        if not cache.has(key):
+            try:
+                cache.store(key, point, run_point(point, num_trials, seed, workers))
+            except Exception:
+                queue.finish(key, status = "failed")
+                raise
+        queue.finish(key)
+        done += 1
+
+def load_spec(path):
+    with open(path) as f:
+        return json.load(f)
+
+def spec_points(spec, cache = None, workers = None, version = None):
+    fixed = spec.get("fixed", {})
+    if "grid" in spec:
+        return grid_points(spec["grid"], fixed)
+
+    adaptive = dict(spec["adaptive"])
+    if cache is None:
+        raise ValueError("An adaptive sweep must be run locally")
+    if version is None:
+        version = code_version()
+
+    num_trials = spec.get("trials", 100)
+    seed = spec.get("seed", 0)
+
+    def evaluate(points):
+        keys = run_sweep(points, cache, num_trials, seed = seed, workers = workers, version = version)
+        return [summarize_point(cache.load(key)[1]) for key in keys]
+
+    points = adaptive_points(evaluate = evaluate, fixed = fixed, **adaptive)
+    cache.store_sweep(spec_key(spec, version), points)
+    return points
+
+def computed_keys(spec, cache, version = None):
+    # keys of the points of a sweep that has already been computed, by run or by the workers of a queue
+    if version is None:
+        version = code_version()
+    if "grid" in spec:
+        points = spec_points(spec)
+    else:
+        # the points of an adaptive sweep are only known once it has run
+        points = cache.load_sweep(spec_key(spec, version))
+        if points is None:
+            raise RuntimeError("The adaptive sweep has not been run with this spec and this version of the code, "
+                               "use the run command first")
+    keys = [point_key(point, spec.get("trials", 100), spec.get("seed", 0), version) for point in points]
+    missing = [key for key in keys if not cache.has(key)]
+    if missing:
+        raise RuntimeError(f"{len(missing)} points of the sweep are not computed yet")
+    return keys
+
+def save_table(path, table):
+    np.savez(path, **table)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Parameter sweeps of the repeater network with an on-disk cache")
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+
+    run_parser = subparsers.add_parser("run", help = "run the sweep in this process")
+    enqueue_parser = subparsers.add_parser("enqueue", help = "add the points of a grid sweep to a work queue")
+    work_parser = subparsers.add_parser("work", help = "run the points of a work queue")
+    collect_parser = subparsers.add_parser("collect", help = "collect the results of a sweep in one table")
+
+    for sub in [run_parser, enqueue_parser, collect_parser]:
+        sub.add_argument("spec", help = "json file with the grid or the adaptive sampling, the fixed parameters, "
+                                        "the number of trials and the seed")
+    for sub in [run_parser, work_parser, collect_parser]:
+        sub.add_argument("--cache", required = True, help = "directory of the results")
+    for sub in [enqueue_parser, work_parser]:
+        sub.add_argument("--queue", required = True, help = "sqlite file of the work queue")
+    for sub in [run_parser, work_parser]:
+        sub.add_argument("--workers", type = int, default = None, help = "processes used for the trials of a point")
+    for sub in [run_parser, collect_parser]:
+        sub.add_argument("--output", default = None, help = "npz file with one row for each point")
+    work_parser.add_argument("--stale-after", type = float, default = None,
+                             help = "seconds after which a running point is considered abandoned")
+
+    args = parser.parse_args()
+    version = code_version()
+
+    if args.command == "work":
+        queue = WorkQueue(args.queue)
+        done = run_worker(queue, ResultCache(args.cache), workers = args.workers, stale_after = args.stale_after)
+        print(f"Computed {done} points, queue status: {queue.counts()}")
+        queue.close()
+        return
+
+    spec = load_spec(args.spec)
+    num_trials = spec.get("trials", 100)
+    seed = spec.get("seed", 0)
+
+    if args.command == "enqueue":
+        if "grid" not in spec:
+            raise ValueError("Only grid sweeps can be enqueued")
+        queue = WorkQueue(args.queue)
+        queue.add(grid_points(spec["grid"], spec.get("fixed", {})), num_trials, seed, version)
+        print(f"Queue status: {queue.counts()}")
+        queue.close()
+        return
+
+    cache = ResultCache(args.cache)
+    if args.command == "run":
+        points = spec_points(spec, cache = cache, workers = args.workers, version = version)
+        keys = run_sweep(points, cache, num_trials, seed = seed, workers = args.workers, version = version)
+    else:
+        keys = computed_keys(spec, cache, version = version)
+
+    table = collect(keys, cache)
+    if args.output is not None:
+        save_table(args.output, table)
+    else:
+        for index in range(len(keys)):
+            print({name: table[name][index].item() for name in table})
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+import netsquid as ns
+
+from chain import setup_chain_network
+from main import setup_network, start_protocols, stop_protocols
+from probes import PROBES
+
+class NetworkTemplate:
+    """
+    This class builds a network and its protocols once, then resets them before every trial
+    """
+
+    def __init__(self, num_hops = None, swap_order = "nested", **params):
+        # the protocols are started by reset, at the beginning of every trial
+        if num_hops is None:
+            self.net, self.protocols = setup_network(start = False, **params)
+        else:
+            self.net, self.protocols = setup_chain_network(num_hops = num_hops, swap_order = swap_order, start = False,
+                                                           **params)
+
+        self.nodes = list(self.net.nodes.values())
+        self.sources = [connection.subcomponents["EPS"] for connection in self.net.connections.values()
+                        if "EPS" in connection.subcomponents]
+
+    def reset(self, seed = None):
+        stop_protocols(self.protocols)
+        ns.sim_reset()
+
+        if seed is not None:
+            ns.set_random_state(seed = seed)
+            # the sampling of the probes is reproducible too
+            PROBES.seed(seed)
+
+        for node in self.nodes:
+            # discard the qubits of the previous trial
+            node.qmemory.reset()
+            # and the messages nobody read, like the photons arrived after the latched one
+            node.clear_mailboxes()
+
+        for source in self.sources:
+            source.status = ns.components.SourceStatus.OFF
+
+        start_protocols(self.protocols)
+
+    def run(self, seed = None):
+        self.reset(seed = seed)
+        ns.sim_run()
+        return self.protocols
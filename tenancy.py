@@ -0,0 +1,453 @@
+import argparse
+import collections
+import json
+import math
+
+import netsquid as ns
+import numpy as np
+
+from ent_swapping import EntSwapping, e2e_fidelity
+from instrumentation import instrumented
+from main import start_protocols
+from ms_protocol import get_EPS_connection
+from node import NetNode
+from probes import PROBES
+from purification import PurificationProtocol
+
+# order in which the queued requests are served
+POLICIES = ["fifo", "edf", "fidelity"]
+
+class PairRequest:
+    """
+    This class represents the request of an e2e pair between two end nodes, with its state and its metrics
+    """
+
+    def __init__(self, request_id, source, destination, min_fidelity = 0., deadline = None, arrival_time = 0.):
+        if source == destination:
+            raise ValueError("The source and the destination of a request must be different")
+
+        self.request_id = request_id
+        self.source = source
+        self.destination = destination
+        self.min_fidelity = min_fidelity
+        # absolute simulation time in nsecs, None if the request can wait forever
+        self.deadline = deadline
+        self.arrival_time = arrival_time
+
+        # queued -> active -> served, or expired if the deadline passes in the queue, or failed after too many attempts
+        self.status = "created"
+        self.start_time = None
+        self.end_time = None
+        self.attempts = 0
+        self.fidelity = None
+        self.bell_index = None
+
+    @property
+    def route(self):
+        return (self.source, self.destination)
+
+    @property
+    def queueing_delay(self):
+        return self.start_time - self.arrival_time if self.start_time is not None else None
+
+    @property
+    def met_deadline(self):
+        if self.status != "served":
+            return False
+        return self.deadline is None or self.end_time <= self.deadline
+
+    def to_dict(self):
+        return {
+            "request_id": self.request_id,
+            "source": self.source,
+            "destination": self.destination,
+            "min_fidelity": self.min_fidelity,
+            "deadline": self.deadline,
+            "arrival_time": self.arrival_time,
+            "status": self.status,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "attempts": self.attempts,
+            "fidelity": self.fidelity,
+            "bell_index": self.bell_index,
+            "queueing_delay": self.queueing_delay,
+            "met_deadline": self.met_deadline,
+        }
+
+def setup_star_network(num_end_nodes, link_length, p_lr, p_m, t_clock, repeater_slots = None, slots_per_link = 2,
+                       sparse_source = False, depolar_rate = 0.1):
+    # every end node has a single link to the repeater in the middle, on the nic of the repeater with its index
+    net = ns.nodes.Network("Quantum Star Network")
+
+    if repeater_slots is None:
+        repeater_slots = num_end_nodes * slots_per_link
+    # a request holds the slots of both its links on the repeater, with less memory no request could ever start
+    if repeater_slots < 2 * slots_per_link:
+        raise ValueError(f"The repeater needs at least {2 * slots_per_link} slots to serve a request, "
+                         f"found {repeater_slots}")
+
+    repeater = NetNode(ID = 0, name = "Repeater", slots_per_link = slots_per_link, num_links = num_end_nodes,
+                       num_positions = repeater_slots)
+    end_nodes = [NetNode(ID = index + 1, name = f"End_{index}", is_repeater = False, slots_per_link = slots_per_link)
+                 for index in range(num_end_nodes)]
+    net.add_node(repeater)
+    net.add_nodes(end_nodes)
+
+    eps_connections = []
+    for index, end_node in enumerate(end_nodes):
+        channel_to_end = ns.components.ClassicalChannel(f"channel_repeater_to_{index}", length = link_length,
+                                                        models = {"delay_model": ns.components.models.FibreDelayModel()})
+        channel_to_repeater = ns.components.ClassicalChannel(f"channel_{index}_to_repeater", length = link_length,
+                                                             models = {"delay_model": ns.components.models.FibreDelayModel()})
+        classical_conn = ns.nodes.DirectConnection(f"classical_conn_{index}", channel_to_end, channel_to_repeater)
+        net.add_connection(node1 = repeater, node2 = end_node, connection = classical_conn,
+                           port_name_node1 = f"c{index}", port_name_node2 = "c0", label = f"classical_conn_{index}")
+
+        # the EPS of every link is controlled by the repeater
+        eps_conn = get_EPS_connection(t_clock = t_clock, p_m = p_m, p_lr = p_lr, length = link_length,
+                                      sparse = sparse_source, depolar_rate = depolar_rate)
+        net.add_connection(node1 = repeater, node2 = end_node, connection = eps_conn,
+                           port_name_node1 = f"q{index}", port_name_node2 = "q0", label = f"eps_conn_{index}")
+        eps_connections.append(eps_conn)
+
+    return net, repeater, end_nodes, eps_connections
+
+class ReleaseRelay(ns.protocols.NodeProtocol):
+    """
+    This class waits for the RELEASE of a consumed pair on a classical port, frees the slots of its node and forwards
+    the message to the next node
+    """
+
+    def __init__(self, node, in_port, on_release, out_port = None, name = None):
+        super().__init__(node = node, name = name)
+        self.in_port = in_port
+        self.on_release = on_release
+        self.out_port = out_port
+
+    @instrumented
+    def run(self):
+        # the port is shared with the protocols of the link, the message waits in the mailbox of the node
+        yield from self.node.receive(self, self.in_port, ("RELEASE",))
+        if self.out_port is not None:
+            self.node.ports[self.out_port].tx_output(ns.components.Message(items = ["RELEASE"]))
+        self.on_release()
+
+class RequestScheduler(ns.pydynaa.Entity):
+    """
+    This class serves the pair requests of the end nodes of a star, sharing the memory of the repeater and the links
+    """
+
+    _EVTYPE_DEADLINE = ns.pydynaa.EventType("REQUEST_DEADLINE", "The deadline of a queued request has passed")
+
+    def __init__(self, net, repeater, end_nodes, eps_connections, link_length, p_lr, p_m, t_clock, policy = "fifo",
+                 K_attempts = None, multiplexed = False, max_attempts = 10):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy {policy}, the policies are {POLICIES}")
+
+        self.net = net
+        self.repeater = repeater
+        self.end_nodes = end_nodes
+        self.eps_connections = eps_connections
+        self.link_length = link_length
+        self.t_clock = t_clock
+        self.policy = policy
+        self.multiplexed = multiplexed
+        # attempts of a request whose pairs are below its minimum fidelity, then it fails
+        self.max_attempts = max_attempts
+
+        if K_attempts is None:
+            K_attempts = math.ceil((1/p_m*p_lr))
+        self.K_attempts = K_attempts
+
+        self.slots_per_link = repeater.slots_per_link
+        self._free_slots = list(range(repeater.qmemory.num_positions))
+        self._busy_links = set()
+
+        self.requests = []
+        self._queue = []
+        # request id -> (memory positions on the repeater, protocols of the current attempt)
+        self._active = {}
+        # mean fidelity of the pairs delivered on each route, used by the fidelity aware policy
+        self._fidelity_sums = collections.defaultdict(lambda: [0., 0])
+
+        self._deadline_handler = ns.pydynaa.EventHandler(self._on_deadline)
+
+        for node in [repeater] + end_nodes:
+            node.program_scheduler.start()
+
+    def submit(self, request):
+        request.status = "queued"
+        request.arrival_time = ns.sim_time()
+        self.requests.append(request)
+        self._queue.append(request)
+        # a request can expire while nothing arrives or completes, so its deadline is an event of its own
+        if request.deadline is not None and request.deadline > ns.sim_time():
+            event = self._schedule_at(request.deadline, self._EVTYPE_DEADLINE)
+            self._wait_once(self._deadline_handler, event = event)
+        self._dispatch()
+
+    def _on_deadline(self, event):
+        self._dispatch()
+
+    def _fidelity_estimate(self, route):
+        total, count = self._fidelity_sums[route]
+        return total / count if count > 0 else None
+
+    def _priority(self, request):
+        deadline = request.deadline if request.deadline is not None else math.inf
+        if self.policy == "fifo":
+            return (request.arrival_time,)
+        if self.policy == "edf":
+            return (deadline, request.arrival_time)
+        # the requests that the route is not able to satisfy are served only when nothing else can be served
+        estimate = self._fidelity_estimate(request.route)
+        unlikely = estimate is not None and estimate < request.min_fidelity
+        return (unlikely, deadline, request.arrival_time)
+
+    def _can_start(self, request):
+        return (request.source not in self._busy_links and request.destination not in self._busy_links
+                and len(self._free_slots) >= 2 * self.slots_per_link)
+
+    def _dispatch(self):
+        # the requests whose deadline is already passed are dropped, a request cannot be served at its deadline
+        now = ns.sim_time()
+        for request in [request for request in self._queue if request.deadline is not None and request.deadline <= now]:
+            request.status = "expired"
+            self._queue.remove(request)
+
+        # a blocked request does not stop the following ones whose links are free
+        for request in sorted(self._queue, key = self._priority):
+            if self._can_start(request):
+                self._queue.remove(request)
+                self._start(request)
+
+    def _start(self, request):
+        request.status = "active"
+        request.start_time = ns.sim_time()
+        self._busy_links.update(request.route)
+
+        positions = [self._free_slots.pop(0) for _ in range(2 * self.slots_per_link)]
+        self._active[request.request_id] = (positions, None)
+        self._launch(request)
+
+    def _launch(self, request):
+        positions, _ = self._active[request.request_id]
+        source, destination = request.route
+        # a route serves one request at a time, so its protocols are named after it: the names of the tracer and
+        # of the program schedulers do not grow with the number of requests
+        name = f"{source}_{destination}"
+
+        purification_params = {"K_attempts": self.K_attempts, "t_clock": self.t_clock, "link_length": self.link_length,
+                               "multiplexed": self.multiplexed}
+        purif_source = PurificationProtocol(node = self.end_nodes[source], name = f"PP_source_{name}", connection = None,
+                                            nic_index = 0, **purification_params)
+        purif_rep_source = PurificationProtocol(node = self.repeater, name = f"PP_rep_source_{name}",
+                                                connection = self.eps_connections[source], nic_index = source,
+                                                mem_positions = positions[:self.slots_per_link], **purification_params)
+        purif_rep_destination = PurificationProtocol(node = self.repeater, name = f"PP_rep_destination_{name}",
+                                                     connection = self.eps_connections[destination],
+                                                     nic_index = destination,
+                                                     mem_positions = positions[self.slots_per_link:],
+                                                     **purification_params)
+        purif_destination = PurificationProtocol(node = self.end_nodes[destination], name = f"PP_destination_{name}",
+                                                 connection = None, nic_index = 0, **purification_params)
+
+        # the repeater sends the outcome of the BSM on the link of the destination
+        swapping_repeater = EntSwapping(node = self.repeater, purif_to_wait = [purif_rep_source, purif_rep_destination],
+                                        name = f"ent_swapping_repeater_{name}", is_left = True,
+                                        outcome_port = f"c{destination}")
+        swapping_destination = EntSwapping(node = self.end_nodes[destination], purif_to_wait = [purif_destination],
+                                           name = f"ent_swapping_destination_{name}", is_left = False)
+        swapping_repeater.set_swap_to_wait(swapping_destination)
+        swapping_destination.set_swap_to_wait(swapping_repeater)
+        swapping_destination.set_end_purifications([purif_source, purif_destination])
+        swapping_destination.consumer = lambda swapping: self._complete(request, swapping)
+
+        protocols = {
+            "standalone": [purif_source],
+            "schedulers": [],
+            "purification": [purif_source, purif_rep_source, purif_rep_destination, purif_destination],
+            "swapping": [swapping_repeater, swapping_destination],
+            "end_purifications": [purif_source, purif_destination],
+        }
+        self._active[request.request_id] = (positions, protocols)
+        start_protocols(protocols)
+
+    @staticmethod
+    def _free_memory(node, positions = None):
+        for position in list(node.qmemory.used_positions):
+            if positions is None or position in positions:
+                node.qmemory.pop(positions=[position])
+
+    def _complete(self, request, swapping):
+        # called by the destination as soon as it knows the bell state of the pair
+        fidelity = e2e_fidelity(swapping)
+
+        request.attempts += 1
+        sums = self._fidelity_sums[request.route]
+        sums[0] += fidelity
+        sums[1] += 1
+
+        deadline_passed = request.deadline is not None and ns.sim_time() > request.deadline
+        # the pair is discarded and the same links try again
+        retry = fidelity < request.min_fidelity and not deadline_passed and request.attempts < self.max_attempts
+        if not retry:
+            request.status = "served" if fidelity >= request.min_fidelity else "failed"
+            request.end_time = ns.sim_time()
+            request.fidelity = fidelity
+            request.bell_index = swapping.final_bell_index
+
+        # the destination consumed its qubit, the repeater and the source free theirs only when the RELEASE
+        # message arrives over the links
+        source, destination = request.route
+        name = f"{source}_{destination}"
+        self._free_memory(self.end_nodes[destination])
+        ReleaseRelay(self.repeater, f"c{destination}", lambda: self._repeater_released(request, retry),
+                     out_port = f"c{source}", name = f"release_repeater_{name}").start()
+        ReleaseRelay(self.end_nodes[source], "c0", lambda: self._source_released(request, retry),
+                     name = f"release_source_{name}").start()
+        self.end_nodes[destination].ports["c0"].tx_output(ns.components.Message(items = ["RELEASE"]))
+
+    def _repeater_released(self, request, retry):
+        positions, _ = self._active[request.request_id]
+        self._free_memory(self.repeater, positions)
+        if retry:
+            return
+        # the slots and the link of the destination can serve another request
+        self._free_slots.extend(positions)
+        self._busy_links.discard(request.destination)
+        self._dispatch()
+
+    def _source_released(self, request, retry):
+        self._free_memory(self.end_nodes[request.source])
+        if retry:
+            self._launch(request)
+            return
+        del self._active[request.request_id]
+        self._busy_links.discard(request.source)
+        self._dispatch()
+
+    def report(self):
+        elapsed = ns.sim_time()
+        served = [request for request in self.requests if request.status == "served"]
+        statuses = collections.Counter(request.status for request in self.requests)
+        delays = np.array([request.queueing_delay for request in served])
+
+        per_route = {}
+        for route in sorted({request.route for request in self.requests}):
+            route_requests = [request for request in self.requests if request.route == route]
+            route_served = [request for request in route_requests if request.status == "served"]
+            per_route[f"{route[0]}->{route[1]}"] = {
+                "requests": len(route_requests),
+                "served": len(route_served),
+                # served pairs per second of simulated time
+                "throughput": len(route_served) / elapsed * 1e9 if elapsed > 0 else None,
+                "mean_queueing_delay": float(np.mean([request.queueing_delay for request in route_served]))
+                                       if route_served else None,
+            }
+
+        return {
+            "policy": self.policy,
+            "requests": len(self.requests),
+            "statuses": dict(statuses),
+            "throughput": len(served) / elapsed * 1e9 if elapsed > 0 else None,
+            "deadline_met": sum(request.met_deadline for request in self.requests),
+            "queueing_delay": {f"p{q}": float(np.percentile(delays, q)) for q in (50, 90, 99)} if len(delays) else None,
+            "mean_queueing_delay": float(np.mean(delays)) if len(delays) else None,
+            "mean_service_time": float(np.mean([request.end_time - request.start_time for request in served]))
+                                 if served else None,
+            "mean_fidelity": float(np.mean([request.fidelity for request in served])) if served else None,
+            "per_route": per_route,
+        }
+
+class RequestArrivals(ns.protocols.Protocol):
+    """
+    This class submits the requests to the scheduler at their arrival times
+    """
+
+    def __init__(self, scheduler, requests, name = "request_arrivals"):
+        super().__init__(name = name)
+        self.scheduler = scheduler
+        self.requests = sorted(requests, key = lambda request: request.arrival_time)
+
+    def run(self):
+        for request in self.requests:
+            if request.arrival_time > ns.sim_time():
+                yield self.await_timer(end_time = request.arrival_time)
+            self.scheduler.submit(request)
+
+def poisson_requests(num_end_nodes, rate, duration, rng, min_fidelity = (0., 0.), deadline_slack = None):
+    # rate is in requests per second, the times in nsecs
+    requests = []
+    time = rng.exponential(1e9 / rate)
+    while time < duration:
+        source, destination = rng.choice(num_end_nodes, size = 2, replace = False)
+        requests.append(PairRequest(request_id = len(requests), source = int(source), destination = int(destination),
+                                    min_fidelity = float(rng.uniform(*min_fidelity)),
+                                    deadline = time + deadline_slack if deadline_slack is not None else None,
+                                    arrival_time = time))
+        time += rng.exponential(1e9 / rate)
+    return requests
+
+def run_tenancy(num_end_nodes, link_length, p_lr, p_m, t_clock, rate, duration, policy = "fifo", repeater_slots = None,
+                slots_per_link = 2, min_fidelity = (0., 0.), deadline_slack = None, seed = 0, K_attempts = None,
+                sparse_source = False, depolar_rate = 0.1, multiplexed = False, max_sim_time = None):
+    ns.sim_reset()
+    ns.set_qstate_formalism(ns.QFormalism.DM)
+    ns.set_random_state(seed = seed)
+    PROBES.seed(seed)
+
+    net, repeater, end_nodes, eps_connections = setup_star_network(
+        num_end_nodes = num_end_nodes, link_length = link_length, p_lr = p_lr, p_m = p_m, t_clock = t_clock,
+        repeater_slots = repeater_slots, slots_per_link = slots_per_link, sparse_source = sparse_source,
+        depolar_rate = depolar_rate)
+    scheduler = RequestScheduler(net, repeater, end_nodes, eps_connections, link_length = link_length, p_lr = p_lr,
+                                 p_m = p_m, t_clock = t_clock, policy = policy, K_attempts = K_attempts,
+                                 multiplexed = multiplexed)
+
+    # the requests have their own generator, so the same load is offered to every policy
+    requests = poisson_requests(num_end_nodes, rate, duration, np.random.default_rng(seed), min_fidelity = min_fidelity,
+                                deadline_slack = deadline_slack)
+    RequestArrivals(scheduler, requests).start()
+
+    if max_sim_time is None:
+        ns.sim_run()
+    else:
+        ns.sim_run(end_time = max_sim_time)
+
+    return scheduler.report()
+
+def main():
+    parser = argparse.ArgumentParser(description = "Serve the pair requests of several end nodes sharing a repeater")
+    parser.add_argument("--end-nodes", type = int, default = 4)
+    parser.add_argument("--repeater-slots", type = int, default = None, help = "memory of the repeater, all the links by default")
+    parser.add_argument("--slots-per-link", type = int, default = 2)
+    parser.add_argument("--rate", type = float, default = 1000, help = "requests per second")
+    parser.add_argument("--duration", type = float, default = 1e8, help = "nsecs in which the requests arrive")
+    parser.add_argument("--policy", choices = POLICIES, default = "fifo")
+    parser.add_argument("--min-fidelity", type = float, nargs = 2, default = (0., 0.), metavar = ("LOW", "HIGH"))
+    parser.add_argument("--deadline-slack", type = float, default = None, help = "nsecs between arrival and deadline")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--link-length", type = float, default = 30)
+    parser.add_argument("--p-lr", type = float, default = 0.9)
+    parser.add_argument("--p-m", type = float, default = 0.02)
+    parser.add_argument("--t-clock", type = float, default = 10)
+    parser.add_argument("--depolar-rate", type = float, default = 0.1)
+    parser.add_argument("--K-attempts", type = int, default = None)
+    parser.add_argument("--multiplexed", action = "store_true")
+    parser.add_argument("--sparse-source", action = "store_true")
+    parser.add_argument("--max-sim-time", type = float, default = None)
+    args = parser.parse_args()
+
+    report = run_tenancy(num_end_nodes = args.end_nodes, link_length = args.link_length, p_lr = args.p_lr,
+                         p_m = args.p_m, t_clock = args.t_clock, rate = args.rate, duration = args.duration,
+                         policy = args.policy, repeater_slots = args.repeater_slots,
+                         slots_per_link = args.slots_per_link, min_fidelity = tuple(args.min_fidelity),
+                         deadline_slack = args.deadline_slack, seed = args.seed, K_attempts = args.K_attempts,
+                         sparse_source = args.sparse_source, depolar_rate = args.depolar_rate,
+                         multiplexed = args.multiplexed, max_sim_time = args.max_sim_time)
+
+    print(json.dumps(report, indent = 2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+
+from attempt_store import AttemptReader, AttemptStore
+
+def write(store, trials, attempt = 3):
+    for trial in trials:
+        store.trial = trial
+        store.record(run_start = 0., window_start = 10., window_end = 10. + trial, node = "repeater",
+                     protocol = f"MSProtocol_{trial % 2}", window = 1, k_attempts = 20, attempt = attempt,
+                     other_attempt = attempt, latched = 1, matched = 1)
+
+def chunk_sizes(reader):
+    return [len(chunk) for chunk in reader.chunks()]
+
+def test_records_survive_a_reopen_across_chunks(tmp_path):
+    directory = os.path.join(tmp_path, "run_a", "process_1")
+    # the buffer is flushed in the middle of a chunk and the chunks are smaller than a run
+    store = AttemptStore(buffer_records = 4, chunk_records = 5)
+    store.open(directory)
+    write(store, range(12))
+    store.close()
+    assert chunk_sizes(AttemptReader(tmp_path)) == [5, 5, 2]
+
+    # a new store appends to the partial chunk, with the chunk size of the meta
+    store = AttemptStore(buffer_records = 3, chunk_records = 100)
+    store.open(directory)
+    write(store, range(12, 16), attempt = 7)
+    store.close()
+
+    reader = AttemptReader(tmp_path)
+    assert chunk_sizes(reader) == [5, 5, 5, 1]
+    assert len(reader) == 16
+    records = np.concatenate(list(reader.chunks()))
+    assert records["trial"].tolist() == list(range(16))
+    assert records["window_end"].tolist() == [10. + trial for trial in range(16)]
+    assert reader.names[directory] == ["repeater", "MSProtocol_0", "MSProtocol_1"]
+    assert records["protocol"].tolist() == [1 + trial % 2 for trial in range(16)]
+
+    distribution = reader.attempt_distribution()
+    assert distribution[3] == 12 and distribution[7] == 4 and distribution.sum() == 16
+
+def test_reader_maps_the_stores_of_every_run(tmp_path):
+    for run in ("run_a", "run_b"):
+        store = AttemptStore(buffer_records = 2, chunk_records = 3)
+        store.open(os.path.join(tmp_path, run, "process_1"))
+        write(store, range(4))
+        store.close()
+
+    reader = AttemptReader(tmp_path)
+    assert len(reader.directories) == 2
+    assert len(reader) == 8
+    assert reader.window_success_rates()["rates"][1] == 1.
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from bell_diagonal import B00, BellDiagonalEngine, _window_probabilities, compose, link_state, purify, swap
+
+def werner(fidelity):
+    state = np.full(4, (1 - fidelity) / 3)
+    state[B00] = fidelity
+    return state
+
+def test_link_state_is_normalized():
+    assert np.allclose(link_state(0.), [1, 0, 0, 0])
+    state = link_state(0.1)
+    assert state.sum() == pytest.approx(1)
+    # both the photons are depolarized
+    assert state[B00] == pytest.approx(0.81 + 0.19 / 4)
+
+@pytest.mark.parametrize("fidelity", [0.6, 0.75, 0.9])
+def test_purify_werner_matches_bbpssw(fidelity):
+    n = 20000
+    states = np.tile(werner(fidelity), (n, 1))
+    state, matched = purify(states, states, np.random.default_rng(0))
+
+    # closed form of BBPSSW without twirling
+    e = (1 - fidelity) / 3
+    p_success = fidelity ** 2 + 2 * fidelity * e + 5 * e ** 2
+    assert matched.mean() == pytest.approx(p_success, abs = 0.01)
+    assert np.allclose(state[matched, B00], (fidelity ** 2 + e ** 2) / p_success)
+
+    # the state after a mismatch is still a normalized bell diagonal state
+    assert np.allclose(state.sum(axis = 1), 1)
+
+def test_purify_deterministic_cases():
+    rng = np.random.default_rng(0)
+    perfect = np.array([1., 0, 0, 0])
+    state, matched = purify(perfect, perfect, rng)
+    assert matched
+    assert np.allclose(state, perfect)
+
+    # a bit flip on one pair always gives different outcomes
+    bit_flip = np.array([0., 1, 0, 0])
+    _, matched = purify(perfect, bit_flip, rng)
+    assert not matched
+
+def test_swap_composes_the_errors():
+    fidelity_left, fidelity_right = 0.9, 0.8
+    state, outcome = swap(werner(fidelity_left)[None], werner(fidelity_right)[None], np.random.default_rng(0))
+    expected = fidelity_left * fidelity_right + (1 - fidelity_left) * (1 - fidelity_right) / 3
+    assert state[0, B00] == pytest.approx(expected)
+    assert state.sum() == pytest.approx(1)
+    assert 0 <= outcome[0] < 4
+
+def test_compose_is_xor_of_the_indices():
+    for i in range(4):
+        for j in range(4):
+            state = compose(np.eye(4)[i], np.eye(4)[j])
+            assert np.allclose(state, np.eye(4)[i ^ j])
+
+def test_engine_is_reproducible():
+    engine = BellDiagonalEngine(link_length = 30, p_lr = 0.9, p_m = 0.02, t_clock = 10)
+    first = engine.run(1000, seed = 1, chunk_size = 300)
+    assert len(first["fidelity"]) == 1000
+    assert np.all((first["fidelity"] >= 0) & (first["fidelity"] <= 1))
+    assert np.all(first["e2e_time"] > 0)
+    assert np.array_equal(first["fidelity"], engine.run(1000, seed = 1, chunk_size = 300)["fidelity"])
+
+def test_engine_rejects_impossible_links():
+    with pytest.raises(ValueError):
+        BellDiagonalEngine(link_length = 30, p_lr = 0., p_m = 0.02, t_clock = 10, K_attempts = 1)
+
+def test_window_probabilities_match_the_dense_source():
+    # pulse by pulse simulation of the dense source on the clock grid: a pair with p_m, independent losses, every
+    # node latches the first photon of the window
+    p_m, p_lr, K_attempts, pulses_per_attempt = 0.2, 0.7, 3, 4
+    rng = np.random.default_rng(0)
+    trials, pulses = 200000, K_attempts * pulses_per_attempt
+    pairs = rng.random((trials, pulses)) < p_m
+    left = pairs & (rng.random((trials, pulses)) < p_lr)
+    right = pairs & (rng.random((trials, pulses)) < p_lr)
+
+    latched = left.any(axis = 1) & right.any(axis = 1)
+    first_left, first_right = left.argmax(axis = 1), right.argmax(axis = 1)
+    same_pulse = latched & (first_left == first_right)
+    other_pulse = (latched & (first_left != first_right)
+                   & (first_left // pulses_per_attempt == first_right // pulses_per_attempt))
+
+    p_same_pulse, p_other_pulse = _window_probabilities(p_m, p_lr, K_attempts, pulses_per_attempt)
+    assert same_pulse.mean() == pytest.approx(p_same_pulse, abs = 4e-3)
+    assert other_pulse.mean() == pytest.approx(p_other_pulse, abs = 4e-3)
@@ -0,0 +1,28 @@
+from benchmark import compare
+
+def case(formalism = "DM", completed = 20, wall_per_pair = 1., events_per_second = 1000., **fields):
+    return {"formalism": formalism, "link_length": 10, "p_m": 0.02, "num_hops": None, "completed": completed,
+            "wall_per_pair": wall_per_pair, "events_per_second": events_per_second, "peak_rss_mb": 100., **fields}
+
+def metrics(regressions):
+    return sorted((regression["formalism"], regression["metric"]) for regression in regressions)
+
+def test_changes_within_the_tolerance_are_not_regressions():
+    baseline = {"cases": [case()]}
+    results = {"cases": [case(wall_per_pair = 1.05, events_per_second = 960.)]}
+    assert compare(results, baseline, tolerance = 0.1) == []
+
+def test_slower_cases_are_regressions():
+    baseline = {"cases": [case()]}
+    results = {"cases": [case(wall_per_pair = 1.5, events_per_second = 500.)]}
+    assert metrics(compare(results, baseline)) == [("DM", "events_per_second"), ("DM", "wall_per_pair")]
+
+def test_new_errors_missing_cases_and_fewer_pairs_are_regressions():
+    baseline = {"cases": [case("DM"), case("KET"), case("STAB")]}
+    results = {"cases": [{**case("DM"), "error": "ValueError: unsupported"}, case("KET", completed = 15)]}
+    assert metrics(compare(results, baseline)) == [("DM", "error"), ("KET", "completed"), ("STAB", "missing")]
+
+def test_cases_without_a_baseline_and_old_errors_are_ignored():
+    baseline = {"cases": [{**case("DM"), "error": "ValueError: unsupported"}]}
+    results = {"cases": [{**case("DM"), "error": "ValueError: unsupported"}, case("KET")]}
+    assert compare(results, baseline) == []
@@ -0,0 +1,111 @@
+import pytest
+
+from instrumentation import BIN_EDGES, METRICS, NUM_BINS, Histogram, Metrics, _bin_index, instrumented, load
+
+@pytest.fixture
+def metrics():
+    METRICS.reset()
+    METRICS.enabled = True
+    yield METRICS
+    METRICS.reset()
+    METRICS.enabled = True
+
+class Protocol:
+    # the decorator only needs the run generator of an object
+    def __init__(self):
+        self.log = []
+
+    @instrumented
+    def run(self):
+        try:
+            while True:
+                try:
+                    value = yield "expression"
+                    self.log.append(value)
+                except ValueError as error:
+                    self.log.append(f"caught {error}")
+                    return "done"
+        finally:
+            self.log.append("cleanup")
+
+def test_bins_are_logarithmic():
+    assert _bin_index(0.5) == 0
+    assert _bin_index(1) == 1
+    assert _bin_index(10) == 1 + 10
+    assert _bin_index(1e20) == NUM_BINS - 1
+    # every value is below the upper edge of its bin
+    for value in (1, 3.7, 150, 2e6):
+        assert value < BIN_EDGES[_bin_index(value)]
+
+def test_quantiles_are_clipped_to_the_observed_values():
+    histogram = Histogram()
+    assert histogram.quantile(0.5) is None
+    for value in [100] * 90 + [1e4] * 10:
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == pytest.approx(BIN_EDGES[_bin_index(100)])
+    assert histogram.quantile(0.99) == 1e4
+    assert histogram.quantile(0) >= 100
+
+    summary = histogram.summary()
+    assert summary["count"] == 100
+    assert summary["mean"] == pytest.approx(1090)
+    assert summary["min"] == 100 and summary["max"] == 1e4
+
+def test_merging_snapshots_adds_counters_and_histograms(tmp_path):
+    first, second = Metrics(), Metrics()
+    first.observe("purif_total", 10)
+    first.count("purification_rounds", 2)
+    first.add_wall_time("PurificationProtocol", 0.5)
+    second.observe("purif_total", 1000)
+    second.observe("swap_bsm", 1)
+    second.count("purification_rounds")
+    second.count("purification_matches")
+    second.add_wall_time("PurificationProtocol", 0.25)
+
+    merged = Metrics()
+    merged.merge(first.snapshot())
+    merged.merge(second.snapshot())
+    assert merged.counters == {"purification_rounds": 3, "purification_matches": 1}
+    assert merged.latencies["purif_total"].count == 2
+    assert merged.latencies["purif_total"].min == 10 and merged.latencies["purif_total"].max == 1000
+    assert merged.latencies["swap_bsm"].count == 1
+    assert merged.wall_times["PurificationProtocol"] == [0.75, 2]
+    assert merged.summary()["purification_match_rate"] == pytest.approx(1 / 3)
+
+    # the exported snapshot is loaded back as the same metrics
+    path = str(tmp_path / "metrics.json")
+    merged.export(path)
+    loaded = load(path)
+    assert loaded.counters == merged.counters
+    assert loaded.latencies["purif_total"].counts.tolist() == merged.latencies["purif_total"].counts.tolist()
+    assert loaded.wall_times == merged.wall_times
+
+def test_instrumented_forwards_values_and_measures_the_run(metrics):
+    protocol = Protocol()
+    generator = protocol.run()
+    assert next(generator) == "expression"
+    assert generator.send(1) == "expression"
+    with pytest.raises(StopIteration) as stop:
+        generator.throw(ValueError("stop"))
+    assert stop.value.value == "done"
+    assert protocol.log == [1, "caught stop", "cleanup"]
+    seconds, resumes = metrics.wall_times["Protocol"]
+    assert resumes == 3 and seconds >= 0
+
+def test_closing_the_wrapper_closes_the_inner_run(metrics):
+    protocol = Protocol()
+    generator = protocol.run()
+    next(generator)
+    generator.send(1)
+    generator.close()
+    # the finally of the inner run is executed when the protocol is stopped
+    assert protocol.log == [1, "cleanup"]
+
+def test_disabled_metrics_measure_nothing(metrics):
+    metrics.enabled = False
+    protocol = Protocol()
+    generator = protocol.run()
+    next(generator)
+    generator.close()
+    assert protocol.log == ["cleanup"]
+    assert metrics.wall_times == {}
@@ -0,0 +1,31 @@
+import pytest
+
+from links import check_cutoff, eps_frequency, eps_period, herald_probabilities, min_generation_time
+
+def test_eps_period_is_the_inverse_of_the_frequency():
+    assert eps_period(10) == pytest.approx(1e9 / eps_frequency(10))
+    assert eps_period(10) == pytest.approx(1.)
+
+def test_min_generation_time_crosses_the_link_twice():
+    # 30 km take 150000 nsecs, plus a window of 45 attempts of 10 nsecs
+    assert min_generation_time(30, 45, 10) == pytest.approx(2 * 150000 + 450)
+
+def test_cutoff_shorter_than_a_generation_is_rejected():
+    min_time = min_generation_time(30, 45, 10)
+    with pytest.raises(ValueError):
+        check_cutoff(1e5, min_time)
+    with pytest.raises(ValueError):
+        check_cutoff(min_time, min_time)
+    check_cutoff(1e6, min_time)
+    check_cutoff(None, min_time)
+
+def test_herald_probabilities_fold_the_losses_of_the_dense_source():
+    p_m, p_lr = 0.2, 0.7
+    p_herald, p_both = herald_probabilities(p_m, p_lr)
+    # the dense source: a pair with p_m, then every photon is lost independently
+    p_none_lost = p_m * p_lr ** 2
+    p_one_lost = p_m * 2 * p_lr * (1 - p_lr)
+    assert p_herald == pytest.approx(p_none_lost + p_one_lost)
+    assert p_both == pytest.approx(p_none_lost / (p_none_lost + p_one_lost))
+    # a node receives a photon from a pulse with the same probability as with the dense source
+    assert p_herald * (p_both + (1 - p_both) / 2) == pytest.approx(p_m * p_lr)
@@ -0,0 +1,126 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+import sweep
+from sweep import (ResultCache, WorkQueue, code_files, code_version, collect, computed_keys, grid_points, make_point,
+                   point_key, run_sweep, spec_key, spec_points)
+
+def columns(point, num_trials = 4):
+    # fake results of a point, the fidelity decreases with p_m so the adaptive sweep refines the low values
+    return {
+        "seed": np.arange(num_trials, dtype = np.uint32),
+        "purification_success": np.ones(num_trials, dtype = bool),
+        "final_bell_index": np.zeros(num_trials, dtype = np.int8),
+        "fidelity": np.full(num_trials, 1 - point["p_m"] ** 0.5),
+        "e2e_time": np.full(num_trials, 1e6),
+    }
+
+@pytest.fixture
+def fake_trials(monkeypatch):
+    computed = []
+    def run_point(point, num_trials, seed, workers = None):
+        computed.append(point)
+        return columns(point, num_trials)
+    monkeypatch.setattr(sweep, "run_point", run_point)
+    return computed
+
+def test_point_key_is_stable():
+    point = make_point({"p_m": 0.05, "link_length": 20})
+    reordered = dict(reversed(list(point.items())))
+    assert point_key(point, 10, 0, "v1") == point_key(reordered, 10, 0, "v1")
+    keys = {point_key(point, 10, 0, "v1"), point_key(point, 11, 0, "v1"), point_key(point, 10, 1, "v1"),
+            point_key(point, 10, 0, "v2"), point_key(make_point({"p_m": 0.06}), 10, 0, "v1")}
+    assert len(keys) == 5
+
+def test_code_version_hashes_every_module(tmp_path, monkeypatch):
+    names = {os.path.basename(path) for path in code_files()}
+    # the modules that were not hashed served stale results
+    assert {"sweep.py", "trials.py", "links.py", "tenancy.py", "probes.py"} <= names
+    assert code_version() == code_version()
+
+    module = tmp_path / "module.py"
+    module.write_text("A = 1\n")
+    monkeypatch.setattr(sweep, "code_files", lambda: sorted(str(path) for path in tmp_path.glob("*.py")))
+    version = code_version()
+    module.write_text("A = 2\n")
+    assert code_version() != version
+    edited = code_version()
+    (tmp_path / "other.py").write_text("")
+    assert code_version() != edited
+
+def test_claims_are_exclusive_and_stale_ones_are_reclaimed(tmp_path):
+    path = str(tmp_path / "queue.sqlite")
+    first, second = WorkQueue(path), WorkQueue(path)
+    keys = first.add(grid_points({"p_m": [0.01, 0.02]}), 10, 0, "v1")
+    # adding the same points again does nothing
+    assert second.add(grid_points({"p_m": [0.01, 0.02]}), 10, 0, "v1") == keys
+
+    claimed = [first.claim("a"), second.claim("b")]
+    assert sorted(claim[0] for claim in claimed) == sorted(keys)
+    assert first.claim("a") is None
+    assert second.claim("b", stale_after = 1000) is None
+
+    # the worker of the first point crashed long ago
+    first.connection.execute("UPDATE points SET claimed_at = ? WHERE key = ?", (time.time() - 100, claimed[0][0]))
+    reclaimed = second.claim("b", stale_after = 50)
+    assert reclaimed[0] == claimed[0][0]
+    assert reclaimed[1]["p_m"] == claimed[0][1]["p_m"]
+
+    first.finish(claimed[0][0])
+    second.finish(claimed[1][0], status = "failed")
+    assert first.counts() == {"done": 1, "failed": 1}
+    first.close()
+    second.close()
+
+def test_store_is_atomic_and_collect_reads_the_points(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path))
+    points = grid_points({"p_m": [0.01, 0.04]})
+    keys = [point_key(point, 4, 0, "v1") for point in points]
+    for key, point in zip(keys, points):
+        cache.store(key, point, columns(point))
+    assert cache.load(keys[0])[0] == points[0]
+
+    # a job that crashes while saving leaves neither the result nor the temporary file
+    def crash(*args, **kwargs):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(np, "savez", crash)
+    key = point_key(make_point({"p_m": 0.09}), 4, 0, "v1")
+    with pytest.raises(KeyboardInterrupt):
+        cache.store(key, make_point({"p_m": 0.09}), columns(make_point({"p_m": 0.09})))
+    assert not cache.has(key)
+    assert not [name for name in os.listdir(os.path.dirname(cache.path(key))) if name.endswith(".tmp")]
+
+    table = collect(keys, cache)
+    assert table["p_m"].tolist() == [0.01, 0.04]
+    assert table["fidelity"] == pytest.approx([0.9, 0.8])
+    assert table["completed"].tolist() == [1., 1.]
+    # the optional parameters are stored as nan
+    assert np.isnan(table["cutoff"]).all()
+
+def test_adaptive_sweep_is_collected_after_run(tmp_path, fake_trials):
+    cache = ResultCache(str(tmp_path))
+    spec = {"adaptive": {"param": "p_m", "low": 0.01, "high": 0.09, "initial": 3, "tolerance": 0.05, "max_rounds": 2},
+            "trials": 4, "seed": 0}
+
+    # before run the chosen points are unknown
+    with pytest.raises(RuntimeError):
+        computed_keys(spec, cache, version = "v1")
+
+    # like the run command: the last refinement adds points that are computed after the sampling
+    points = spec_points(spec, cache = cache, version = "v1")
+    run_sweep(points, cache, 4, seed = 0, version = "v1")
+    assert len(points) > 3
+    assert cache.load_sweep(spec_key(spec, "v1")) == points
+
+    keys = computed_keys(spec, cache, version = "v1")
+    assert keys == [point_key(point, 4, 0, "v1") for point in points]
+    assert collect(keys, cache)["p_m"].tolist() == [point["p_m"] for point in points]
+    # every point was computed once, the refinement reused the cached ones
+    assert len(fake_trials) == len(points)
+
+    # a new version of the code must run the sweep again
+    with pytest.raises(RuntimeError):
+        computed_keys(spec, cache, version = "v2")
@@ -0,0 +1,27 @@
+import pytest
+
+ns = pytest.importorskip("netsquid")
+
+from template import NetworkTemplate
+
+def test_reused_sparse_network_completes_every_trial():
+    ns.set_qstate_formalism(ns.QFormalism.DM)
+    template = NetworkTemplate(link_length = 30, p_lr = 0.9, p_m = 0.02, t_clock = 10, sparse_source = True)
+
+    # the second trial runs after ns.sim_reset, the sources must still emit
+    for seed in (1, 2):
+        protocols = template.run(seed = seed)
+        assert protocols["end"].final_bell_index is not None
+        assert protocols["end"].end_time > 0
+
+def test_cutoff_shorter_than_a_generation_is_rejected():
+    # a pair takes at least 3e5 nsecs on 30 km, with this cutoff every new pair would be discarded forever
+    with pytest.raises(ValueError):
+        NetworkTemplate(link_length = 30, p_lr = 0.9, p_m = 0.02, t_clock = 10, cutoff = 1e5)
+    # the repeater replaces a pair waiting for the swap with a whole purification round
+    with pytest.raises(ValueError):
+        NetworkTemplate(link_length = 30, p_lr = 0.9, p_m = 0.02, t_clock = 10, cutoff = 5e5)
+
+def test_chains_reject_the_cutoff():
+    with pytest.raises(ValueError):
+        NetworkTemplate(num_hops = 4, link_length = 30, p_lr = 0.9, p_m = 0.02, t_clock = 10, cutoff = 1e6)
@@ -0,0 +1,62 @@
+import math
+
+import pytest
+
+from links import eps_period
+from topology import Link, Topology, link_weight, load_edge_list
+
+def square():
+    # A - B - D is shorter than A - C - D, the links differ only in length
+    topology = Topology()
+    topology.add_link("A", "B", 10, 0.9, 0.02, 10)
+    topology.add_link("B", "D", 10, 0.9, 0.02, 10)
+    topology.add_link("A", "C", 50, 0.9, 0.02, 10)
+    topology.add_link("C", "D", 50, 0.9, 0.02, 10)
+    return topology
+
+def test_link_weight_uses_the_eps_period():
+    link = Link(length = 0, p_lr = 0.5, p_m = 0.1, t_clock = 10)
+    assert link_weight(link, "time") == pytest.approx(eps_period(10) / (0.1 * 0.25))
+    assert link_weight(link, "reliability") == pytest.approx(-math.log(0.1 * 0.25))
+    with pytest.raises(ValueError):
+        link_weight(link, "hops")
+
+def test_shortest_path_and_cost():
+    topology = square()
+    assert topology.path("A", "D") == ["A", "B", "D"]
+    expected = 2 * link_weight(topology.link("A", "B"))
+    assert topology.path_cost("A", "D") == pytest.approx(expected)
+    assert topology.path("A", "A") == ["A"]
+
+def test_add_link_invalidates_the_cached_paths():
+    topology = square()
+    assert topology.path("A", "D") == ["A", "B", "D"]
+
+    topology.add_link("A", "D", 1, 0.9, 0.02, 10)
+    assert topology.path("A", "D") == ["A", "D"]
+    assert topology.path_cost("A", "D") == pytest.approx(link_weight(topology.link("A", "D")))
+
+def test_unreachable_and_unknown_nodes():
+    topology = square()
+    topology.add_link("E", "F", 10, 0.9, 0.02, 10)
+    with pytest.raises(ValueError):
+        topology.path("A", "E")
+    assert topology.path_cost("A", "E") == math.inf
+    with pytest.raises(KeyError):
+        topology.path("Z", "A")
+    with pytest.raises(ValueError):
+        topology.add_link("A", "A", 10, 0.9, 0.02, 10)
+
+def test_load_edge_list(tmp_path):
+    path = tmp_path / "mesh.txt"
+    path.write_text("# a comment\nA B\nB C 20 0.8\n\nC D 5 0.9 0.05 20  # inline comment\n")
+    topology = load_edge_list(str(path))
+    assert topology.nodes == ["A", "B", "C", "D"]
+    assert topology.num_links == 3
+    assert topology.link("B", "C") == Link(length = 20, p_lr = 0.8, p_m = 0.02, t_clock = 10)
+    assert topology.link("D", "C") == Link(length = 5, p_lr = 0.9, p_m = 0.05, t_clock = 20)
+    assert topology.path("A", "D") == ["A", "B", "C", "D"]
+
+    path.write_text("A\n")
+    with pytest.raises(ValueError):
+        load_edge_list(str(path))
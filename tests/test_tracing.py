@@ -0,0 +1,58 @@
+import numpy as np
+
+from tracing import (DEBUG, EVENT_DTYPE, INFO, MS_LATCHED, PURIF_FIDELITY, SWAP_FINAL_STATE, SWAP_WAITING, Tracer,
+                     format_event, load)
+
+def test_levels_below_the_tracer_are_not_recorded():
+    tracer = Tracer(capacity = 4, level = INFO)
+    tracer.record(1., DEBUG, PURIF_FIDELITY, "Repeater", "PP_rep_1", value = 0.9)
+    tracer.record(2., INFO, MS_LATCHED, "Repeater", "MS0", attempt = 3)
+    assert len(tracer.events()) == 1
+    assert tracer.dropped == 0
+
+def test_ring_buffer_keeps_the_newest_events_in_order():
+    tracer = Tracer(capacity = 4, level = DEBUG)
+    for attempt in range(10):
+        tracer.record(float(attempt), INFO, MS_LATCHED, "Repeater", "MS0", attempt = attempt)
+
+    events = tracer.events()
+    assert events["attempt"].tolist() == [6, 7, 8, 9]
+    assert events["sim_time"].tolist() == [6., 7., 8., 9.]
+    assert tracer.dropped == 6
+
+    tracer.clear()
+    assert len(tracer.events()) == 0
+    assert tracer.dropped == 0
+
+def test_dump_and_load_round_trip(tmp_path):
+    tracer = Tracer(capacity = 3, level = DEBUG)
+    tracer.record(1., INFO, SWAP_WAITING, "Repeater", "ent_swapping_repeater", peer = "PP_rep_1")
+    tracer.record(2., DEBUG, PURIF_FIDELITY, "End_l", "PP_l", value = 0.93)
+    tracer.record(3., INFO, SWAP_FINAL_STATE, "End_r", "ent_swapping_r_node", outcome = 2)
+    tracer.record(4., INFO, MS_LATCHED, "End_r", "MS1", attempt = 17)
+
+    for compressed in (True, False):
+        path = str(tmp_path / f"trace_{compressed}.npz")
+        tracer.dump(path, compressed = compressed)
+        events, names = load(path)
+        assert names == tracer.names
+        for field in EVENT_DTYPE.names:
+            # the values that were not set are nan, they are equal for numpy
+            np.testing.assert_array_equal(events[field], tracer.events()[field])
+        assert [names[index] for index in events["protocol"]] == ["PP_l", "ent_swapping_r_node", "MS1"]
+
+def test_format_event():
+    tracer = Tracer(level = DEBUG)
+    tracer.record(1., INFO, SWAP_WAITING, "Repeater", "ent_swapping_repeater", peer = "PP_rep_1")
+    tracer.record(2., INFO, SWAP_FINAL_STATE, "End_r", "ent_swapping_r_node", outcome = 2)
+    tracer.record(3., INFO, SWAP_FINAL_STATE, "End_r", "ent_swapping_r_node")
+    tracer.record(4., INFO, MS_LATCHED, "End_r", "MS1", attempt = 17)
+
+    lines = [format_event(event, tracer.names) for event in tracer.events()]
+    assert lines == tracer.format()
+    assert lines == [
+        "[1.0] Node Repeater: waiting for purification protocol PP_rep_1 to terminate",
+        "[2.0] Node End_r: I'm entangled with the left end-node with state b10",
+        "[3.0] Node End_r: I'm entangled with the left end-node with state ?",
+        "[4.0] Node End_r: Latched photon at attempt 17",
+    ]
@@ -0,0 +1,183 @@
+import argparse
+import collections
+import heapq
+import json
+import math
+
+from links import FIBRE_SPEED, eps_period
+
+# weights of the links used to choose the path of a pair
+ROUTING_METRICS = ("time", "reliability")
+
+Link = collections.namedtuple("Link", ["length", "p_lr", "p_m", "t_clock"])
+
+def link_weight(link, metric = "time"):
+    # probability that a pulse of the EPS entangles the two nodes
+    p_pair = link.p_m * link.p_lr ** 2
+    if metric == "time":
+        # expected nsecs to entangle the link: the pulses needed for a pair, then the photons travel
+        return eps_period(link.t_clock) / p_pair + link.length / FIBRE_SPEED * 10 ** 9
+    if metric == "reliability":
+        # the most reliable path maximizes the product of the probabilities, so it minimizes the sum of -log
+        return -math.log(p_pair)
+    raise ValueError(f"Unknown metric {metric}, the metrics are {ROUTING_METRICS}")
+
+class Topology:
+    """
+    This class describes a mesh of repeaters, it builds the network of a path only when a pair needs it
+    """
+
+    def __init__(self, max_templates = 16):
+        self._adjacency = collections.defaultdict(dict)
+        # (source, metric) -> distances and predecessors of the shortest paths from source
+        self._path_cache = {}
+        # the networks already built, the least recently used one is dropped when there are too many
+        self._templates = collections.OrderedDict()
+        self.max_templates = max_templates
+
+    def add_link(self, node_a, node_b, length, p_lr, p_m, t_clock):
+        if node_a == node_b:
+            raise ValueError(f"The link of {node_a} connects the node to itself")
+        link = Link(length = length, p_lr = p_lr, p_m = p_m, t_clock = t_clock)
+        self._adjacency[node_a][node_b] = link
+        self._adjacency[node_b][node_a] = link
+        # the paths computed so far may not be the shortest ones anymore
+        self._path_cache.clear()
+        self._templates.clear()
+
+    @property
+    def nodes(self):
+        return sorted(self._adjacency)
+
+    @property
+    def num_links(self):
+        return sum(len(neighbours) for neighbours in self._adjacency.values()) // 2
+
+    def link(self, node_a, node_b):
+        return self._adjacency[node_a][node_b]
+
+    def _shortest_paths(self, source, metric):
+        key = (source, metric)
+        cached = self._path_cache.get(key)
+        if cached is not None:
+            return cached
+
+        if source not in self._adjacency:
+            raise KeyError(f"Unknown node {source}")
+
+        # dijkstra from the source, the result is used by all the destinations
+        distances = {source: 0.}
+        previous = {}
+        heap = [(0., source)]
+        while heap:
+            distance, node = heapq.heappop(heap)
+            if distance > distances[node]:
+                continue
+            for neighbour, link in self._adjacency[node].items():
+                candidate = distance + link_weight(link, metric)
+                if candidate < distances.get(neighbour, math.inf):
+                    distances[neighbour] = candidate
+                    previous[neighbour] = node
+                    heapq.heappush(heap, (candidate, neighbour))
+
+        self._path_cache[key] = (distances, previous)
+        return distances, previous
+
+    def path(self, source, destination, metric = "time"):
+        distances, previous = self._shortest_paths(source, metric)
+        if destination not in distances:
+            raise ValueError(f"There is no path from {source} to {destination}")
+
+        path = [destination]
+        while path[-1] != source:
+            path.append(previous[path[-1]])
+        return path[::-1]
+
+    def path_cost(self, source, destination, metric = "time"):
+        distances, _ = self._shortest_paths(source, metric)
+        return distances.get(destination, math.inf)
+
+    def link_params(self, path):
+        # the parameters of the hops of the chain that simulates the path
+        return [{"link_length": link.length, "p_lr": link.p_lr, "p_m": link.p_m, "t_clock": link.t_clock}
+                for link in (self.link(node_a, node_b) for node_a, node_b in zip(path, path[1:]))]
+
+    def template(self, source, destination, metric = "time", swap_order = "nested", **params):
+        # imported here so that the routing can be used without netsquid
+        from template import NetworkTemplate
+
+        path = self.path(source, destination, metric)
+        key = (tuple(path), swap_order, tuple(sorted(params.items())))
+        template = self._templates.get(key)
+        if template is not None:
+            self._templates.move_to_end(key)
+            return template
+
+        # only the nodes and the links of the path are instantiated, as a chain with the parameters of each link
+        link_params = self.link_params(path)
+        template = NetworkTemplate(num_hops = len(path) - 1, swap_order = swap_order, link_params = link_params,
+                                   node_names = [str(node) for node in path], **link_params[0], **params)
+
+        self._templates[key] = template
+        if len(self._templates) > self.max_templates:
+            self._templates.popitem(last = False)
+        return template
+
+    def run_trials(self, source, destination, num_trials, seed = 0, metric = "time", swap_order = "nested", **params):
+        import netsquid as ns
+        from trials import collect_result, trial_seeds
+
+        ns.set_qstate_formalism(ns.QFormalism.DM)
+        template = self.template(source, destination, metric = metric, swap_order = swap_order, **params)
+
+        results = []
+        for trial, trial_seed in enumerate(trial_seeds(seed, num_trials)):
+            protocols = template.run(seed = trial_seed)
+            results.append(collect_result(trial, trial_seed, protocols))
+        return results
+
+def load_edge_list(path, length = 30, p_lr = 0.9, p_m = 0.02, t_clock = 10, max_templates = 16):
+    # one link per line: node_a node_b [length [p_lr [p_m [t_clock]]]], the missing values are the defaults
+    topology = Topology(max_templates = max_templates)
+    defaults = [length, p_lr, p_m, t_clock]
+
+    with open(path) as f:
+        for line_number, line in enumerate(f, start = 1):
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            if len(fields) < 2 or len(fields) > 6:
+                raise ValueError(f"{path}:{line_number}: a link needs 2 to 6 fields, found {len(fields)}")
+
+            values = [float(value) for value in fields[2:]] + defaults[len(fields) - 2:]
+            topology.add_link(fields[0], fields[1], *values)
+
+    return topology
+
+def main():
+    parser = argparse.ArgumentParser(description = "Simulate the pairs between two nodes of a mesh of repeaters")
+    parser.add_argument("edge_list", help = "file with a link per line: node_a node_b [length [p_lr [p_m [t_clock]]]]")
+    parser.add_argument("--source", required = True)
+    parser.add_argument("--destination", required = True)
+    parser.add_argument("--metric", choices = ROUTING_METRICS, default = "time")
+    parser.add_argument("--swap-order", choices = ("nested", "parallel"), default = "nested")
+    parser.add_argument("--trials", type = int, default = 10)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--depolar-rate", type = float, default = 0.1)
+    parser.add_argument("--sparse-source", action = "store_true")
+    args = parser.parse_args()
+
+    topology = load_edge_list(args.edge_list)
+    path = topology.path(args.source, args.destination, args.metric)
+
+    results = topology.run_trials(args.source, args.destination, num_trials = args.trials, seed = args.seed,
+                                  metric = args.metric, swap_order = args.swap_order,
+                                  depolar_rate = args.depolar_rate, sparse_source = args.sparse_source)
+
+    from trials import aggregate
+
+    print(json.dumps({"path": path, "cost": topology.path_cost(args.source, args.destination, args.metric),
+                      "summary": aggregate(results)}, indent = 2))
+
+if __name__ == '__main__':
+    main()
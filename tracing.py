@@ -0,0 +1,154 @@
+import math
+
+import numpy as np
+
+# levels of the events, a tracer records the events with a level greater or equal to its own
+DEBUG = 10
+INFO = 20
+OFF = 100
+
+# phases of the protocols
+MS_START_SENT = 1
+MS_LATCHED = 2
+MS_SUCCESS = 3
+PURIF_PAIRS_READY = 4
+PURIF_SUCCESS = 5
+PURIF_FIDELITY = 6
+PURIF_FAILED = 7
+PURIF_TERMINATED = 8
+SWAP_WAITING = 9
+SWAP_START = 10
+SWAP_BSM_SENT = 11
+SWAP_FINAL_STATE = 12
+
+BELL_STATE_NAMES = ["b00", "b01", "b10", "b11"]
+
+# one fixed width record for each event. node, protocol and peer are indices in the table of names
+EVENT_DTYPE = np.dtype([
+    ("sim_time", "f8"),
+    ("node", "u2"),
+    ("protocol", "u2"),
+    ("peer", "u2"),
+    ("phase", "u1"),
+    ("level", "u1"),
+    ("attempt", "i8"),
+    ("outcome", "i8"),
+    ("value", "f8"),
+    ("value2", "f8"),
+])
+
+# the human readable lines printed by the protocols
+_FORMATS = {
+    MS_START_SENT: "Node {node}: Sending START message with value {value:.0f}",
+    MS_LATCHED: "Node {node}: Latched photon at attempt {attempt}",
+    MS_SUCCESS: "Node {node}: Entanglement generation successful at attempt {attempt}",
+    PURIF_PAIRS_READY: "Node {node}: Both qubits are entangled with fidelity {value} and {value2}",
+    PURIF_SUCCESS: "Node {node}: Purification successful",
+    PURIF_FIDELITY: "Node {node}: Fidelity of the new qubit pair with respect to the Bell state: {value}",
+    PURIF_FAILED: "Node {node}: Purification failed",
+    PURIF_TERMINATED: "Purification protocol {protocol} terminated",
+    SWAP_WAITING: "Node {node}: waiting for purification protocol {peer} to terminate",
+    SWAP_START: "Node {node}: starting the swapping",
+    SWAP_BSM_SENT: "Node {node}: sending in output the BSM {outcome}",
+    SWAP_FINAL_STATE: "Node {node}: I'm entangled with the left end-node with state {bell_state}",
+}
+
+def format_event(event, names):
+    line = _FORMATS[int(event["phase"])].format(
+        node = names[event["node"]],
+        protocol = names[event["protocol"]],
+        peer = names[event["peer"]],
+        attempt = int(event["attempt"]),
+        outcome = int(event["outcome"]),
+        value = float(event["value"]),
+        value2 = float(event["value2"]),
+        bell_state = BELL_STATE_NAMES[int(event["outcome"])] if 0 <= event["outcome"] < 4 else "?",
+    )
+    return f"[{float(event['sim_time'])}] {line}"
+
+def format_events(events, names):
+    return [format_event(event, names) for event in events]
+
+class Tracer:
+    """
+    This class records the events of the protocols in a preallocated ring buffer
+    """
+
+    def __init__(self, capacity = 1 << 16, level = OFF, echo = False):
+        self.capacity = capacity
+        self.level = level
+        # print the human readable line of each event as soon as it is recorded
+        self.echo = echo
+
+        self._buffer = np.zeros(capacity, dtype = EVENT_DTYPE)
+        self._count = 0
+        # names of the nodes and protocols, the first one is used when there is no peer
+        self._names = [""]
+        self._name_index = {"": 0}
+
+    def set_level(self, level, echo = None):
+        self.level = level
+        if echo is not None:
+            self.echo = echo
+
+    def _intern(self, name):
+        index = self._name_index.get(name)
+        if index is None:
+            index = len(self._names)
+            self._names.append(name)
+            self._name_index[name] = index
+        return index
+
+    def record(self, sim_time, level, phase, node, protocol, peer = "", attempt = -1, outcome = -1,
+               value = math.nan, value2 = math.nan):
+        # the callers check the level before calling, this check is for the direct calls
+        if level < self.level:
+            return
+
+        event = (sim_time, self._intern(node), self._intern(protocol), self._intern(peer), phase, level,
+                 attempt, outcome, value, value2)
+        self._buffer[self._count % self.capacity] = event
+        self._count += 1
+
+        if self.echo:
+            print(format_event(self._buffer[(self._count - 1) % self.capacity], self._names))
+
+    @property
+    def names(self):
+        return list(self._names)
+
+    @property
+    def dropped(self):
+        # number of events overwritten because the buffer is full
+        return max(0, self._count - self.capacity)
+
+    def events(self):
+        # copy of the events in the buffer, from the oldest to the newest
+        if self._count <= self.capacity:
+            return self._buffer[:self._count].copy()
+        start = self._count % self.capacity
+        return np.concatenate([self._buffer[start:], self._buffer[:start]])
+
+    def clear(self):
+        self._count = 0
+
+    def format(self):
+        return format_events(self.events(), self._names)
+
+    def dump(self, path, compressed = True):
+        # every field is saved as its own array, so a single column can be loaded without the others
+        events = self.events()
+        columns = {field: events[field] for field in EVENT_DTYPE.names}
+        save = np.savez_compressed if compressed else np.savez
+        save(path, names = np.array(self._names), dropped = np.array(self.dropped), **columns)
+
+def load(path):
+    with np.load(path) as data:
+        events = np.zeros(len(data["sim_time"]), dtype = EVENT_DTYPE)
+        for field in EVENT_DTYPE.names:
+            events[field] = data[field]
+        names = [str(name) for name in data["names"]]
+    return events, names
+
+# tracer shared by all the protocols, it is disabled by default
+TRACER = Tracer()
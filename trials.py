@@ -0,0 +1,199 @@
+import argparse
+import collections
+import json
+import math
+import multiprocessing
+import os
+import statistics
+import uuid
+
+import netsquid as ns
+import numpy as np
+
+from attempt_store import ATTEMPTS
+from chain import SWAP_ORDERS
+from ent_swapping import e2e_fidelity
+from instrumentation import METRICS
+from template import NetworkTemplate
+
+# result of a single simulation of the network
+TrialResult = collections.namedtuple("TrialResult", ["trial", "seed", "purification_success", "purification_results",
+                                                     "final_bell_index", "fidelity", "e2e_time"])
+
+def trial_seeds(seed, num_trials):
+    # every trial gets its own independent stream, spawned from the root seed
+    children = np.random.SeedSequence(seed).spawn(num_trials)
+    return [int(child.generate_state(1)[0]) for child in children]
+
+def collect_result(trial, seed, protocols):
+    purification_results = tuple(protocol.success for protocol in protocols["purification"])
+    end = protocols["end"]
+
+    return TrialResult(trial = trial, seed = seed, purification_success = all(purification_results),
+                       purification_results = purification_results, final_bell_index = end.final_bell_index,
+                       fidelity = e2e_fidelity(end), e2e_time = end.end_time)
+
+# the network of the last parameter set, reused by the following trials of the same process
+_template = None
+_template_params = None
+
+def _get_template(params):
+    global _template, _template_params
+    if params != _template_params:
+        _template = NetworkTemplate(**params)
+        _template_params = params
+    return _template
+
+def run_trial(link_length, p_lr, p_m, t_clock, seed, trial = 0, sparse_source = False, K_attempts = None,
+              num_hops = None, swap_order = "nested", depolar_rate = 0.1, multiplexed = False, slots_per_link = 2,
+              memory_depolar_rate = 0., cutoff = None):
+    params = {"link_length": link_length, "p_lr": p_lr, "p_m": p_m, "t_clock": t_clock, "sparse_source": sparse_source,
+              "K_attempts": K_attempts, "num_hops": num_hops, "swap_order": swap_order, "depolar_rate": depolar_rate,
+              "multiplexed": multiplexed, "slots_per_link": slots_per_link, "memory_depolar_rate": memory_depolar_rate,
+              "cutoff": cutoff}
+
+    # every trial starts from a clean simulator with its own random state, the network is built only once
+    ns.set_qstate_formalism(ns.QFormalism.DM)
+    protocols = _get_template(params).run(seed = seed)
+
+    return collect_result(trial, seed, protocols)
+
+def _run_trial_job(job):
+    trial, seed, params = job
+    ATTEMPTS.trial = trial
+    return run_trial(seed = seed, trial = trial, **params)
+
+def _run_trial_job_with_metrics(job):
+    # the metrics of the worker are sent back with the result and merged in the metrics of the parent process
+    METRICS.reset()
+    result = _run_trial_job(job)
+    # the pool kills its workers at the end, the attempts must be on disk before the result is sent back
+    if ATTEMPTS.enabled:
+        ATTEMPTS.flush()
+    return result, METRICS.snapshot()
+
+def _open_attempts(directory, run_id):
+    # every process of every run appends to its own store, the reader maps all of them. The pids are reused
+    # by the runs that share the directory, the run id is not
+    ATTEMPTS.open(os.path.join(directory, f"run_{run_id}", f"process_{os.getpid()}"))
+
+def run_trials(num_trials, link_length, p_lr, p_m, t_clock, seed = 0, workers = None, sparse_source = False,
+               K_attempts = None, num_hops = None, swap_order = "nested", depolar_rate = 0.1, multiplexed = False,
+               slots_per_link = 2, memory_depolar_rate = 0., cutoff = None, attempts_dir = None):
+    params = {"link_length": link_length, "p_lr": p_lr, "p_m": p_m, "t_clock": t_clock, "sparse_source": sparse_source,
+              "K_attempts": K_attempts, "num_hops": num_hops, "swap_order": swap_order, "depolar_rate": depolar_rate,
+              "multiplexed": multiplexed, "slots_per_link": slots_per_link, "memory_depolar_rate": memory_depolar_rate,
+              "cutoff": cutoff}
+    jobs = [(trial, trial_seed, params) for trial, trial_seed in enumerate(trial_seeds(seed, num_trials))]
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    run_id = uuid.uuid4().hex
+
+    if workers <= 1:
+        if attempts_dir is not None:
+            _open_attempts(attempts_dir, run_id)
+        try:
+            results = [_run_trial_job(job) for job in jobs]
+        finally:
+            if attempts_dir is not None:
+                ATTEMPTS.close()
+    else:
+        # netsquid is imported once per worker process and not once per trial
+        chunksize = max(1, num_trials // (workers * 4))
+        initializer, initargs = (_open_attempts, (attempts_dir, run_id)) if attempts_dir is not None else (None, ())
+        with multiprocessing.Pool(processes = workers, initializer = initializer, initargs = initargs) as pool:
+            results = []
+            for result, snapshot in pool.imap_unordered(_run_trial_job_with_metrics, jobs, chunksize = chunksize):
+                results.append(result)
+                METRICS.merge(snapshot)
+
+    results.sort(key = lambda result: result.trial)
+    return results
+
+def _z_value(confidence):
+    return statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+
+def _mean_interval(values, confidence):
+    if len(values) == 0:
+        return {"n": 0, "mean": None, "ci": (None, None)}
+    mean = statistics.fmean(values)
+    if len(values) == 1:
+        return {"n": 1, "mean": mean, "ci": (mean, mean)}
+    half_width = _z_value(confidence) * statistics.stdev(values) / math.sqrt(len(values))
+    return {"n": len(values), "mean": mean, "ci": (mean - half_width, mean + half_width)}
+
+def _proportion_interval(successes, n, confidence):
+    # Wilson score interval, it behaves well also when the rate is close to 0 or 1
+    if n == 0:
+        return {"n": 0, "rate": None, "ci": (None, None)}
+    z = _z_value(confidence)
+    rate = successes / n
+    denominator = 1 + z ** 2 / n
+    center = (rate + z ** 2 / (2 * n)) / denominator
+    half_width = z * math.sqrt(rate * (1 - rate) / n + z ** 2 / (4 * n ** 2)) / denominator
+    return {"n": n, "rate": rate, "ci": (center - half_width, center + half_width)}
+
+def aggregate(results, confidence = 0.95):
+    completed = [result for result in results if result.final_bell_index is not None]
+    bell_counts = collections.Counter(result.final_bell_index for result in completed)
+
+    return {
+        "trials": len(results),
+        "confidence": confidence,
+        "completed": _proportion_interval(len(completed), len(results), confidence),
+        "purification_success": _proportion_interval(sum(result.purification_success for result in results),
+                                                     len(results), confidence),
+        "fidelity": _mean_interval([result.fidelity for result in completed], confidence),
+        "e2e_time": _mean_interval([result.e2e_time for result in completed], confidence),
+        "final_bell_index": {index: bell_counts.get(index, 0) for index in range(4)},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description = "Run independent trials of the repeater network in parallel")
+    parser.add_argument("--trials", type = int, default = 100)
+    parser.add_argument("--workers", type = int, default = None, help = "number of processes, all the cores by default")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--link-length", type = float, default = 30)
+    parser.add_argument("--p-lr", type = float, default = 0.9)
+    parser.add_argument("--p-m", type = float, default = 0.02)
+    parser.add_argument("--t-clock", type = float, default = 10)
+    parser.add_argument("--depolar-rate", type = float, default = 0.1, help = "depolarizing probability of the photons")
+    parser.add_argument("--K-attempts", type = int, default = None, help = "attempts per window, ceil(p_lr / p_m) by default")
+    parser.add_argument("--hops", type = int, default = None, help = "simulate a repeater chain with this number of hops")
+    parser.add_argument("--swap-order", choices = SWAP_ORDERS, default = "nested")
+    parser.add_argument("--multiplexed", action = "store_true",
+                        help = "all the memory slots of a link try to latch photons at the same time")
+    parser.add_argument("--slots-per-link", type = int, default = 2)
+    parser.add_argument("--memory-depolar-rate", type = float, default = 0., help = "depolarizing rate of the memories in Hz")
+    parser.add_argument("--cutoff", type = float, default = None,
+                        help = "nsecs a pair can wait for the other pair of its round before it is generated again")
+    parser.add_argument("--sparse-source", action = "store_true", help = "only simulate the pulses where a photon arrives")
+    parser.add_argument("--confidence", type = float, default = 0.95)
+    parser.add_argument("--output", default = None, help = "write the summary and the per-trial results in a json file")
+    parser.add_argument("--metrics", default = None, help = "write the latencies and counters of the phases in a json file")
+    parser.add_argument("--attempts", default = None,
+                        help = "record every window of heralding attempts in this directory, see attempt_store.py")
+    args = parser.parse_args()
+    if args.cutoff is not None and args.hops is not None:
+        parser.error("--cutoff is not supported by the chains of --hops")
+
+    results = run_trials(num_trials = args.trials, link_length = args.link_length, p_lr = args.p_lr, p_m = args.p_m,
+                         t_clock = args.t_clock, seed = args.seed, workers = args.workers,
+                         sparse_source = args.sparse_source, K_attempts = args.K_attempts, num_hops = args.hops,
+                         swap_order = args.swap_order, depolar_rate = args.depolar_rate, multiplexed = args.multiplexed,
+                         slots_per_link = args.slots_per_link, memory_depolar_rate = args.memory_depolar_rate,
+                         cutoff = args.cutoff, attempts_dir = args.attempts)
+    summary = aggregate(results, confidence = args.confidence)
+
+    print(json.dumps(summary, indent = 2))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"summary": summary, "results": [result._asdict() for result in results]}, f, indent = 2)
+
+    if args.metrics is not None:
+        METRICS.export(args.metrics)
+
+if __name__ == '__main__':
+    main()